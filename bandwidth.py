@@ -0,0 +1,178 @@
+"""Распределение полосы между торрент-загрузками.
+
+Общий бюджет (TORRENT_DOWNLOAD_LIMIT / TORRENT_UPLOAD_LIMIT, байт/с) может
+меняться по расписанию и урезается, пока веб-сервер отдает пользователям файлы.
+Бюджет делится сначала между пользователями, затем между их торрентами
+пропорционально приоритетам, с учетом ограничений пользователя и торрента.
+Полоса, которую торрент не может использовать (мало пиров), достается остальным.
+
+Везде 0 означает «без ограничения», как в libtorrent.
+"""
+import math
+import threading
+from datetime import datetime
+
+PRIORITY_WEIGHTS = {'low': 1, 'normal': 2, 'high': 4}
+DEFAULT_PRIORITY = 'normal'
+
+# Торрент, который использует меньше этой доли выделенной полосы, получает столько,
+# сколько реально качает (с запасом), а остаток отдается другим торрентам.
+# Запас и нижняя граница большие: на малых лимитах скорость в libtorrent сильно скачет,
+# и торрент иначе не выбирается из урезанного лимита
+DEMAND_THRESHOLD = 0.5
+DEMAND_HEADROOM = 2
+MIN_DEMAND = 128 * 1024
+
+# Меньше этого торренту не выделяется, чтобы не рвались соединения с пирами
+MIN_RATE = 4 * 1024
+
+
+def as_limit(value):
+    """0 или None — без ограничения"""
+    return value if value and value > 0 else math.inf
+
+
+def water_fill(budget, items):
+    """Делит budget между items = [(ключ, вес, потолок)] пропорционально весам.
+    Никто не получает больше своего потолка, остаток делится между остальными"""
+    shares = {}
+    remaining = list(items)
+    while remaining:
+        if budget == math.inf:
+            shares.update((key, cap) for key, weight, cap in remaining)
+            break
+
+        total_weight = sum(weight for key, weight, cap in remaining)
+        capped = [item for item in remaining if item[2] <= budget * item[1] / total_weight]
+        if not capped:
+            shares.update((key, budget * weight / total_weight) for key, weight, cap in remaining)
+            break
+
+        for key, weight, cap in capped:
+            shares[key] = cap
+            budget -= cap
+        remaining = [item for item in remaining if item not in capped]
+    return shares
+
+
+def parse_time(value):
+    hours, minutes = value.split(':')
+    return int(hours) * 60 + int(minutes)
+
+
+class BandwidthScheduler:
+    def __init__(self, download_limit=0, upload_limit=0, user_download_limit=0, user_upload_limit=0,
+                 schedule=None, busy_download_limit=0, busy_upload_limit=0):
+        self.limits = {'download': download_limit, 'upload': upload_limit}
+        self.user_limits = {'download': user_download_limit, 'upload': user_upload_limit}
+        self.busy_limits = {'download': busy_download_limit, 'upload': busy_upload_limit}
+
+        # Окна расписания: {'start': '08:00', 'end': '23:00', 'days': [0, 1, 2, 3, 4],
+        # 'download_limit': ..., 'upload_limit': ...}; окно может переходить через полночь
+        self.schedule = []
+        for window in schedule or []:
+            self.schedule.append({
+                'start': parse_time(window['start']),
+                'end': parse_time(window['end']),
+                'days': set(window['days']) if window.get('days') is not None else None,
+                'download': window.get('download_limit'),
+                'upload': window.get('upload_limit'),
+            })
+
+    def _window(self, now):
+        minute = now.hour * 60 + now.minute
+        for window in self.schedule:
+            if window['start'] <= window['end']:
+                inside = window['start'] <= minute < window['end']
+                day = now.weekday()
+            else:
+                inside = minute >= window['start'] or minute < window['end']
+                # После полуночи действует окно, начавшееся накануне
+                day = now.weekday() if minute >= window['start'] else (now.weekday() - 1) % 7
+            if inside and (window['days'] is None or day in window['days']):
+                return window
+        return None
+
+    def global_limits(self, now=None, busy=False):
+        """Общий бюджет {'download': ..., 'upload': ...} (math.inf — без ограничения)"""
+        window = self._window(now or datetime.now())
+        limits = {}
+        for direction in ('download', 'upload'):
+            limit = self.limits[direction]
+            if window is not None and window[direction] is not None:
+                limit = window[direction]
+            limit = as_limit(limit)
+            # Пока пользователи скачивают и смотрят файлы, торренты получают не больше busy-лимита
+            if busy:
+                limit = min(limit, as_limit(self.busy_limits[direction]))
+            limits[direction] = limit
+        return limits
+
+    def _demand(self, torrent, direction):
+        """Сколько торрент способен использовать: если он не выбирает выделенную
+        полосу, больше ему не нужно"""
+        applied = torrent.get(f'applied_{direction}_limit') or 0
+        rate = torrent.get(f'{direction}_rate') or 0
+        if applied > 0 and rate < applied * DEMAND_THRESHOLD:
+            return max(rate * DEMAND_HEADROOM, MIN_DEMAND)
+        return math.inf
+
+    def allocate(self, torrents, now=None, busy=False):
+        """Лимиты для активных торрентов.
+
+        torrents — задания с полями id, user_id, priority, download_limit, upload_limit,
+        download_rate, upload_rate и applied_*_limit (лимиты, выставленные в прошлый раз).
+        Возвращает (общие лимиты, {id: {'download': ..., 'upload': ...}}) в байт/с, 0 — без ограничения"""
+        budget = self.global_limits(now, busy)
+        allocation = {torrent['id']: {} for torrent in torrents}
+
+        by_user = {}
+        for torrent in torrents:
+            by_user.setdefault(torrent['user_id'], []).append(torrent)
+
+        for direction in ('download', 'upload'):
+            caps = {
+                torrent['id']: min(as_limit(torrent.get(f'{direction}_limit')), self._demand(torrent, direction))
+                for torrent in torrents
+            }
+            weights = {torrent['id']: PRIORITY_WEIGHTS.get(torrent.get('priority'), PRIORITY_WEIGHTS[DEFAULT_PRIORITY]) for torrent in torrents}
+
+            # Сначала бюджет делится между пользователями, затем между торрентами пользователя
+            user_items = [
+                (user_id, sum(weights[t['id']] for t in user_torrents),
+                 min(as_limit(self.user_limits[direction]), sum(caps[t['id']] for t in user_torrents)))
+                for user_id, user_torrents in by_user.items()
+            ]
+            user_shares = water_fill(budget[direction], user_items)
+
+            for user_id, user_torrents in by_user.items():
+                shares = water_fill(user_shares[user_id], [(t['id'], weights[t['id']], caps[t['id']]) for t in user_torrents])
+                for torrent_id, share in shares.items():
+                    allocation[torrent_id][direction] = 0 if share == math.inf else max(int(share), MIN_RATE)
+
+        session_limits = {direction: 0 if limit == math.inf else int(limit) for direction, limit in budget.items()}
+        return session_limits, allocation
+
+
+class HttpActivity:
+    """Число интерактивных HTTP-передач (скачивание, просмотр файлов), идущих в процессе веб-сервера"""
+    def __init__(self):
+        self.active = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+
+    def begin(self):
+        with self.lock:
+            self.active += 1
+        self.changed.set()
+
+    def end(self):
+        with self.lock:
+            self.active -= 1
+        self.changed.set()
+
+    def wait(self, timeout):
+        """Ждет изменения счетчика и возвращает текущее значение"""
+        self.changed.wait(timeout)
+        self.changed.clear()
+        return self.active
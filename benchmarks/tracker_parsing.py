@@ -0,0 +1,87 @@
+"""Замер разбора страниц поиска трекеров на сохраненных страницах (benchmarks/fixtures).
+
+Страницы повторяют разметку трекеров и содержат полные таблицы результатов
+(Rutor — 100 раздач, 1337x — 20, RuTracker и Kinozal — по 50, EZTV — 100),
+как при обычном поиске фильма.
+
+Для каждого трекера выводится время разбора страницы через trackers.parse_html
+и parse_page провайдера, число найденных результатов и, если установлен
+BeautifulSoup, для сравнения время разбора той же страницы html.parser
+с выбором строк результатов CSS-селектором (как было до перехода на lxml).
+
+Запуск: python benchmarks/tracker_parsing.py [-n ПОВТОРОВ]
+"""
+import argparse
+import math
+import os
+import sys
+import timeit
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+import requests
+
+import trackers
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:
+    BeautifulSoup = None
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# Трекер: (файл, Content-Type ответа, запрос, адрес сайта, селектор строк в старом разборе)
+FIXTURES = {
+    'Rutor': ('rutor.html', 'text/html', 'The Matrix 1999', None, '#index tr:not(:first-child)'),
+    '1337x': ('1337x.html', 'text/html; charset=utf-8', 'The Matrix 1999', 'https://1337x.to', 'table.table-list tbody tr'),
+    'RuTracker': ('rutracker.html', 'text/html; charset=windows-1251', 'Матрица 1999', None, 'table.forumline tr.hl-tr'),
+    'Kinozal': ('kinozal.html', 'text/html; charset=windows-1251', 'Матрица 1999', None, 'table.t_peer.w100p tr:not(.bg)'),
+    'EZTV': ('eztv.html', 'text/html; charset=utf-8', 'The Matrix Season', None, 'table tr.forum_header_border'),
+}
+
+
+def load_response(filename, content_type):
+    response = requests.Response()
+    response.status_code = 200
+    response.headers['Content-Type'] = content_type
+    with open(os.path.join(FIXTURES_DIR, filename), 'rb') as f:
+        response._content = f.read()
+    return response
+
+
+def best_time(func, number):
+    """Лучшее время одного вызова в миллисекундах"""
+    return min(timeit.repeat(func, number=1, repeat=number)) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', '--number', type=int, default=20, help='сколько раз разбирать каждую страницу')
+    args = parser.parse_args()
+
+    ctx = trackers.build_search_context('Матрица', 'The Matrix', 1999, math.inf)
+    providers = {provider.name: provider for provider in trackers.PROVIDERS}
+
+    print(f"{'трекер':<10} {'размер':>8} {'lxml, мс':>10} {'результатов':>12} {'bs4, мс':>10}")
+    for name, (filename, content_type, query, base_url, row_selector) in FIXTURES.items():
+        provider = providers[name]
+        response = load_response(filename, content_type)
+
+        def parse():
+            return provider.parse_page(trackers.parse_html(response), ctx, query, base_url)
+
+        results = parse()
+        lxml_ms = best_time(parse, args.number)
+
+        if BeautifulSoup is not None:
+            bs4_ms = best_time(lambda: BeautifulSoup(response.text, 'html.parser').select(row_selector), args.number)
+            bs4_column = f"{bs4_ms:>10.2f}"
+        else:
+            bs4_column = f"{'—':>10}"
+
+        print(f"{name:<10} {len(response.content) // 1024:>6} КБ {lxml_ms:>10.2f} {len(results):>12} {bs4_column}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,269 @@
+"""Кэш результатов внешних запросов (трекеры, API Кинопоиска).
+
+Два уровня: LRU в памяти процесса и необязательная SQLite-база на диске, общая
+для всех рабочих процессов и переживающая перезапуск. Для каждого пространства
+имен задаются свои сроки жизни:
+
+- ttl — сколько секунд значение считается свежим;
+- stale_ttl — сколько еще секунд после этого отдается устаревшее значение,
+  пока в фоне идет обновление (stale-while-revalidate);
+- negative_ttl — сколько секунд помнится ошибка или пустой ответ, чтобы не
+  повторять заведомо неудачный запрос.
+"""
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_POLICY = {'ttl': 3600, 'stale_ttl': 0, 'negative_ttl': 60}
+
+# Как часто (в записях) удалять из дискового кэша окончательно устаревшие значения
+DISK_CLEANUP_INTERVAL = 500
+
+
+class CachedFailure(Exception):
+    """Недавний запрос с этим ключом завершился ошибкой (негативный кэш)"""
+
+
+class Uncached:
+    """Обертка для результата загрузчика, который не нужно сохранять в кэш
+    (например, неполный ответ, собранный до дедлайна)"""
+    def __init__(self, value):
+        self.value = value
+
+
+class UncacheableError(Exception):
+    """Ошибка загрузчика, которую не нужно запоминать в негативном кэше"""
+
+
+def normalize_key(*parts):
+    """Ключ кэша: регистр и лишние пробелы в частях ключа не важны"""
+    return '\x1f'.join(' '.join(str(part).lower().split()) if part is not None else '' for part in parts)
+
+
+class _Flight:
+    """Загрузка, которая уже выполняется: остальные запросы того же ключа ждут ее результата"""
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class TTLCache:
+    def __init__(self, max_entries=2048, db_path=None, policies=None):
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.policies = policies or {}
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.refreshing = set()
+        self.refresh_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='cache-refresh')
+        self.stats = {'hits': 0, 'stale_hits': 0, 'negative_hits': 0, 'misses': 0, 'disk_hits': 0}
+
+        self._db_local = threading.local()
+        self._disk_writes = 0
+        if db_path:
+            self._init_disk()
+
+    # Дисковый уровень
+
+    def _db(self):
+        conn = getattr(self._db_local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=5, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._db_local.conn = conn
+        return conn
+
+    def _init_disk(self):
+        conn = self._db()
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS cache (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value TEXT,
+            error TEXT,
+            fresh_until REAL NOT NULL,
+            stale_until REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID
+        ''')
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_stale_until ON cache(stale_until)")
+        conn.commit()
+
+    def _disk_get(self, namespace, key):
+        try:
+            row = self._db().execute(
+                "SELECT value, error, fresh_until, stale_until FROM cache WHERE namespace = ? AND key = ?",
+                (namespace, key)
+            ).fetchone()
+        except sqlite3.Error as e:
+            print(f"Ошибка чтения дискового кэша: {str(e)}")
+            return None
+
+        if not row or row[3] <= time.time():
+            return None
+        return {
+            'value': json.loads(row[0]) if row[0] is not None else None,
+            'error': row[1],
+            'fresh_until': row[2],
+            'stale_until': row[3],
+        }
+
+    def _disk_set(self, namespace, key, entry):
+        try:
+            conn = self._db()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, error, fresh_until, stale_until) VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, key, json.dumps(entry['value'], ensure_ascii=False) if entry['error'] is None else None,
+                 entry['error'], entry['fresh_until'], entry['stale_until'])
+            )
+
+            self._disk_writes += 1
+            if self._disk_writes % DISK_CLEANUP_INTERVAL == 0:
+                conn.execute("DELETE FROM cache WHERE stale_until < ?", (time.time(),))
+            conn.commit()
+        except (sqlite3.Error, TypeError, ValueError) as e:
+            print(f"Ошибка записи в дисковый кэш: {str(e)}")
+
+    # Память
+
+    def policy(self, namespace):
+        """Сроки жизни для пространства имен: точное совпадение, затем префикс до ':'"""
+        policy = self.policies.get(namespace) or self.policies.get(namespace.split(':', 1)[0]) or {}
+        return {**DEFAULT_POLICY, **policy}
+
+    def _get(self, namespace, key):
+        with self.lock:
+            entry = self.entries.get((namespace, key))
+            if entry is not None:
+                self.entries.move_to_end((namespace, key))
+                return entry
+
+        if self.db_path:
+            entry = self._disk_get(namespace, key)
+            if entry is not None:
+                self.stats['disk_hits'] += 1
+                self._remember(namespace, key, entry)
+                return entry
+        return None
+
+    def _remember(self, namespace, key, entry):
+        with self.lock:
+            self.entries[(namespace, key)] = entry
+            self.entries.move_to_end((namespace, key))
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def _store(self, namespace, key, value=None, error=None, negative=False):
+        policy = self.policy(namespace)
+        now = time.time()
+        if error is not None or negative:
+            # Ошибки и пустые ответы не отдаются как устаревшие: после negative_ttl запрос повторяется
+            fresh_until = stale_until = now + policy['negative_ttl']
+        else:
+            fresh_until = now + policy['ttl']
+            stale_until = fresh_until + policy['stale_ttl']
+
+        entry = {'value': value, 'error': error, 'fresh_until': fresh_until, 'stale_until': stale_until}
+        self._remember(namespace, key, entry)
+        if self.db_path:
+            self._disk_set(namespace, key, entry)
+
+    def set(self, namespace, key, value):
+        self._store(namespace, key, value)
+
+    def invalidate(self, namespace, key):
+        with self.lock:
+            self.entries.pop((namespace, key), None)
+        if self.db_path:
+            try:
+                conn = self._db()
+                conn.execute("DELETE FROM cache WHERE namespace = ? AND key = ?", (namespace, key))
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"Ошибка удаления из дискового кэша: {str(e)}")
+
+    # Загрузка
+
+    def _load(self, namespace, key, loader, is_negative):
+        """Выполняет загрузчик один раз на ключ, даже если значение нужно нескольким потокам сразу"""
+        with self.lock:
+            flight = self.inflight.get((namespace, key))
+            leader = flight is None
+            if leader:
+                flight = self.inflight[(namespace, key)] = _Flight()
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise CachedFailure(flight.error)
+            return flight.value
+
+        try:
+            value = loader()
+            if isinstance(value, Uncached):
+                value = value.value
+            else:
+                self._store(namespace, key, value, negative=bool(is_negative and is_negative(value)))
+            flight.value = value
+            return value
+        except UncacheableError as e:
+            flight.error = str(e)
+            raise
+        except Exception as e:
+            flight.error = str(e)
+            self._store(namespace, key, error=str(e))
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop((namespace, key), None)
+            flight.event.set()
+
+    def _refresh(self, namespace, key, loader, is_negative):
+        """Фоновое обновление устаревшего значения"""
+        with self.lock:
+            if (namespace, key) in self.refreshing:
+                return
+            self.refreshing.add((namespace, key))
+
+        def run():
+            try:
+                self._load(namespace, key, loader, is_negative)
+            except Exception as e:
+                print(f"Ошибка фонового обновления кэша {namespace}: {str(e)}")
+            finally:
+                with self.lock:
+                    self.refreshing.discard((namespace, key))
+
+        self.refresh_executor.submit(run)
+
+    def get_or_load(self, namespace, key, loader, refresh=None, is_negative=None):
+        """Значение из кэша или результат loader().
+
+        refresh — загрузчик для фонового обновления устаревшего значения (по умолчанию loader);
+        is_negative(value) — считать ли успешный ответ пустым (кэшируется на negative_ttl).
+        Если недавний запрос завершился ошибкой, выбрасывает CachedFailure."""
+        entry = self._get(namespace, key)
+        now = time.time()
+
+        if entry is not None:
+            if now < entry['fresh_until']:
+                if entry['error'] is not None:
+                    self.stats['negative_hits'] += 1
+                    raise CachedFailure(entry['error'])
+                self.stats['hits'] += 1
+                return entry['value']
+
+            if entry['error'] is None and now < entry['stale_until']:
+                self.stats['stale_hits'] += 1
+                self._refresh(namespace, key, refresh or loader, is_negative)
+                return entry['value']
+
+        self.stats['misses'] += 1
+        return self._load(namespace, key, loader, is_negative)
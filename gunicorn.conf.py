@@ -0,0 +1,37 @@
+"""Настройки gunicorn для рабочего запуска (python serve.py).
+
+Рабочие процессы gthread: SSE-потоки прогресса и передача больших файлов держат
+поток на все время ответа, поэтому потоков в процессе намного больше, чем ядер.
+Часть потоков каждого процесса зарезервирована под API (API_RESERVED_THREADS в server.py).
+
+Значения можно переопределить в config.py:
+SERVER_BIND, SERVER_WORKERS, SERVER_THREADS, SERVER_GRACEFUL_TIMEOUT.
+"""
+import multiprocessing
+import os
+import runpy
+
+_base_dir = os.path.dirname(os.path.abspath(__file__))
+_config_path = os.path.join(_base_dir, 'config.py')
+_settings = runpy.run_path(_config_path) if os.path.exists(_config_path) else {}
+
+wsgi_app = 'server:app'
+chdir = _base_dir
+bind = _settings.get('SERVER_BIND', '0.0.0.0:5000')
+
+worker_class = 'gthread'
+workers = _settings.get('SERVER_WORKERS') or multiprocessing.cpu_count()
+threads = _settings.get('SERVER_THREADS', 32)
+
+# Для gthread timeout — сколько рабочий процесс может не отвечать арбитру, а не длительность
+# запроса, поэтому долгие потоки и загрузки не обрываются
+timeout = 60
+# SIGHUP и SIGTERM дают идущим запросам столько секунд на завершение
+graceful_timeout = _settings.get('SERVER_GRACEFUL_TIMEOUT', 30)
+keepalive = 5
+
+accesslog = '-'
+errorlog = '-'
+
+# server.py делит потоки процесса между долгими ответами и API
+os.environ['WALPSERVER_THREADS'] = str(threads)
@@ -0,0 +1,174 @@
+"""Общий HTTP-клиент для запросов к внешним сервисам (Кинопоиск, трекеры, зеркала).
+
+Один пул соединений на процесс: соединения с хостом переиспользуются между
+запросами и потоками (keep-alive), поэтому TLS-рукопожатие не повторяется на каждый
+запрос. У каждого запроса есть таймауты соединения и чтения по умолчанию, неудачные
+идемпотентные запросы повторяются с экспоненциальной паузой со случайным разбросом,
+а число одновременных запросов к одному хосту ограничено.
+
+Сессии из HttpClient.session() — обычные requests.Session со своими заголовками и
+cookies, но с общим пулом соединений, повторами, ограничениями и статистикой.
+"""
+import random
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+
+# Повторяются только запросы, которые безопасно отправить еще раз
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class HostBusyError(requests.ConnectionError):
+    """Слишком много одновременных запросов к хосту, очередь не освободилась вовремя"""
+
+
+class ClientSession(requests.Session):
+    """Сессия, отправляющая запросы через HttpClient"""
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        self.headers['User-Agent'] = USER_AGENT
+        self.mount('http://', client.adapter)
+        self.mount('https://', client.adapter)
+        # Дедлайн по умолчанию для всех запросов сессии (см. HttpClient.send)
+        self.deadline = None
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('deadline', self.deadline)
+        return self.client.send(super().request, method, url, **kwargs)
+
+    def close(self):
+        # Пул соединений общий и закрывается только вместе с клиентом
+        pass
+
+
+class HttpClient:
+    def __init__(self, connect_timeout=5, read_timeout=15, retries=2, backoff=0.5, max_backoff=8,
+                 pool_size=16, host_limit=8, queue_timeout=10):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.host_limit = host_limit
+        self.queue_timeout = queue_timeout
+
+        # Повторы делаются здесь, а не в urllib3, чтобы учитывать их в статистике и дедлайнах
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=host_limit, max_retries=0)
+        self.default_session = ClientSession(self)
+
+        self.host_slots = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def session(self, headers=None, verify=True, deadline=None):
+        session = ClientSession(self)
+        session.verify = verify
+        session.deadline = deadline
+        if headers:
+            session.headers.update(headers)
+        return session
+
+    def request(self, method, url, **kwargs):
+        return self.default_session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def head(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', False)
+        return self.request('HEAD', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def _host(self, host):
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = threading.BoundedSemaphore(self.host_limit)
+                self.stats[host] = {'requests': 0, 'errors': 0, 'retries': 0, 'busy': 0,
+                                    'active': 0, 'total_time': 0.0, 'statuses': {}}
+            return self.host_slots[host], self.stats[host]
+
+    def _count(self, stats, **changes):
+        with self.lock:
+            for key, value in changes.items():
+                stats[key] += value
+
+    def _delay(self, attempt, response=None):
+        """Пауза перед повтором: случайная в пределах растущего окна (full jitter),
+        но не меньше Retry-After, если сервер его прислал"""
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(int(retry_after), self.max_backoff))
+        return delay
+
+    def send(self, send, method, url, retries=None, deadline=None, **kwargs):
+        """Выполняет запрос функцией send (requests.Session.request) с ограничением по хосту
+        и повторами. deadline — момент time.monotonic(), после которого повторов не будет"""
+        kwargs.setdefault('timeout', self.timeout)
+        retries = self.retries if retries is None else retries
+        if method.upper() not in IDEMPOTENT_METHODS:
+            retries = 0
+
+        slots, stats = self._host(urllib.parse.urlsplit(url).netloc)
+        attempt = 0
+        while True:
+            if not slots.acquire(timeout=self.queue_timeout):
+                self._count(stats, busy=1)
+                raise HostBusyError(f"Слишком много одновременных запросов к {urllib.parse.urlsplit(url).netloc}")
+
+            self._count(stats, requests=1, active=1)
+            started = time.monotonic()
+            response = error = None
+            try:
+                # Для stream=True слот освобождается после заголовков, тело читается уже без него
+                response = send(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            finally:
+                slots.release()
+                elapsed = time.monotonic() - started
+                with self.lock:
+                    stats['active'] -= 1
+                    stats['total_time'] += elapsed
+                    if response is not None:
+                        stats['statuses'][response.status_code] = stats['statuses'].get(response.status_code, 0) + 1
+                    else:
+                        stats['errors'] += 1
+
+            retryable = error is not None or response.status_code in RETRY_STATUSES
+            if not retryable or attempt >= retries:
+                if error is not None:
+                    raise error
+                return response
+
+            delay = self._delay(attempt, response)
+            if deadline is not None and time.monotonic() + delay >= deadline:
+                if error is not None:
+                    raise error
+                return response
+
+            if response is not None:
+                response.close()
+            self._count(stats, retries=1)
+            attempt += 1
+            time.sleep(delay)
+
+    def snapshot(self):
+        """Статистика по хостам: число запросов, ошибок, повторов, среднее время ответа"""
+        with self.lock:
+            return {
+                host: dict(stats, statuses=dict(stats['statuses']),
+                           avg_time=round(stats['total_time'] / stats['requests'], 3) if stats['requests'] else None)
+                for host, stats in self.stats.items()
+            }
+
+    def close(self):
+        self.adapter.close()
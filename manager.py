@@ -7,6 +7,7 @@ import os
 import json
 from datetime import datetime
 import webbrowser
+import signal
 import sys
 import logging
 from flet import Colors, Icons
@@ -28,13 +29,16 @@ class ServerManager:
         self.is_running = False
         self.log_file = "server.log"
         self.server_dir = "/usr/lib/walpserver"
+        # serve.py перед выходом дожидается текущих запросов и сохраняет данные для возобновления торрентов
+        self.stop_timeout = 60
         
     def start_server(self):
         if not self.is_running:
             try:
                 # Убедимся, что сервер запускается в правильной директории
                 python_path = "/usr/lib/walpserver/venv/bin/python3"
-                server_path = os.path.join(self.server_dir, "server.py")
+                # serve.py запускает менеджер торрентов и gunicorn (см. gunicorn.conf.py)
+                server_path = os.path.join(self.server_dir, "serve.py")
                 
                 # Добавляем логирование команды запуска
                 start_msg = f"Starting server with Python: {python_path}"
@@ -80,7 +84,11 @@ class ServerManager:
         if self.is_running and self.server_process:
             try:
                 self.server_process.terminate()
-                self.server_process.wait(timeout=5)
+                try:
+                    self.server_process.wait(timeout=self.stop_timeout)
+                except subprocess.TimeoutExpired:
+                    self.server_process.kill()
+                    self.server_process.wait()
                 self.is_running = False
                 stop_msg = "Server stopped successfully"
                 self.logs.append(stop_msg)
@@ -93,6 +101,16 @@ class ServerManager:
                 return False, error_msg
         return False, "Server is not running"
             
+    def reload_server(self):
+        """Мягкая перезагрузка: gunicorn перезапускает рабочие процессы, загрузки продолжаются"""
+        if self.is_running and self.server_process and self.server_process.poll() is None:
+            self.server_process.send_signal(signal.SIGHUP)
+            reload_msg = "Server reload requested"
+            self.logs.append(reload_msg)
+            logging.info(reload_msg)
+            return True, reload_msg
+        return False, "Server is not running"
+            
     def _read_logs(self):
         while self.is_running:
             try:
@@ -193,6 +211,15 @@ def main(page: ft.Page):
             logging.error(f"Failed to stop server: {message}")
         page.update()
     
+    def on_reload_click(e):
+        logging.info("Reload button clicked")
+        success, message = server.reload_server()
+        if not success:
+            status_text.value = f"Server status: {message}"
+            status_text.color = Colors.RED
+            logging.error(f"Failed to reload server: {message}")
+        page.update()
+    
     # Control buttons
     start_button = ft.ElevatedButton(
         "Start Server",
@@ -206,6 +233,12 @@ def main(page: ft.Page):
         on_click=on_stop_click
     )
     
+    reload_button = ft.ElevatedButton(
+        "Reload Server",
+        icon=Icons.REFRESH_ROUNDED,
+        on_click=on_reload_click
+    )
+    
     # Log display
     log_display = ft.ListView(
         expand=1,
@@ -251,7 +284,7 @@ def main(page: ft.Page):
     )
     
     controls_row = ft.Row(
-        controls=[start_button, stop_button, web_button, status_text],
+        controls=[start_button, stop_button, reload_button, web_button, status_text],
         alignment=ft.MainAxisAlignment.CENTER,
         spacing=20
     )
@@ -0,0 +1,155 @@
+"""Проверка зеркал Кинопоиска для просмотра фильмов.
+
+Фоновый поток по расписанию одновременно опрашивает все зеркала и держит таблицу
+доступных зеркал, упорядоченную по времени ответа, поэтому лучшее зеркало
+выбирается без сетевых запросов. Зеркало, которое несколько раз подряд не ответило,
+исключается (circuit breaker) и проверяется снова только через паузу, которая
+растет с каждой новой неудачей.
+
+Пока таблица пуста (сразу после запуска), несколько зеркал опрашиваются
+одновременно и берется первое ответившее.
+"""
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+
+from http_client import HttpClient
+
+# Вес нового замера во времени ответа зеркала (экспоненциальное сглаживание)
+LATENCY_SMOOTHING = 0.3
+
+
+class MirrorMonitor:
+    def __init__(self, mirrors, probe_path='/', interval=60, timeout=2, failure_threshold=3,
+                 open_seconds=60, max_open_seconds=3600, race_candidates=3, verify=False, client=None):
+        self.mirrors = list(mirrors)
+        self.probe_path = probe_path
+        self.interval = interval
+        self.timeout = timeout
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.race_candidates = race_candidates
+
+        # Одна сессия на все проверки: соединения с зеркалами переиспользуются
+        self.session = (client or HttpClient()).session(verify=verify)
+        self.executor = ThreadPoolExecutor(max_workers=max(len(self.mirrors), 1), thread_name_prefix='mirror-probe')
+
+        self.states = {
+            mirror: {'latency': None, 'failures': 0, 'open_until': 0, 'open_seconds': 0,
+                     'status': None, 'checked_at': None}
+            for mirror in self.mirrors
+        }
+        # Доступные зеркала от быстрого к медленному; заменяется целиком, поэтому читается без блокировки
+        self.ranked = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        """Запускает фоновую проверку (повторный вызов ничего не делает)"""
+        if self.thread is not None or not self.mirrors:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='mirror-monitor', daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.probe_all()
+            except Exception as e:
+                print(f"Ошибка проверки зеркал: {str(e)}")
+            time.sleep(self.interval)
+
+    def _probe(self, mirror):
+        """Один HEAD-запрос к зеркалу: (доступно ли, время ответа в секундах, статус)"""
+        started = time.monotonic()
+        try:
+            # Проверка сама повторяется по расписанию, поэтому без повторов внутри
+            response = self.session.head(mirror + self.probe_path, timeout=self.timeout, allow_redirects=False, retries=0)
+        except requests.RequestException as e:
+            return False, None, str(e)
+        elapsed = time.monotonic() - started
+        # 200 и перенаправления считаем рабочими
+        return response.status_code < 400, elapsed, response.status_code
+
+    def _record(self, mirror, ok, latency, status):
+        now = time.time()
+        with self.lock:
+            state = self.states[mirror]
+            state['status'] = status
+            state['checked_at'] = now
+            if ok:
+                state['failures'] = 0
+                state['open_until'] = 0
+                state['open_seconds'] = 0
+                if state['latency'] is None:
+                    state['latency'] = latency
+                else:
+                    state['latency'] += LATENCY_SMOOTHING * (latency - state['latency'])
+            else:
+                # Не ответившее зеркало сразу выпадает из таблицы, но проверяется дальше,
+                # пока неудач подряд не станет failure_threshold
+                state['failures'] += 1
+                # Зеркало, не ответившее после паузы, исключается сразу и на вдвое больший срок
+                if state['failures'] >= self.failure_threshold or state['open_seconds']:
+                    state['open_seconds'] = min(max(state['open_seconds'] * 2, self.open_seconds), self.max_open_seconds)
+                    state['open_until'] = now + state['open_seconds']
+                    state['latency'] = None
+            self._rank(now)
+
+    def _rank(self, now):
+        available = [
+            (state['latency'], mirror) for mirror, state in self.states.items()
+            if state['latency'] is not None and not state['failures'] and state['open_until'] <= now
+        ]
+        self.ranked = [mirror for latency, mirror in sorted(available)]
+
+    def probe_all(self):
+        """Одновременно проверяет все зеркала, кроме исключенных, у которых пауза еще не прошла"""
+        now = time.time()
+        due = [mirror for mirror, state in self.states.items() if state['open_until'] <= now]
+        futures = {self.executor.submit(self._probe, mirror): mirror for mirror in due}
+        for future, mirror in futures.items():
+            self._record(mirror, *future.result())
+
+    def best(self):
+        """Самое быстрое доступное зеркало по последним проверкам или None"""
+        ranked = self.ranked
+        return ranked[0] if ranked else None
+
+    def race(self):
+        """Одновременно опрашивает несколько зеркал и возвращает первое ответившее (или None).
+        Используется, пока фоновая проверка еще ничего не нашла"""
+        now = time.time()
+        candidates = [mirror for mirror in self.mirrors if self.states[mirror]['open_until'] <= now]
+        random.shuffle(candidates)
+        futures = {self.executor.submit(self._probe, mirror): mirror for mirror in candidates[:self.race_candidates]}
+
+        pending = set(futures)
+        deadline = time.monotonic() + self.timeout
+        winner = None
+        while pending and winner is None:
+            done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                mirror = futures[future]
+                ok, latency, status = future.result()
+                self._record(mirror, ok, latency, status)
+                if ok and winner is None:
+                    winner = mirror
+
+        # Остальные ответы тоже попадут в таблицу, когда придут
+        for future in pending:
+            future.add_done_callback(lambda f, mirror=futures[future]: self._record(mirror, *f.result()))
+        return winner
+
+    def choose(self):
+        """Зеркало для перехода: из таблицы, а если она пуста — первое ответившее в гонке"""
+        self.start()
+        return self.best() or self.race()
@@ -0,0 +1,127 @@
+"""Разбор названий релизов: разрешение, источник, кодек, HDR, год, сезон и серия.
+
+Все признаки ищутся одним заранее скомпилированным регулярным выражением за один
+проход по названию. Размер раздачи («1.46 GB», «700 МБ») переводится в байты,
+чтобы результаты можно было сортировать и фильтровать по числам.
+"""
+import re
+
+# Токен не должен быть частью другого слова или числа: «x264-GROUP», «1080p.BluRay»,
+# «The_Matrix_1999» разбираются, а «1920x1080» или «DVD» внутри «DVDRip» — нет
+_START = r'(?<![^\W_])'
+_END = r'(?![^\W_])'
+
+RELEASE_RE = re.compile(_START + r'''(?:
+    (?P<resolution>2160p|1440p|1080[pi]|720p|576p|480p|4k|uhd)
+  | (?P<source>blu-?ray|bd-?remux|remux|bd-?rip|br-?rip|web-?dl-?rip|web-?dl|web-?rip|web|hd-?rip|hdtv(?:-?rip)?|dvd-?rip|dvd[59]?|cam-?rip|cam|ts|telesync)
+  | (?P<codec>[xh]\.?26[45]|hevc|avc|xvid|divx)
+  | (?P<hdr>hdr10\+|hdr10|hdr|dolby[ .]?vision|dv)
+  | s(?P<season>\d{1,2})(?:[ .]?e(?P<episode>\d{1,3}))?
+  | (?:season|сезон)[ .:]*(?P<season_word>\d{1,2})
+  | (?P<season_before>\d{1,2})[ .-]*(?:й[ .]+)?сезон
+  | (?:episode|серия|серии)[ .:]*(?P<episode_word>\d{1,3})
+  | (?P<year>(?:19|20)\d{2})
+)''' + _END, re.IGNORECASE | re.VERBOSE)
+
+FOUR_K_RE = re.compile(_START + r'4k' + _END, re.IGNORECASE)
+
+# Число в начале строки: «57», «1 024», «12,345»; «1.2k» читается как 1
+COUNT_RE = re.compile(r'\s*(\d{1,3}(?:[ ,\u00a0\u202f]\d{3})+(?!\d)|\d+)')
+
+SIZE_RE = re.compile(r'(\d+(?:[.,]\d+)?)\s*(bytes?|байт|[kmgt]i?b|[кмгт]б|b)' + _END, re.IGNORECASE)
+
+# Для сортировки разрешение хранится числом строк
+RESOLUTIONS = {'2160p': 2160, '4k': 2160, 'uhd': 2160, '1440p': 1440, '1080p': 1080, '1080i': 1080,
+               '720p': 720, '576p': 576, '480p': 480}
+
+SOURCES = {
+    'bluray': 'BluRay', 'bdremux': 'Remux', 'remux': 'Remux', 'bdrip': 'BDRip', 'brrip': 'BDRip',
+    'webdlrip': 'WEBRip', 'webdl': 'WEB-DL', 'web': 'WEB-DL', 'webrip': 'WEBRip', 'hdrip': 'HDRip', 'hdtv': 'HDTV', 'hdtvrip': 'HDTV',
+    'dvdrip': 'DVDRip', 'dvd': 'DVD', 'dvd5': 'DVD', 'dvd9': 'DVD', 'camrip': 'CAM', 'cam': 'CAM',
+    'ts': 'TS', 'telesync': 'TS',
+}
+
+CODECS = {'x264': 'H.264', 'h264': 'H.264', 'avc': 'H.264', 'x265': 'H.265', 'h265': 'H.265',
+          'hevc': 'H.265', 'xvid': 'XviD', 'divx': 'DivX'}
+
+HDR_FORMATS = {'hdr10+': 'HDR10+', 'hdr10': 'HDR10', 'hdr': 'HDR', 'dolbyvision': 'Dolby Vision', 'dv': 'Dolby Vision'}
+
+SIZE_UNITS = {'b': 1, 'byte': 1, 'bytes': 1, 'байт': 1, 'б': 1,
+              'k': 1024, 'к': 1024, 'm': 1024 ** 2, 'м': 1024 ** 2,
+              'g': 1024 ** 3, 'г': 1024 ** 3, 't': 1024 ** 4, 'т': 1024 ** 4}
+
+
+def _token(value):
+    return value.lower().replace('-', '').replace('.', '').replace(' ', '')
+
+
+def parse_release(name):
+    """Признаки релиза по названию. Если признак встречается несколько раз, берется первый,
+    годы собираются все (в названии бывает диапазон или год оригинала)"""
+    release = {'resolution': None, 'source': None, 'codec': None, 'hdr': None,
+               'year': None, 'years': [], 'season': None, 'episode': None}
+
+    for match in RELEASE_RE.finditer(name):
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'year':
+            release['years'].append(int(value))
+        elif kind == 'resolution':
+            release['resolution'] = release['resolution'] or RESOLUTIONS[value.lower()]
+        elif kind == 'source':
+            release['source'] = release['source'] or SOURCES[_token(value)]
+        elif kind == 'codec':
+            release['codec'] = release['codec'] or CODECS[_token(value)]
+        elif kind == 'hdr':
+            release['hdr'] = release['hdr'] or HDR_FORMATS[_token(value)]
+        elif kind in ('season', 'episode'):
+            # S01E02: lastgroup — последняя совпавшая группа, сезон есть всегда
+            release['season'] = release['season'] or int(match.group('season'))
+            if match.group('episode') and release['episode'] is None:
+                release['episode'] = int(match.group('episode'))
+        elif kind in ('season_word', 'season_before'):
+            release['season'] = release['season'] or int(value)
+        elif kind == 'episode_word':
+            release['episode'] = release['episode'] or int(value)
+
+    if release['years']:
+        release['year'] = release['years'][0]
+    return release
+
+
+def quality_label(release, name=''):
+    """Краткое качество для отображения: разрешение, а без него источник.
+    Релизы с меткой 4K в названии показываются как «4K», как раньше"""
+    if release['resolution'] == 2160 and FOUR_K_RE.search(name):
+        return '4K'
+    if release['resolution']:
+        return f"{release['resolution']}p"
+    return release['source'] or 'Unknown'
+
+
+def year_mismatch(release, year):
+    """В названии указан год, и это не год фильма"""
+    return bool(year) and bool(release['years']) and int(year) not in release['years']
+
+
+def parse_size(text):
+    """Размер в байтах из строки вида «1.46 GB» или «700 МБ» (None, если размера нет)"""
+    if isinstance(text, (int, float)):
+        return int(text)
+    match = SIZE_RE.search(text or '')
+    if not match:
+        return None
+    unit = match.group(2).lower()
+    multiplier = SIZE_UNITS.get(unit) or SIZE_UNITS[unit[0]]
+    return int(float(match.group(1).replace(',', '.')) * multiplier)
+
+
+def parse_count(value):
+    """Число сидов или личей: трекеры отдают и числа, и строки («1 024», «—»).
+    Из строки берется число в начале, пробелы и запятые между разрядами допускаются"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = COUNT_RE.match(str(value or ''))
+    if not match:
+        return 0
+    return int(re.sub(r'\D', '', match.group(1)))
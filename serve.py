@@ -0,0 +1,106 @@
+"""Рабочий запуск сервера: менеджер торрент-загрузок отдельным процессом и gunicorn
+(настройки в gunicorn.conf.py).
+
+Рабочих процессов gunicorn несколько, а сессия libtorrent должна быть одна, поэтому
+менеджер запускается здесь, а путь к его сокету передается рабочим процессам через
+TORRENT_MANAGER_SOCKET.
+
+Сигналы: SIGTERM/SIGINT — плавная остановка (сначала веб-сервер дожидается идущих
+запросов, затем менеджер сохраняет resume data), SIGHUP — плавный перезапуск рабочих
+процессов gunicorn с новым кодом и настройками, загрузки при этом не прерываются.
+"""
+import os
+import runpy
+import signal
+import stat
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Сколько секунд ждать, пока менеджер загрузок откроет сокет
+MANAGER_START_TIMEOUT = 30
+# Сколько секунд менеджеру дается на сохранение resume data при остановке
+MANAGER_STOP_TIMEOUT = 30
+
+
+def load_config():
+    config_path = os.path.join(BASE_DIR, 'config.py')
+    return runpy.run_path(config_path) if os.path.exists(config_path) else {}
+
+
+def manager_socket_path(config):
+    # Тот же путь по умолчанию, что и у server.serve_torrent_manager()
+    db_path = config.get('DB_PATH', '/var/lib/walpserver/users.db')
+    return (os.environ.get('TORRENT_MANAGER_SOCKET') or config.get('TORRENT_MANAGER_SOCKET')
+            or os.path.join(os.path.dirname(db_path), 'torrent_manager.sock'))
+
+
+def is_socket(path):
+    try:
+        return stat.S_ISSOCK(os.stat(path).st_mode)
+    except FileNotFoundError:
+        return False
+
+
+def wait_for_socket(path, process):
+    deadline = time.time() + MANAGER_START_TIMEOUT
+    while time.time() < deadline:
+        if process.poll() is not None:
+            return False
+        if is_socket(path):
+            return True
+        time.sleep(0.2)
+    return False
+
+
+def stop_process(process, timeout):
+    if process.poll() is not None:
+        return
+    process.terminate()
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        print(f"Процесс {process.pid} не завершился за {timeout} с, принудительная остановка")
+        process.kill()
+        process.wait()
+
+
+def main():
+    config = load_config()
+    socket_path = manager_socket_path(config)
+    env = dict(os.environ, TORRENT_MANAGER_SOCKET=socket_path)
+
+    # Сокет от прошлого запуска не должен сойти за готовность нового менеджера
+    if is_socket(socket_path):
+        os.unlink(socket_path)
+
+    manager = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'torrent_manager.py')], cwd=BASE_DIR, env=env)
+    if not wait_for_socket(socket_path, manager):
+        print("Менеджер торрент-загрузок не запустился")
+        stop_process(manager, MANAGER_STOP_TIMEOUT)
+        return 1
+
+    web = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', os.path.join(BASE_DIR, 'gunicorn.conf.py')],
+                           cwd=BASE_DIR, env=env)
+    print(f"Сервер запущен: gunicorn {web.pid}, менеджер загрузок {manager.pid}")
+
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGINT, lambda signum, frame: stopping.append(signum))
+    signal.signal(signal.SIGHUP, lambda signum, frame: web.send_signal(signal.SIGHUP))
+
+    while not stopping and web.poll() is None and manager.poll() is None:
+        time.sleep(1)
+
+    if not stopping:
+        print("Один из процессов сервера завершился, остановка")
+
+    stop_process(web, config.get('SERVER_GRACEFUL_TIMEOUT', 30) + 5)
+    stop_process(manager, MANAGER_STOP_TIMEOUT)
+    return 0 if stopping else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,26 +1,53 @@
-from flask import Flask, render_template, request, redirect, url_for, send_from_directory, jsonify, Response, send_file
+from flask import Flask, render_template, request, redirect, url_for, jsonify, Response, g
 from flask_login import LoginManager, UserMixin, login_required, login_user, logout_user, current_user
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
+from werkzeug import http
 from flask_cors import CORS
 from functools import wraps
 import jwt
 import os
+import html
+import base64
+import hashlib
+import gzip
+import unicodedata
+import heapq
+import itertools
 import sqlite3
 import json
 from datetime import datetime, timedelta
 import uuid
 import mimetypes
-import requests
-from bs4 import BeautifulSoup
+from lxml import etree
 import re
 import random
 import urllib.parse
 import string
-import asyncio
 import threading
 import time
-from torrentp import TorrentDownloader
+import atexit
+import signal
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait
+import trackers
+from cache import TTLCache, CachedFailure, UncacheableError, normalize_key
+from torrent_manager import TorrentManager, TorrentManagerClient, TorrentManagerServer, TorrentManagerError, FINISHED_STATUSES
+from bandwidth import BandwidthScheduler, HttpActivity, PRIORITY_WEIGHTS
+from mirrors import MirrorMonitor
+from http_client import HttpClient
+
+try:
+    from PIL import Image, ImageOps, features
+except ImportError:
+    # Без Pillow миниатюры изображений не строятся, вместо них отдается оригинал
+    Image = None
+try:
+    import brotli
+except ImportError:
+    # Без модуля brotli ответы сжимаются только gzip
+    brotli = None
 
 """
 API Документация
@@ -32,7 +59,14 @@ API Документация
 
 - POST /api/auth/login - Авторизация пользователя
   Тело запроса: {"username": "user", "password": "password"}
-  Ответ: {"message": "Авторизация успешна", "token": "JWT_TOKEN", "user_id": 1, "username": "user"}
+  Ответ: {"message": "Авторизация успешна", "token": "JWT_TOKEN", "refresh_token": "REFRESH_TOKEN", "user_id": 1, "username": "user"}
+
+- POST /api/auth/refresh - Новая пара токенов без повторного ввода пароля (refresh-токен одноразовый)
+  Тело запроса: {"refresh_token": "REFRESH_TOKEN"}
+  Ответ: {"token": "JWT_TOKEN", "refresh_token": "REFRESH_TOKEN"}
+
+- POST /api/auth/logout - Отзыв refresh-токена
+  Тело запроса: {"refresh_token": "REFRESH_TOKEN"}
 
 - GET /api/users/me - Получение информации о текущем пользователе
   Заголовки: Authorization: Bearer JWT_TOKEN
@@ -40,9 +74,10 @@ API Документация
 
 Файлы:
 - GET /api/files - Получение списка файлов
-  Параметры запроса: category=all|images|videos|..., sort=date|name|size, order=asc|desc
+  Параметры запроса: category=all|images|videos|..., sort=date|name|size, order=asc|desc,
+  limit=<размер страницы>, cursor=<next_cursor предыдущей страницы>, fields=id,filename,size,...
   Заголовки: Authorization: Bearer JWT_TOKEN
-  Ответ: {"files": [{"id": 1, "filename": "file.txt", ...}]}
+  Ответ: {"files": [{"id": 1, "filename": "file.txt", ...}], "next_cursor": "..." | null}
 
 - GET /api/files/<file_id> - Получение информации о файле
   Заголовки: Authorization: Bearer JWT_TOKEN
@@ -53,6 +88,28 @@ API Документация
   Форма: file=<file>, path=<path>, torrent_category=<category> (опционально)
   Ответ: {"message": "Файл успешно загружен", "file_id": 1, ...}
 
+- POST /api/files/upload/check - Проверка, есть ли уже у пользователя файл с таким содержимым
+  Заголовки: Authorization: Bearer JWT_TOKEN
+  Тело запроса: {"sha256": "<hex>", "size": 1024, "filename": "photo.jpg", "path": ""}
+  Ответ: {"exists": true, "file_id": 1, ...} — файл добавлен без загрузки; {"exists": false} — нужно загружать
+
+- POST /api/files/upload/sessions - Начало возобновляемой загрузки по частям
+  Заголовки: Authorization: Bearer JWT_TOKEN
+  Тело запроса: {"filename": "video.mkv", "size": 21474836480, "chunk_size": 8388608, "path": "", "torrent_category": "other"}
+  Ответ: {"upload_id": "...", "chunk_size": 8388608, "chunk_count": 2560, "received_chunks": [], "offset": 0, ...}
+
+- GET /api/files/upload/sessions/<upload_id> - Состояние загрузки (какие части уже приняты)
+
+- PUT /api/files/upload/sessions/<upload_id>/chunks/<index> - Отправка части (части можно слать параллельно)
+  Заголовки: Authorization: Bearer JWT_TOKEN, Upload-Checksum: sha256 <base64> (опционально)
+  Тело запроса: байты части
+  Ответ: состояние загрузки; 460 при несовпадении контрольной суммы
+
+- POST /api/files/upload/sessions/<upload_id>/finalize - Завершение загрузки после получения всех частей
+  Ответ: {"message": "Файл успешно загружен", "file_id": 1, ...}
+
+- DELETE /api/files/upload/sessions/<upload_id> - Отмена загрузки
+
 - GET /api/files/<file_id>/download - Скачивание файла
   Заголовки: Authorization: Bearer JWT_TOKEN
   Ответ: Файл для скачивания
@@ -121,6 +178,12 @@ API Документация
   Заголовки: Authorization: Bearer JWT_TOKEN
   Ответ: {"message": "Фильм успешно удален"}
 
+Поиск:
+- GET /api/search - Полнотекстовый поиск по файлам, ссылкам, заметкам и фильмам
+  Параметры запроса: q=<запрос>, types=file,link,note,movie, page=1, per_page=50
+  Заголовки: Authorization: Bearer JWT_TOKEN
+  Ответ: {"results": [{"type": "file", "id": 1, "snippet": "...<mark>...</mark>...", "score": 1.5, ...}], "page": 1, "per_page": 50, "has_more": false}
+
 Статистика:
 - GET /api/stats - Получение статистики
   Заголовки: Authorization: Bearer JWT_TOKEN
@@ -133,9 +196,10 @@ app.config.from_pyfile('config.py')
 # Настройка CORS
 CORS(app)
 
-# Секретный ключ для JWT токенов
-app.config['JWT_SECRET_KEY'] = 'secret-key-for-jwt'  # В реальном приложении используйте безопасный секретный ключ
-app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=1)  # Время жизни токена
+# Ключ подписи JWT задается в config.py; без него используется SECRET_KEY
+app.config.setdefault('JWT_SECRET_KEY', app.config['SECRET_KEY'])
+app.config.setdefault('JWT_ACCESS_TOKEN_EXPIRES', timedelta(hours=1))  # Время жизни токена доступа
+app.config.setdefault('JWT_REFRESH_TOKEN_EXPIRES', timedelta(days=30))  # Время жизни refresh-токена
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -145,13 +209,85 @@ login_manager.login_view = 'login'
 for category in ['images', 'videos', 'documents', 'other', 'links', 'audio', 'scripts', 'archives', 'code', 'executables', 'databases', 'torrents']:
     os.makedirs(os.path.join(app.config['UPLOAD_FOLDER'], category), exist_ok=True)
 
-DB_PATH = "/var/lib/walpserver/users.db"
+DB_PATH = app.config.get('DB_PATH', "/var/lib/walpserver/users.db")
+
+# Кэш ответов внешних сервисов (трекеры, Кинопоиск). Сроки жизни в секундах, см. cache.py
+CACHE_POLICIES = {
+    'kinopoisk_search': {'ttl': 6 * 3600, 'stale_ttl': 24 * 3600, 'negative_ttl': 60},
+    'kinopoisk_film': {'ttl': 7 * 24 * 3600, 'stale_ttl': 30 * 24 * 3600, 'negative_ttl': 120},
+    'tracker': {'ttl': 15 * 60, 'stale_ttl': 60 * 60, 'negative_ttl': 120},
+}
+for namespace, policy in app.config.get('CACHE_POLICIES', {}).items():
+    CACHE_POLICIES[namespace] = {**CACHE_POLICIES.get(namespace, {}), **policy}
+
+result_cache = TTLCache(
+    max_entries=app.config.get('CACHE_MAX_ENTRIES', 2048),
+    db_path=app.config.get('CACHE_DB_PATH'),  # None — только кэш в памяти
+    policies=CACHE_POLICIES
+)
+
+# Общий клиент для запросов к внешним сервисам (см. http_client.py)
+http_client = HttpClient(
+    connect_timeout=app.config.get('HTTP_CONNECT_TIMEOUT', 5),
+    read_timeout=app.config.get('HTTP_READ_TIMEOUT', 15),
+    retries=app.config.get('HTTP_RETRIES', 2),
+    host_limit=app.config.get('HTTP_HOST_LIMIT', 8)
+)
 os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
 
-# Настройка базы данных пользователей
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
+# Пул соединений SQLite: у каждого потока свое соединение, которое живет
+# между запросами, а не открывается и закрывается в каждом обработчике
+_db_local = threading.local()
+
+def _open_db_connection():
+    """Открывает соединение с БД и применяет к нему настройки производительности"""
+    timeout = app.config.get('SQLITE_BUSY_TIMEOUT', 30)
+
+    # Общий кэш страниц для всех соединений процесса (по умолчанию выключен:
+    # в shared-cache режиме SQLite блокирует таблицы целиком)
+    if app.config.get('SQLITE_SHARED_CACHE', False):
+        conn = sqlite3.connect(f"file:{DB_PATH}?cache=shared", uri=True, timeout=timeout)
+    else:
+        conn = sqlite3.connect(DB_PATH, timeout=timeout)
+
+    if app.config.get('SQLITE_WAL_MODE', True):
+        # В режиме WAL читатели не блокируются писателем, а fsync
+        # выполняется только на чекпоинтах
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={int(app.config.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))}")
+        conn.execute(f"PRAGMA cache_size=-{int(app.config.get('SQLITE_CACHE_SIZE_KB', 16 * 1024))}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+
+    return conn
+
+def get_db():
+    """Возвращает соединение с БД текущего потока, создавая его при первом обращении"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is None:
+        conn = _open_db_connection()
+        _db_local.conn = conn
+    return conn
+
+def close_db():
+    """Закрывает соединение текущего потока (для фоновых потоков перед завершением)"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None:
+        _db_local.conn = None
+        conn.close()
+
+@app.teardown_appcontext
+def release_db(exception=None):
+    """Возвращает соединение в пул после запроса: незавершенная транзакция откатывается,
+    чтобы не удерживать блокировку записи до следующего запроса этого потока"""
+    conn = getattr(_db_local, 'conn', None)
+    if conn is not None and conn.in_transaction:
+        conn.rollback()
+
+# Миграции схемы базы данных пользователей.
+# Номер последней примененной миграции хранится в PRAGMA user_version,
+# каждая миграция выполняется в отдельной транзакции ровно один раз
+def migration_initial_schema(c):
+    """Базовые таблицы приложения"""
     c.execute('''
     CREATE TABLE IF NOT EXISTS users
     (id INTEGER PRIMARY KEY, username TEXT UNIQUE, password TEXT)
@@ -219,20 +355,339 @@ def init_db():
             ('other', 'Другое')
         ]
         c.executemany("INSERT INTO torrent_categories (name, description) VALUES (?, ?)", categories)
-    
-    # Проверяем, есть ли колонка torrent_category в таблице files
+
+def migration_torrent_category(c):
+    """Колонка torrent_category в таблице files"""
+    # В базах, созданных до появления миграций, колонка уже может существовать
     c.execute("PRAGMA table_info(files)")
     columns = [column[1] for column in c.fetchall()]
     
     if 'torrent_category' not in columns:
         c.execute("ALTER TABLE files ADD COLUMN torrent_category TEXT")
+
+def migration_indexes(c):
+    """Индексы под фильтрацию по пользователю и сортировки списков"""
+    # Списки файлов: фильтр по user_id (и category) с сортировкой по дате, имени или размеру
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_user_date ON files(user_id, upload_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_user_name ON files(user_id, original_filename)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_user_size ON files(user_id, size)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_user_category_date ON files(user_id, category, upload_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_user_category_size ON files(user_id, category, size)")
+    
+    # /download и /preview ищут файл по имени на диске
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_filename_user ON files(filename, user_id)")
+    
+    c.execute("CREATE INDEX IF NOT EXISTS idx_links_user_date ON links(user_id, add_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_notes_user_priority ON notes(user_id, priority, create_date)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_movies_user_kinopoisk ON movies(user_id, kinopoisk_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_movies_user_date ON movies(user_id, add_date)")
+    
+    # share_links(token) уже покрыт индексом ограничения UNIQUE,
+    # а выборки ссылок пользователя соединяются с files по file_id
+    c.execute("CREATE INDEX IF NOT EXISTS idx_share_links_file ON share_links(file_id)")
+    
+    c.execute("ANALYZE")
+
+# Коды типов записей в полнотекстовом индексе. rowid записи индекса равен
+# id * 4 + код, поэтому триггеры удаляют и обновляют записи по rowid
+SEARCH_KINDS = {'file': 0, 'link': 1, 'note': 2, 'movie': 3}
+
+def fts5_available(c):
+    """Проверяет, собран ли SQLite с модулем FTS5"""
+    try:
+        c.execute("CREATE VIRTUAL TABLE temp.fts5_probe USING fts5(x)")
+        c.execute("DROP TABLE temp.fts5_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+def migration_search_index(c):
+    """Полнотекстовый индекс FTS5 по файлам, ссылкам, заметкам и фильмам"""
+    if not fts5_available(c):
+        print("SQLite собран без FTS5, поиск будет работать через LIKE")
+        return
+
+    c.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5(
+        title, body,
+        kind UNINDEXED, item_id UNINDEXED, user_id UNINDEXED,
+        tokenize = 'unicode61 remove_diacritics 2',
+        prefix = '2 3'
+    )
+    ''')
+
+    # Для каждой таблицы: что попадает в title и body индекса
+    sources = {
+        'file': ('files', "new.original_filename", "''", "original_filename, user_id"),
+        'link': ('links', "new.title", "coalesce(new.description, '')", "title, description, user_id"),
+        'note': ('notes', "new.title", "coalesce(new.content, '')", "title, content, user_id"),
+        'movie': ('movies', "coalesce(new.title, '') || ' ' || coalesce(new.original_title, '')",
+                  "coalesce(new.description, '')", "title, original_title, description, user_id"),
+    }
+
+    for kind, (table, title_expr, body_expr, indexed_columns) in sources.items():
+        code = SEARCH_KINDS[kind]
+        insert_sql = f'''
+            INSERT INTO search_index (rowid, title, body, kind, item_id, user_id)
+            VALUES (new.id * 4 + {code}, {title_expr}, {body_expr}, '{kind}', new.id, new.user_id);
+        '''
+        delete_sql = f"DELETE FROM search_index WHERE rowid = old.id * 4 + {code};"
+
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN {insert_sql} END")
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN {delete_sql} END")
+        c.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE OF {indexed_columns} ON {table} BEGIN {delete_sql} {insert_sql} END")
+
+        # Индексируем уже существующие записи
+        backfill_title = title_expr.replace('new.', '')
+        backfill_body = body_expr.replace('new.', '')
+        c.execute(f'''
+        INSERT INTO search_index (rowid, title, body, kind, item_id, user_id)
+        SELECT id * 4 + {code}, {backfill_title}, {backfill_body}, '{kind}', id, user_id FROM {table}
+        ''')
+
+def migration_list_name_indexes(c):
+    """Индексы для постраничной сортировки по имени без учета регистра"""
+    c.execute("DROP INDEX IF EXISTS idx_files_user_name")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_user_name ON files(user_id, original_filename COLLATE NOCASE)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_user_category_name ON files(user_id, category, original_filename COLLATE NOCASE)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_links_user_title ON links(user_id, title COLLATE NOCASE)")
+
+def migration_upload_sessions(c):
+    """Таблицы для возобновляемой загрузки файлов по частям"""
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS upload_sessions (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        filename TEXT NOT NULL,
+        original_filename TEXT NOT NULL,
+        category TEXT NOT NULL,
+        torrent_category TEXT,
+        size INTEGER NOT NULL,
+        chunk_size INTEGER NOT NULL,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS upload_chunks (
+        session_id TEXT NOT NULL,
+        chunk_index INTEGER NOT NULL,
+        checksum TEXT,
+        PRIMARY KEY (session_id, chunk_index)
+    ) WITHOUT ROWID
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_upload_sessions_updated ON upload_sessions(updated_at)")
+
+def migration_blob_storage(c):
+    """Учет блоков содержимого (content-addressed storage) и ссылок на них из files"""
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS blobs (
+        digest TEXT PRIMARY KEY,
+        size INTEGER NOT NULL,
+        refcount INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    ''')
+    c.execute("ALTER TABLE files ADD COLUMN blob_digest TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_files_user_blob ON files(user_id, blob_digest)")
     
-    conn.commit()
-    conn.close()
+    # Счетчик ссылок поддерживается триггерами, поэтому верен при любом способе удаления файлов
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS files_blob_ai AFTER INSERT ON files WHEN new.blob_digest IS NOT NULL BEGIN
+        UPDATE blobs SET refcount = refcount + 1 WHERE digest = new.blob_digest;
+    END
+    ''')
+    c.execute('''
+    CREATE TRIGGER IF NOT EXISTS files_blob_ad AFTER DELETE ON files WHEN old.blob_digest IS NOT NULL BEGIN
+        UPDATE blobs SET refcount = refcount - 1 WHERE digest = old.blob_digest;
+    END
+    ''')
+
+def migration_torrent_jobs(c):
+    """Задания менеджера торрент-загрузок (torrent_manager.py)"""
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS torrent_jobs (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        file_id INTEGER NOT NULL,
+        torrent_path TEXT NOT NULL,
+        download_dir TEXT NOT NULL,
+        info_hash TEXT NOT NULL,
+        name TEXT,
+        status TEXT NOT NULL,
+        progress REAL NOT NULL DEFAULT 0,
+        downloaded INTEGER NOT NULL DEFAULT 0,
+        total_size INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        target_category TEXT,
+        target_filename TEXT,
+        resume_data BLOB,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_torrent_jobs_status ON torrent_jobs(status, created_at)")
+
+def migration_torrent_history(c):
+    """История завершенных торрент-загрузок: в torrent_jobs остаются только текущие задания"""
+    c.execute("ALTER TABLE torrent_jobs ADD COLUMN finished_at TEXT")
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS torrent_history (
+        id TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        file_id INTEGER NOT NULL,
+        info_hash TEXT NOT NULL,
+        name TEXT,
+        status TEXT NOT NULL,
+        progress REAL NOT NULL DEFAULT 0,
+        downloaded INTEGER NOT NULL DEFAULT 0,
+        total_size INTEGER NOT NULL DEFAULT 0,
+        error TEXT,
+        target_category TEXT,
+        target_filename TEXT,
+        created_at TEXT NOT NULL,
+        finished_at TEXT,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_torrent_history_user ON torrent_history(user_id, finished_at)")
+    
+    # Уже завершенные задания переносятся в историю при следующем запуске менеджера
+    c.execute("UPDATE torrent_jobs SET finished_at = updated_at WHERE status IN ('completed', 'error', 'stopped')")
+
+def migration_torrent_bandwidth(c):
+    """Приоритет и собственные ограничения скорости торрент-загрузок"""
+    c.execute("ALTER TABLE torrent_jobs ADD COLUMN priority TEXT NOT NULL DEFAULT 'normal'")
+    c.execute("ALTER TABLE torrent_jobs ADD COLUMN download_limit INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE torrent_jobs ADD COLUMN upload_limit INTEGER NOT NULL DEFAULT 0")
+
+def migration_torrent_streaming(c):
+    """Режим последовательной загрузки и файлы, зарегистрированные до завершения торрента (JSON)"""
+    c.execute("ALTER TABLE torrent_jobs ADD COLUMN sequential INTEGER NOT NULL DEFAULT 0")
+    c.execute("ALTER TABLE torrent_jobs ADD COLUMN imported_files TEXT")
+
+def migration_refresh_tokens(c):
+    """Выданные refresh-токены API (по jti), чтобы их можно было отозвать"""
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS refresh_tokens (
+        jti TEXT PRIMARY KEY,
+        user_id INTEGER NOT NULL,
+        expires_at TEXT NOT NULL,
+        revoked INTEGER NOT NULL DEFAULT 0,
+        created_at TEXT NOT NULL,
+        FOREIGN KEY (user_id) REFERENCES users (id)
+    )
+    ''')
+    c.execute("CREATE INDEX IF NOT EXISTS idx_refresh_tokens_user ON refresh_tokens(user_id)")
+
+# Счетчики user_stats: таблица -> [(имя, ключ, размер, условие, колонки для UPDATE OF)].
+# {row} в выражениях заменяется на new/old в триггерах и на имя таблицы при заполнении
+USER_STATS_SOURCES = {
+    'files': [('files', "'file:' || {row}.category", "coalesce({row}.size, 0)", "1", "category, size, user_id")],
+    'notes': [('notes', "'notes'", "0", "1", "user_id")],
+    'links': [('links', "'links'", "0", "1", "user_id")],
+    'movies': [('movies', "'movies'", "0", "1", "user_id"),
+               ('watched', "'movies_watched'", "0", "{row}.watched = 1", "watched, user_id")],
+}
+
+def migration_user_stats(c):
+    """Статистика пользователя одной строкой на счетчик, которую поддерживают триггеры:
+    /stats читает ее одним запросом по первичному ключу вместо агрегатов по всем таблицам"""
+    c.execute('''
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id INTEGER NOT NULL,
+        key TEXT NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        size INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, key)
+    ) WITHOUT ROWID
+    ''')
+
+    for table, counters in USER_STATS_SOURCES.items():
+        for name, key, size, condition, columns in counters:
+            def add(row):
+                return f'''
+                INSERT INTO user_stats (user_id, key, count, size)
+                SELECT {row}.user_id, {key.format(row=row)}, 1, {size.format(row=row)} WHERE {condition.format(row=row)}
+                ON CONFLICT (user_id, key) DO UPDATE SET count = count + excluded.count, size = size + excluded.size;
+                '''
+
+            def subtract(row):
+                return f'''
+                UPDATE user_stats SET count = count - 1, size = size - {size.format(row=row)}
+                WHERE user_id = {row}.user_id AND key = {key.format(row=row)} AND {condition.format(row=row)};
+                '''
+
+            c.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_stats_{name}_insert AFTER INSERT ON {table} BEGIN {add('new')} END")
+            c.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_stats_{name}_delete AFTER DELETE ON {table} BEGIN {subtract('old')} END")
+            c.execute(f"CREATE TRIGGER IF NOT EXISTS {table}_stats_{name}_update AFTER UPDATE OF {columns} ON {table} "
+                      f"BEGIN {subtract('old')} {add('new')} END")
+
+            # Заполняем по уже существующим записям
+            c.execute(f'''
+            INSERT INTO user_stats (user_id, key, count, size)
+            SELECT user_id, {key.format(row=table)}, COUNT(*), SUM({size.format(row=table)})
+            FROM {table} WHERE user_id IS NOT NULL AND {condition.format(row=table)}
+            GROUP BY user_id, {key.format(row=table)}
+            ''')
+
+MIGRATIONS = [
+    (1, 'Базовая схема', migration_initial_schema),
+    (2, 'Колонка torrent_category', migration_torrent_category),
+    (3, 'Индексы для списков и поиска файлов', migration_indexes),
+    (4, 'Полнотекстовый поиск', migration_search_index),
+    (5, 'Индексы для сортировки по имени', migration_list_name_indexes),
+    (6, 'Сессии загрузки по частям', migration_upload_sessions),
+    (7, 'Хранилище по хешу содержимого', migration_blob_storage),
+    (8, 'Задания менеджера торрент-загрузок', migration_torrent_jobs),
+    (9, 'История торрент-загрузок', migration_torrent_history),
+    (10, 'Приоритеты и ограничения скорости торрент-загрузок', migration_torrent_bandwidth),
+    (11, 'Последовательная загрузка и готовые файлы торрентов', migration_torrent_streaming),
+    (12, 'Refresh-токены API', migration_refresh_tokens),
+    (13, 'Сводная статистика пользователей', migration_user_stats),
+]
+
+def get_schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def run_migrations(conn):
+    """Применяет к БД все миграции, которые еще не были применены"""
+    for version, description, migrate in MIGRATIONS:
+        # BEGIN IMMEDIATE сразу берет блокировку записи: если несколько процессов
+        # стартуют одновременно, миграцию выполнит только первый из них
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            
+            print(f"Применение миграции БД {version}: {description}")
+            migrate(conn.cursor())
+            conn.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+# Настройка базы данных пользователей
+def init_db():
+    conn = get_db()
+
+    # Режим журнала WAL сохраняется в самом файле БД, поэтому включаем его один раз
+    if app.config.get('SQLITE_WAL_MODE', True):
+        conn.execute("PRAGMA journal_mode=WAL")
+
+    run_migrations(conn)
 
 # Инициализация базы данных при запуске
 init_db()
 
+# Полнотекстовый поиск доступен, если миграция смогла создать индекс FTS5
+SEARCH_INDEX_ENABLED = get_db().execute(
+    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'search_index'"
+).fetchone() is not None
+
 # Класс пользователя для Flask-Login
 class User(UserMixin):
     def __init__(self, id, username, password):
@@ -240,28 +695,78 @@ class User(UserMixin):
         self.username = username
         self.password = password
 
+# Записи пользователей для token_required и load_user без запроса к БД на каждый вызов.
+# Пользователи только добавляются, поэтому срок жизни ограничивает лишь то, как долго
+# другой рабочий процесс может не видеть изменение
+user_cache = TTLCache(
+    max_entries=app.config.get('USER_CACHE_SIZE', 1024),
+    policies={'user': {'ttl': app.config.get('USER_CACHE_TTL', 300), 'negative_ttl': 5}}
+)
+
+def get_user(user_id):
+    """Пользователь по id (из кэша) или None"""
+    def load():
+        try:
+            row = get_db().execute("SELECT id, username, password FROM users WHERE id = ?", (user_id,)).fetchone()
+        except sqlite3.Error as e:
+            raise UncacheableError(str(e))
+        return list(row) if row else None
+    
+    row = user_cache.get_or_load('user', normalize_key(user_id), load, is_negative=lambda value: value is None)
+    return User(*row) if row else None
+
+def invalidate_user(user_id):
+    """Вызывается после любого изменения записи пользователя"""
+    user_cache.invalidate('user', normalize_key(user_id))
+
+# Для GET-запросов API достаточно проверенной подписи токена: пользователь берется
+# из его claims без обращения к БД и кэшу
+JWT_TRUST_CLAIMS = app.config.get('JWT_TRUST_CLAIMS', True)
+READ_ONLY_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
 # Функция для создания JWT токена
-def create_token(user_id):
+def create_token(user_id, username=None):
     payload = {
         'exp': datetime.utcnow() + app.config['JWT_ACCESS_TOKEN_EXPIRES'],
         'iat': datetime.utcnow(),
-        'sub': user_id
+        'sub': user_id,
+        'type': 'access'
     }
+    if username is not None:
+        payload['username'] = username
     return jwt.encode(
         payload,
         app.config['JWT_SECRET_KEY'],
         algorithm='HS256'
     )
 
+def create_refresh_token(c, user_id):
+    """Новый refresh-токен; его jti хранится в refresh_tokens, чтобы токен можно было отозвать"""
+    jti = uuid.uuid4().hex
+    now = datetime.utcnow()
+    expires_at = now + app.config['JWT_REFRESH_TOKEN_EXPIRES']
+    c.execute("INSERT INTO refresh_tokens (jti, user_id, expires_at, created_at) VALUES (?, ?, ?, ?)",
+             (jti, user_id, expires_at.isoformat(), now.isoformat()))
+    return jwt.encode(
+        {'exp': expires_at, 'iat': now, 'sub': user_id, 'type': 'refresh', 'jti': jti},
+        app.config['JWT_SECRET_KEY'],
+        algorithm='HS256'
+    )
+
 # Функция для проверки JWT токена
-def decode_token(token):
+def decode_token(token, token_type='access'):
+    """Claims проверенного токена или строка с ошибкой.
+    Токены без поля type выпущены до появления refresh-токенов и считаются токенами доступа"""
     try:
         payload = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=['HS256'])
-        return payload['sub']
     except jwt.ExpiredSignatureError:
         return 'Token истек. Пожалуйста, войдите снова.'
     except jwt.InvalidTokenError:
         return 'Недействительный токен. Пожалуйста, войдите снова.'
+    
+    if payload.get('type', 'access') != token_type:
+        return 'Недействительный токен. Пожалуйста, войдите снова.'
+    return payload
 
 # Декоратор для проверки JWT токена в запросах API
 def token_required(f):
@@ -277,34 +782,25 @@ def token_required(f):
         if not token:
             return jsonify({'message': 'Токен отсутствует!'}), 401
         
-        user_id = decode_token(token)
-        if isinstance(user_id, str):
-            return jsonify({'message': user_id}), 401
+        claims = decode_token(token)
+        if isinstance(claims, str):
+            return jsonify({'message': claims}), 401
         
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-        user = c.fetchone()
-        conn.close()
+        if JWT_TRUST_CLAIMS and request.method in READ_ONLY_METHODS and 'username' in claims:
+            return f(User(claims['sub'], claims['username'], None), *args, **kwargs)
         
+        user = get_user(claims['sub'])
         if not user:
             return jsonify({'message': 'Пользователь не найден!'}), 401
         
-        return f(User(user[0], user[1], user[2]), *args, **kwargs)
+        return f(user, *args, **kwargs)
     
     return decorated
 
 # Загрузчик пользователя для Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT * FROM users WHERE id = ?", (user_id,))
-    user = c.fetchone()
-    conn.close()
-    if user:
-        return User(user[0], user[1], user[2])
-    return None
+    return get_user(user_id)
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in app.config['ALLOWED_EXTENSIONS']
@@ -369,11 +865,10 @@ def login():
         username = request.form['username']
         password = request.form['password']
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
         c.execute("SELECT * FROM users WHERE username = ?", (username,))
         user = c.fetchone()
-        conn.close()
         
         if user and check_password_hash(user[2], password):
             user_obj = User(user[0], user[1], user[2])
@@ -390,18 +885,17 @@ def register():
         username = request.form['username']
         password = request.form['password']
         
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
         c.execute("SELECT * FROM users WHERE username = ?", (username,))
         if c.fetchone():
-            conn.close()
             return render_template('register.html', error='Пользователь уже существует')
         
         hashed_password = generate_password_hash(password)
         c.execute("INSERT INTO users (username, password) VALUES (?, ?)", 
                  (username, hashed_password))
         conn.commit()
-        conn.close()
+        invalidate_user(c.lastrowid)
         return redirect(url_for('login'))
     
     return render_template('register.html')
@@ -414,11 +908,10 @@ def dashboard():
 @app.route('/torrent_categories')
 @login_required
 def get_torrent_categories():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT id, name, description FROM torrent_categories ORDER BY name")
     categories = c.fetchall()
-    conn.close()
     
     categories_list = []
     for category in categories:
@@ -430,6 +923,494 @@ def get_torrent_categories():
     
     return jsonify({'categories': categories_list})
 
+def upload_path_parts(path):
+    """Части относительного пути папки. Имена папок сохраняются как есть (в том числе
+    кириллица), отбрасываются только пустые части, «.», «..» и части с нулевым байтом,
+    поэтому выйти за пределы категории нельзя"""
+    parts = []
+    for part in path.replace('\\', '/').split('/'):
+        part = part.strip()
+        if part in ('', '.', '..') or '\0' in part:
+            continue
+        parts.append(part)
+    return parts
+
+def prepare_upload_target(filename, category, path=''):
+    """Имя для записи в БД и полный путь для нового файла в хранилище.
+    path — относительная папка внутри категории (при загрузке папок)"""
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    new_filename = f"{timestamp}_{filename}"
+    
+    path = '/'.join(upload_path_parts(path))
+    
+    if path:
+        # Создаем подпапку с учетом пути
+        folder_path = os.path.join(app.config['UPLOAD_FOLDER'], category, path)
+        os.makedirs(folder_path, exist_ok=True)
+        return os.path.join(path, new_filename), os.path.join(folder_path, new_filename)
+    
+    return new_filename, os.path.join(app.config['UPLOAD_FOLDER'], category, new_filename)
+
+# Сколько имен с суффиксом пробуется, если файл с таким именем уже есть
+UPLOAD_NAME_ATTEMPTS = 100
+
+def create_upload_target(stored_name, file_path, create):
+    """Создает новый файл функцией create(путь), которая не должна перезаписывать существующий
+    файл (открытие в режиме 'x', os.link) и бросает FileExistsError. Если имя занято (две загрузки
+    одного файла в одну секунду, повтор запроса клиентом), к имени добавляется суффикс _1, _2, ...
+    Возвращает (имя для БД, путь, результат create)"""
+    base_name, extension = os.path.splitext(stored_name)
+    base_path = file_path[:len(file_path) - len(extension)] if extension else file_path
+    for attempt in range(UPLOAD_NAME_ATTEMPTS):
+        if attempt:
+            stored_name = f"{base_name}_{attempt}{extension}"
+            file_path = f"{base_path}_{attempt}{extension}"
+        try:
+            return stored_name, file_path, create(file_path)
+        except FileExistsError:
+            continue
+    raise FileExistsError(f"Не удалось подобрать свободное имя для {file_path}")
+
+def save_file_record(c, stored_name, filename, category, size, user_id, torrent_category=None, blob_digest=None):
+    """Добавляет файл в таблицу files и возвращает его id"""
+    if category == 'torrents':
+        c.execute("""
+        INSERT INTO files (filename, original_filename, category, upload_date, size, user_id, torrent_category, blob_digest) 
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (stored_name, filename, category, datetime.now().isoformat(), size, user_id, torrent_category, blob_digest))
+    else:
+        c.execute("""
+        INSERT INTO files (filename, original_filename, category, upload_date, size, user_id, blob_digest) 
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (stored_name, filename, category, datetime.now().isoformat(), size, user_id, blob_digest))
+    return c.lastrowid
+
+# Хранилище по хешу содержимого (включается CONTENT_ADDRESSED_STORAGE).
+# Каждое уникальное содержимое хранится один раз в UPLOAD_FOLDER/.blobs/<xx>/<sha256>,
+# а файлы в папках категорий — жесткие ссылки на этот блок. Поэтому отдача, превью
+# и X-Accel-Redirect работают с обычными путями, а повторная копия не занимает места.
+CONTENT_ADDRESSED_STORAGE = app.config.get('CONTENT_ADDRESSED_STORAGE', False)
+BLOB_FOLDER = os.path.join(app.config['UPLOAD_FOLDER'], '.blobs')
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def begin_blob_transaction(c):
+    """Связывание и освобождение блоков выполняются под блокировкой записи БД: она общая
+    для всех потоков и рабочих процессов gunicorn, поэтому блок не удалится в момент, когда
+    другой процесс создает на него ссылку. Блокировка держится до commit вызывающего кода"""
+    if not c.connection.in_transaction:
+        c.execute("BEGIN IMMEDIATE")
+
+def blob_path(digest):
+    return os.path.join(BLOB_FOLDER, digest[:2], digest)
+
+def hash_file(file_path):
+    """SHA-256 содержимого файла"""
+    hasher = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for data in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+def write_upload_stream(stream, file_path):
+    """Копирует поток в файл; при включенном хранилище по хешу заодно считает SHA-256,
+    чтобы не перечитывать файл. Возвращает хеш или None"""
+    hasher = hashlib.sha256() if CONTENT_ADDRESSED_STORAGE else None
+    with open(file_path, 'xb') as f:
+        for data in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+            if hasher:
+                hasher.update(data)
+            f.write(data)
+    return hasher.hexdigest() if hasher else None
+
+def link_blob(c, digest, file_path):
+    """Привязывает файл к блоку с хешем digest. Если такое содержимое уже хранится,
+    загруженная копия заменяется жесткой ссылкой на существующий блок.
+    Открывает транзакцию, запись в files нужно добавить в ней же"""
+    path = blob_path(digest)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    
+    begin_blob_transaction(c)
+    try:
+        # Первый экземпляр содержимого: блок становится второй ссылкой на загруженный файл
+        os.link(file_path, path)
+    except FileExistsError:
+        temp_path = f"{file_path}.{uuid.uuid4().hex}.tmp"
+        os.link(path, temp_path)
+        os.replace(temp_path, file_path)
+    
+    c.execute("INSERT OR IGNORE INTO blobs (digest, size, refcount) VALUES (?, ?, 0)",
+             (digest, os.path.getsize(path)))
+
+def link_existing_blob(digest, file_path):
+    """Создает файл как жесткую ссылку на уже хранящийся блок
+    (внутри транзакции begin_blob_transaction)"""
+    os.link(blob_path(digest), file_path)
+
+def release_blob(c, digest):
+    """Удаляет блок, если на него больше не ссылается ни один файл"""
+    if not digest:
+        return
+    
+    begin_blob_transaction(c)
+    # Проверка счетчика и удаление записи — один запрос, файл блока удаляется, только если запись удалена
+    c.execute("DELETE FROM blobs WHERE digest = ? AND refcount <= 0", (digest,))
+    if c.rowcount:
+        try:
+            os.remove(blob_path(digest))
+        except FileNotFoundError:
+            pass
+
+def find_user_blob(c, user_id, digest, size):
+    """Есть ли у пользователя файл с таким содержимым (проверка до загрузки)"""
+    c.execute("""
+    SELECT 1 FROM files f JOIN blobs b ON b.digest = f.blob_digest
+    WHERE f.user_id = ? AND f.blob_digest = ? AND b.size = ? LIMIT 1
+    """, (user_id, digest, size))
+    return c.fetchone() is not None and os.path.exists(blob_path(digest))
+
+def check_existing_upload(user_id, data):
+    """Проверка "есть ли уже файл с хешем X": если есть, файл добавляется мгновенно,
+    без передачи содержимого. Сравнение идет только с файлами самого пользователя,
+    чтобы по хешу нельзя было узнать о чужих файлах или получить их.
+    Возвращает (результат, ошибка, HTTP-статус)"""
+    if not CONTENT_ADDRESSED_STORAGE:
+        return {'exists': False, 'enabled': False}, None, 200
+    
+    digest = (data.get('sha256') or '').lower()
+    size = data.get('size')
+    original_name = data.get('filename') or ''
+    if (not re.fullmatch(r'[0-9a-f]{64}', digest) or not isinstance(size, int) or isinstance(size, bool)
+            or size < 0 or not original_name):
+        return None, 'Необходимо указать sha256, размер и имя файла', 400
+    if not allowed_file(original_name):
+        return None, 'Недопустимый формат файла', 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    # Блок проверяется и получает новую ссылку в одной транзакции, чтобы его не удалили между ними
+    begin_blob_transaction(c)
+    if not find_user_blob(c, user_id, digest, size):
+        conn.rollback()
+        return {'exists': False, 'enabled': True}, None, 200
+    
+    filename = secure_filename(original_name)
+    category = get_category(filename)
+    stored_name, file_path = prepare_upload_target(filename, category, data.get('path') or '')
+    torrent_category = data.get('torrent_category', 'other') if category == 'torrents' else None
+    
+    try:
+        stored_name, file_path, _ = create_upload_target(stored_name, file_path, lambda path: link_existing_blob(digest, path))
+        file_id = save_file_record(c, stored_name, filename, category, size, user_id, torrent_category, digest)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    
+    return {
+        'exists': True,
+        'enabled': True,
+        'file_id': file_id,
+        'filename': os.path.basename(stored_name),
+        'original_filename': filename,
+        'category': category,
+        'torrent_category': torrent_category,
+        'size': size,
+    }, None, 201
+
+def delete_stored_file(c, file_id, category, filename):
+    """Удаляет файл с диска и из БД; блок содержимого удаляется вместе с последней ссылкой"""
+    begin_blob_transaction(c)
+    c.execute("SELECT blob_digest FROM files WHERE id = ?", (file_id,))
+    row = c.fetchone()
+    
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], category, filename)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    
+    c.execute("DELETE FROM files WHERE id = ?", (file_id,))
+    release_blob(c, row[0] if row else None)
+
+# Возобновляемая загрузка по частям (по мотивам протокола tus).
+# Клиент создает сессию, отправляет части в любом порядке (в том числе параллельно) через
+# PUT .../chunks/<номер>, а после получения всех частей вызывает finalize.
+# Части пишутся сразу на свое место в итоговый файл, без промежуточных копий.
+UPLOAD_CHUNK_SIZE = app.config.get('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)
+MIN_UPLOAD_CHUNK_SIZE = 256 * 1024
+MAX_UPLOAD_CHUNK_SIZE = 64 * 1024 * 1024
+UPLOAD_SESSION_TTL = app.config.get('UPLOAD_SESSION_TTL', 24 * 60 * 60)  # секунды без активности
+UPLOAD_CHECKSUM_ALGORITHMS = ('sha256', 'sha1', 'md5')
+
+# Статус ответа tus при несовпадении контрольной суммы части
+CHECKSUM_MISMATCH = 460
+
+def upload_chunk_count(size, chunk_size):
+    return (size + chunk_size - 1) // chunk_size
+
+def upload_file_path(session):
+    """Путь к файлу, в который пишутся части сессии"""
+    return os.path.join(app.config['UPLOAD_FOLDER'], session['category'], session['filename'])
+
+def get_upload_session(c, session_id, user_id):
+    c.execute("""
+    SELECT id, filename, original_filename, category, torrent_category, size, chunk_size
+    FROM upload_sessions WHERE id = ? AND user_id = ?
+    """, (session_id, user_id))
+    row = c.fetchone()
+    if not row:
+        return None
+    return {
+        'id': row[0],
+        'filename': row[1],
+        'original_filename': row[2],
+        'category': row[3],
+        'torrent_category': row[4],
+        'size': row[5],
+        'chunk_size': row[6],
+    }
+
+def upload_session_state(c, session):
+    """Состояние сессии для клиента: какие части уже приняты и сколько байт подряд с начала файла"""
+    c.execute("SELECT chunk_index FROM upload_chunks WHERE session_id = ? ORDER BY chunk_index", (session['id'],))
+    received = [row[0] for row in c.fetchall()]
+    
+    contiguous = 0
+    for index in received:
+        if index != contiguous:
+            break
+        contiguous += 1
+    
+    return {
+        'upload_id': session['id'],
+        'filename': session['original_filename'],
+        'category': session['category'],
+        'size': session['size'],
+        'chunk_size': session['chunk_size'],
+        'chunk_count': upload_chunk_count(session['size'], session['chunk_size']),
+        'received_chunks': received,
+        'offset': min(contiguous * session['chunk_size'], session['size']),
+    }
+
+def remove_upload_session(c, session):
+    """Удаляет сессию и недокачанный файл"""
+    c.execute("DELETE FROM upload_chunks WHERE session_id = ?", (session['id'],))
+    c.execute("DELETE FROM upload_sessions WHERE id = ?", (session['id'],))
+    try:
+        os.remove(upload_file_path(session))
+    except FileNotFoundError:
+        pass
+
+def cleanup_stale_upload_sessions(c):
+    """Удаляет брошенные сессии загрузки вместе с их файлами"""
+    expired = (datetime.now() - timedelta(seconds=UPLOAD_SESSION_TTL)).isoformat()
+    c.execute("SELECT id, user_id FROM upload_sessions WHERE updated_at < ?", (expired,))
+    for session_id, user_id in c.fetchall():
+        session = get_upload_session(c, session_id, user_id)
+        if session:
+            remove_upload_session(c, session)
+
+def create_upload_session(user_id, data):
+    """Создает сессию загрузки. Возвращает (состояние, ошибка, HTTP-статус)"""
+    original_name = data.get('filename') or ''
+    size = data.get('size')
+    if not original_name or not isinstance(size, int) or isinstance(size, bool) or size < 0:
+        return None, 'Необходимо указать имя и размер файла', 400
+    if not allowed_file(original_name):
+        return None, 'Недопустимый формат файла', 400
+    
+    chunk_size = data.get('chunk_size') or UPLOAD_CHUNK_SIZE
+    if not isinstance(chunk_size, int) or not MIN_UPLOAD_CHUNK_SIZE <= chunk_size <= MAX_UPLOAD_CHUNK_SIZE:
+        return None, f'Размер части должен быть от {MIN_UPLOAD_CHUNK_SIZE} до {MAX_UPLOAD_CHUNK_SIZE} байт', 400
+    
+    filename = secure_filename(original_name)
+    category = get_category(filename)
+    stored_name, file_path = prepare_upload_target(filename, category, data.get('path') or '')
+    torrent_category = data.get('torrent_category', 'other') if category == 'torrents' else None
+    
+    # Файл сразу создается нужного размера (разреженным), части дописываются на свои места
+    def create(path):
+        with open(path, 'xb') as f:
+            f.truncate(size)
+    
+    stored_name, file_path, _ = create_upload_target(stored_name, file_path, create)
+    
+    session = {
+        'id': uuid.uuid4().hex,
+        'filename': stored_name,
+        'original_filename': filename,
+        'category': category,
+        'torrent_category': torrent_category,
+        'size': size,
+        'chunk_size': chunk_size,
+    }
+    
+    conn = get_db()
+    c = conn.cursor()
+    cleanup_stale_upload_sessions(c)
+    now = datetime.now().isoformat()
+    c.execute("""
+    INSERT INTO upload_sessions (id, user_id, filename, original_filename, category, torrent_category, size, chunk_size, created_at, updated_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (session['id'], user_id, stored_name, filename, category, torrent_category, size, chunk_size, now, now))
+    conn.commit()
+    
+    return upload_session_state(c, session), None, 201
+
+def parse_upload_checksum(header):
+    """Разбирает заголовок Upload-Checksum: "<алгоритм> <base64>" """
+    algorithm, _, digest = header.strip().partition(' ')
+    algorithm = algorithm.lower()
+    if algorithm not in UPLOAD_CHECKSUM_ALGORITHMS or not digest:
+        return None
+    try:
+        return algorithm, base64.b64decode(digest.strip(), validate=True)
+    except ValueError:
+        return None
+
+def write_upload_chunk(user_id, session_id, index):
+    """Принимает одну часть из тела запроса и пишет ее на место в файле.
+    Возвращает (состояние, ошибка, HTTP-статус)"""
+    conn = get_db()
+    c = conn.cursor()
+    session = get_upload_session(c, session_id, user_id)
+    if not session:
+        return None, 'Сессия загрузки не найдена', 404
+    
+    chunk_count = upload_chunk_count(session['size'], session['chunk_size'])
+    if index < 0 or index >= chunk_count:
+        return None, 'Неверный номер части', 400
+    
+    offset = index * session['chunk_size']
+    expected = min(session['chunk_size'], session['size'] - offset)
+    if request.content_length != expected:
+        return None, f'Часть {index} должна содержать {expected} байт', 400
+    
+    checksum = None
+    hasher = None
+    checksum_header = request.headers.get('Upload-Checksum')
+    if checksum_header:
+        checksum = parse_upload_checksum(checksum_header)
+        if not checksum:
+            return None, 'Неподдерживаемый формат Upload-Checksum', 400
+        hasher = hashlib.new(checksum[0])
+    
+    # Тело читаем напрямую из потока: без разбора multipart и без временного файла Werkzeug
+    written = 0
+    fd = os.open(upload_file_path(session), os.O_WRONLY)
+    try:
+        while written < expected:
+            data = request.stream.read(min(FILE_CHUNK_SIZE, expected - written))
+            if not data:
+                break
+            if hasher:
+                hasher.update(data)
+            os.pwrite(fd, data, offset + written)
+            written += len(data)
+    finally:
+        os.close(fd)
+    
+    if written != expected:
+        return None, 'Соединение прервано, часть нужно отправить заново', 400
+    if hasher and hasher.digest() != checksum[1]:
+        return None, 'Контрольная сумма части не совпадает', CHECKSUM_MISMATCH
+    
+    c.execute("INSERT OR REPLACE INTO upload_chunks (session_id, chunk_index, checksum) VALUES (?, ?, ?)",
+             (session_id, index, checksum_header))
+    c.execute("UPDATE upload_sessions SET updated_at = ? WHERE id = ?", (datetime.now().isoformat(), session_id))
+    conn.commit()
+    
+    return upload_session_state(c, session), None, 200
+
+def finalize_upload_session(user_id, session_id):
+    """Завершает загрузку: проверяет, что получены все части, и добавляет файл в БД.
+    Возвращает (информация о файле, ошибка, HTTP-статус)"""
+    conn = get_db()
+    c = conn.cursor()
+    session = get_upload_session(c, session_id, user_id)
+    if not session:
+        return None, 'Сессия загрузки не найдена', 404
+    
+    c.execute("SELECT COUNT(*) FROM upload_chunks WHERE session_id = ?", (session_id,))
+    missing = upload_chunk_count(session['size'], session['chunk_size']) - c.fetchone()[0]
+    if missing > 0:
+        return None, f'Не получено частей: {missing}', 409
+    
+    # Части приходят в произвольном порядке, поэтому хеш считается по готовому файлу
+    digest = None
+    if CONTENT_ADDRESSED_STORAGE:
+        file_path = upload_file_path(session)
+        digest = hash_file(file_path)
+        link_blob(c, digest, file_path)
+    
+    file_id = save_file_record(c, session['filename'], session['original_filename'], session['category'],
+                               session['size'], user_id, session['torrent_category'], digest)
+    c.execute("DELETE FROM upload_chunks WHERE session_id = ?", (session_id,))
+    c.execute("DELETE FROM upload_sessions WHERE id = ?", (session_id,))
+    conn.commit()
+    schedule_thumbnail(session['category'], upload_file_path(session))
+    
+    return {
+        'file_id': file_id,
+        'filename': os.path.basename(session['filename']),
+        'original_filename': session['original_filename'],
+        'category': session['category'],
+        'torrent_category': session['torrent_category'],
+        'size': session['size'],
+    }, None, 201
+
+def abort_upload_session(user_id, session_id):
+    """Отменяет загрузку и удаляет недокачанный файл"""
+    conn = get_db()
+    c = conn.cursor()
+    session = get_upload_session(c, session_id, user_id)
+    if not session:
+        return None, 'Сессия загрузки не найдена', 404
+    
+    remove_upload_session(c, session)
+    conn.commit()
+    return {'upload_id': session_id}, None, 200
+
+def upload_status_response(result, error, status, error_key):
+    if error:
+        return jsonify({error_key: error}), status
+    return jsonify(result), status
+
+@app.route('/upload/check', methods=['POST'])
+@login_required
+def check_upload():
+    return upload_status_response(*check_existing_upload(current_user.id, request.get_json(silent=True) or {}), 'error')
+
+@app.route('/upload/sessions', methods=['POST'])
+@login_required
+def create_upload():
+    return upload_status_response(*create_upload_session(current_user.id, request.get_json(silent=True) or {}), 'error')
+
+@app.route('/upload/sessions/<upload_id>', methods=['GET'])
+@login_required
+def upload_status(upload_id):
+    c = get_db().cursor()
+    session = get_upload_session(c, upload_id, current_user.id)
+    if not session:
+        return jsonify({'error': 'Сессия загрузки не найдена'}), 404
+    return jsonify(upload_session_state(c, session))
+
+@app.route('/upload/sessions/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@login_required
+def upload_chunk(upload_id, index):
+    return upload_status_response(*write_upload_chunk(current_user.id, upload_id, index), 'error')
+
+@app.route('/upload/sessions/<upload_id>/finalize', methods=['POST'])
+@login_required
+def finalize_upload(upload_id):
+    result, error, status = finalize_upload_session(current_user.id, upload_id)
+    if error:
+        return jsonify({'error': error}), status
+    return jsonify({'success': True, **result})
+
+@app.route('/upload/sessions/<upload_id>', methods=['DELETE'])
+@login_required
+def abort_upload(upload_id):
+    return upload_status_response(*abort_upload_session(current_user.id, upload_id), 'error')
+
 @app.route('/upload', methods=['POST'])
 @login_required
 def upload_file():
@@ -443,49 +1424,26 @@ def upload_file():
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
         category = get_category(filename)
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        new_filename = f"{timestamp}_{filename}"
-        
-        # Проверяем, есть ли путь для сохранения структуры папок
-        path = request.form.get('path', '')
+        stored_name, file_path = prepare_upload_target(filename, category, request.form.get('path', ''))
         
         # Получаем категорию торрента, если файл является торрентом
         torrent_category = None
         if category == 'torrents':
             torrent_category = request.form.get('torrent_category', 'other')
         
-        if path:
-            # Создаем подпапку с учетом пути
-            folder_path = os.path.join(app.config['UPLOAD_FOLDER'], category, path)
-            os.makedirs(folder_path, exist_ok=True)
-            file_path = os.path.join(folder_path, new_filename)
-        else:
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], category, new_filename)
-        
-        file.save(file_path)
+        stored_name, file_path, digest = create_upload_target(
+            stored_name, file_path, lambda path: write_upload_stream(file.stream, path))
         
         # Сохраняем информацию о файле в БД
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
-        
-        if category == 'torrents':
-            c.execute("""
-            INSERT INTO files (filename, original_filename, category, upload_date, size, user_id, torrent_category) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (new_filename if not path else os.path.join(path, new_filename), 
-                filename, category, datetime.now().isoformat(), 
-                os.path.getsize(file_path), current_user.id, torrent_category))
-        else:
-            c.execute("""
-            INSERT INTO files (filename, original_filename, category, upload_date, size, user_id) 
-            VALUES (?, ?, ?, ?, ?, ?)
-            """, (new_filename if not path else os.path.join(path, new_filename), 
-                filename, category, datetime.now().isoformat(), 
-                os.path.getsize(file_path), current_user.id))
-        
+        if digest:
+            link_blob(c, digest, file_path)
+        save_file_record(c, stored_name, filename, category, os.path.getsize(file_path), current_user.id, torrent_category, digest)
         conn.commit()
-        conn.close()
+        schedule_thumbnail(category, file_path)
         
+        new_filename = os.path.basename(stored_name)
         return jsonify({'success': True, 'filename': new_filename, 'category': category})
     
     return jsonify({'error': 'Недопустимый формат файла'}), 400
@@ -503,7 +1461,7 @@ def add_link():
     description = data.get('description', '')
     category = data.get('category', 'links')
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("""
     INSERT INTO links (title, url, description, category, add_date, user_id) 
@@ -511,7 +1469,6 @@ def add_link():
     """, (title, url, description, category, datetime.now().isoformat(), current_user.id))
     conn.commit()
     link_id = c.lastrowid
-    conn.close()
     
     return jsonify({
         'success': True, 
@@ -522,154 +1479,693 @@ def add_link():
         'add_date': datetime.now().isoformat()
     })
 
+# Постраничная выдача списков файлов и ссылок.
+# Сортировка: колонка в files, колонка в links (у ссылок нет размера, для них ключ постоянный)
+LIST_SORT_COLUMNS = {
+    'date': ('upload_date', 'add_date'),
+    'name': ('original_filename COLLATE NOCASE', 'title COLLATE NOCASE'),
+    'size': ('size', None),
+}
+
+# При равных ключах сортировки файлы идут раньше ссылок
+LIST_RANK_FILE = 0
+LIST_RANK_LINK = 1
+
+MAX_LIST_LIMIT = 1000
+
+def nocase_key(value):
+    """Ключ сравнения, совпадающий с COLLATE NOCASE в SQLite: регистр снимается только у ASCII"""
+    if value is None:
+        return ''
+    return ''.join(chr(ord(ch) + 32) if 'A' <= ch <= 'Z' else ch for ch in value)
+
+def encode_list_cursor(position):
+    """Кодирует позицию последнего отданного элемента (значение, ранг, id) в курсор"""
+    raw = json.dumps(position, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_list_cursor(cursor):
+    """Разбирает курсор; возвращает None, если курсор поврежден"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, rank, item_id = json.loads(raw.decode('utf-8'))
+        if not isinstance(rank, int) or not isinstance(item_id, int):
+            return None
+        return value, rank, item_id
+    except (ValueError, TypeError):
+        return None
+
+def parse_list_params(args):
+    """Общие параметры списков: sort, order, limit, cursor, fields.
+    Возвращает (параметры, ошибка)"""
+    sort_by = args.get('sort', 'date')
+    if sort_by not in LIST_SORT_COLUMNS:
+        sort_by = 'date'
+    
+    limit = args.get('limit')
+    if limit is not None:
+        try:
+            limit = min(max(int(limit), 1), MAX_LIST_LIMIT)
+        except ValueError:
+            return None, 'Некорректный параметр limit'
+    
+    after = None
+    if args.get('cursor'):
+        after = decode_list_cursor(args.get('cursor'))
+        if after is None:
+            return None, 'Некорректный курсор'
+    
+    fields = None
+    if args.get('fields'):
+        fields = {field.strip() for field in args.get('fields').split(',') if field.strip()}
+    
+    return {
+        'sort_by': sort_by,
+        'desc': args.get('order', 'desc') == 'desc',
+        'limit': limit,
+        'after': after,
+        'fields': fields
+    }, None
+
+def iter_sorted_rows(c, table, columns, sort_expr, where, params, rank, desc, after):
+    """Итерирует строки таблицы пользователя в порядке (ключ сортировки, id), начиная сразу
+    после позиции after. Строки читаются из курсора SQLite по мере потребления"""
+    direction = 'DESC' if desc else 'ASC'
+    op = '<' if desc else '>'
+    # Постоянный ключ (размер ссылок) сравниваем как литерал 0
+    key_expr = sort_expr or '0'
+    
+    if after is not None:
+        last_value, last_rank, last_id = after
+        if rank == last_rank:
+            # Нестрогое условие на ключ позволяет SQLite начать обход индекса с нужного места
+            where += f" AND {key_expr} {op}= ? AND ({key_expr} {op} ? OR id {op} ?)"
+            params = params + [last_value, last_value, last_id]
+        elif (rank > last_rank) != desc:
+            # Элементы этого потока с тем же ключом еще не отдавались
+            where += f" AND {key_expr} {op}= ?"
+            params = params + [last_value]
+        else:
+            where += f" AND {key_expr} {op} ?"
+            params = params + [last_value]
+    
+    if sort_expr:
+        order_by = f"{sort_expr} {direction}, id {direction}"
+    else:
+        order_by = f"id {direction}"
+    
+    cursor = c.execute(f"SELECT {columns} FROM {table} WHERE {where} ORDER BY {order_by}", params)
+    for row in cursor:
+        yield row
+
+def iter_user_files(c, user_id, category, sort_by, desc, after):
+    """Поток файлов пользователя: элементы (ключ слияния, позиция для курсора, строка)"""
+    sort_expr = LIST_SORT_COLUMNS[sort_by][0]
+    where = "user_id = ?"
+    params = [user_id]
+    if category and category != 'all':
+        where += " AND category = ?"
+        params.append(category)
+    
+    # id, filename, original_filename, category, upload_date, size, torrent_category
+    rows = iter_sorted_rows(c, 'files',
+                            "id, filename, original_filename, category, upload_date, size, torrent_category",
+                            sort_expr, where, params, LIST_RANK_FILE, desc, after)
+    for row in rows:
+        if sort_by == 'date':
+            value, key = row[4], row[4] or ''
+        elif sort_by == 'name':
+            value, key = row[2], nocase_key(row[2])
+        else:
+            value, key = row[5], row[5] or 0
+        yield (key, LIST_RANK_FILE, row[0]), (value, LIST_RANK_FILE, row[0]), row
+
+def iter_user_links(c, user_id, sort_by, desc, after):
+    """Поток ссылок пользователя в том же формате, что и iter_user_files"""
+    sort_expr = LIST_SORT_COLUMNS[sort_by][1]
+    
+    # id, title, url, description, category, add_date
+    rows = iter_sorted_rows(c, 'links', "id, title, url, description, category, add_date",
+                            sort_expr, "user_id = ?", [user_id], LIST_RANK_LINK, desc, after)
+    for row in rows:
+        if sort_by == 'date':
+            value, key = row[5], row[5] or ''
+        elif sort_by == 'name':
+            value, key = row[1], nocase_key(row[1])
+        else:
+            value, key = 0, 0
+        yield (key, LIST_RANK_LINK, row[0]), (value, LIST_RANK_LINK, row[0]), row
+
+def take_page(stream, limit):
+    """Берет из отсортированного потока страницу; возвращает (элементы, курсор следующей страницы)"""
+    if limit is None:
+        return [(position, row) for _, position, row in stream], None
+    
+    page = [(position, row) for _, position, row in itertools.islice(stream, limit + 1)]
+    if len(page) > limit:
+        page = page[:limit]
+        return page, encode_list_cursor(list(page[-1][0]))
+    return page, None
+
+def project_fields(item, fields, required=('id',)):
+    """Оставляет в элементе только запрошенные поля (и обязательные)"""
+    if not fields:
+        return item
+    return {key: value for key, value in item.items() if key in fields or key in required}
+
 @app.route('/files')
 @login_required
 def list_files():
     category = request.args.get('category', 'all')
-    sort_by = request.args.get('sort', 'date')
-    order = request.args.get('order', 'desc')
+    params, error = parse_list_params(request.args)
+    if error:
+        return jsonify({'error': error}), 400
+    
+    sort_by = params['sort_by']
+    desc = params['desc']
+    after = params['after']
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
-    file_list = []
+    streams = []
     
     # Загружаем файлы, только если не выбрана категория "ссылки"
     if category != 'links':
-        query = "SELECT * FROM files WHERE user_id = ?"
-        params = [current_user.id]
-        
-        if category != 'all':
-            query += " AND category = ?"
-            params.append(category)
-        
-        # Добавляем сортировку в SQL запрос для файлов
-        if sort_by == 'date':
-            query += " ORDER BY upload_date"
-        elif sort_by == 'name':
-            query += " ORDER BY original_filename"
-        elif sort_by == 'size':
-            query += " ORDER BY size"
-        
-        if order == 'desc':
-            query += " DESC"
-        else:
-            query += " ASC"
-        
-        c.execute(query, params)
-        files = c.fetchall()
-        
-        for file in files:
-            file_data = {
-                'id': file[0],
-                'filename': file[1],
-                'original_name': file[2],
-                'category': file[3],
-                'upload_date': file[4],
-                'size': file[5],
+        streams.append(iter_user_files(c, current_user.id, category, sort_by, desc, after))
+    
+    # Если выбрана категория "все" или "ссылки", добавляем ссылки
+    if category == 'all' or category == 'links':
+        streams.append(iter_user_links(conn.cursor(), current_user.id, sort_by, desc, after))
+    
+    # Оба потока уже отсортированы в SQL, поэтому сливаем их на лету без общей сортировки
+    merged = heapq.merge(*streams, key=lambda entry: entry[0], reverse=desc)
+    page, next_cursor = take_page(merged, params['limit'])
+    
+    file_list = []
+    for position, row in page:
+        if position[1] == LIST_RANK_FILE:
+            item = {
+                'id': row[0],
+                'filename': row[1],
+                'original_name': row[2],
+                'category': row[3],
+                'upload_date': row[4],
+                'size': row[5],
                 'type': 'file'
             }
             
             # Добавляем категорию торрента, если это торрент-файл
-            if file[3] == 'torrents' and file[7]:  # file[7] - это индекс torrent_category
-                file_data['torrent_category'] = file[7]
-            
-            file_list.append(file_data)
+            if row[3] == 'torrents' and row[6]:
+                item['torrent_category'] = row[6]
+        else:
+            item = {
+                'id': row[0],
+                'title': row[1],
+                'url': row[2],
+                'description': row[3],
+                'category': row[4],
+                'upload_date': row[5],
+                'size': 0,  # Размер 0 для ссылок, чтобы можно было сортировать вместе с файлами
+                'type': 'link'
+            }
+        file_list.append(project_fields(item, params['fields'], required=('id', 'type')))
     
-    # Если выбрана категория "все" или "ссылки", добавляем ссылки
-    if category == 'all' or category == 'links':
-        query = "SELECT * FROM links WHERE user_id = ?"
-        params = [current_user.id]
+    response = jsonify(file_list)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+# Отдача файлов из хранилища: Range-запросы (в том числе несколько диапазонов),
+# условные GET и передача через sendfile или X-Accel-Redirect
+FILE_CHUNK_SIZE = 64 * 1024
+MAX_RANGES_PER_REQUEST = 16
+
+def file_etag(stat):
+    """Сильный ETag файла: меняется при любой перезаписи содержимого"""
+    return f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+
+def content_disposition(download_name, as_attachment):
+    """Заголовок Content-Disposition с ASCII-именем и UTF-8 именем по RFC 6266"""
+    disposition = 'attachment' if as_attachment else 'inline'
+    if not download_name:
+        return disposition
+    
+    ascii_name = unicodedata.normalize('NFKD', download_name).encode('ascii', 'ignore').decode('ascii')
+    ascii_name = ascii_name.replace('\\', '_').replace('"', '_') or 'download'
+    if ascii_name == download_name:
+        return f'{disposition}; filename="{ascii_name}"'
+    quoted_name = urllib.parse.quote(download_name, safe='')
+    return f"{disposition}; filename=\"{ascii_name}\"; filename*=UTF-8''{quoted_name}"
+
+def is_not_modified(etag, mtime):
+    """Проверяет If-None-Match / If-Modified-Since текущего запроса"""
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        return http.parse_etags(if_none_match).contains_weak(etag)
+    
+    if_modified_since = http.parse_date(request.headers.get('If-Modified-Since'))
+    if if_modified_since:
+        return int(mtime) <= int(if_modified_since.timestamp())
+    return False
+
+def requested_byte_ranges(etag, mtime, length):
+    """Возвращает список диапазонов [(start, stop)], пустой список, если ни один диапазон
+    не выполним, или None, если нужно отдать файл целиком"""
+    range_header = request.headers.get('Range')
+    if not range_header:
+        return None
+    
+    # If-Range: диапазон отдается только если файл не изменился с тех пор, как клиент его видел
+    if_range = request.headers.get('If-Range')
+    if if_range:
+        parsed = http.parse_if_range_header(if_range)
+        if parsed.etag is not None and parsed.etag != etag:
+            return None
+        if parsed.date is not None and int(mtime) > int(parsed.date.timestamp()):
+            return None
+    
+    byte_range = http.parse_range_header(range_header)
+    if byte_range is None or byte_range.units != 'bytes':
+        return None
+    
+    ranges = []
+    for start, stop in byte_range.ranges:
+        if start < 0:
+            start = max(length + start, 0)
+            stop = length
+        else:
+            stop = length if stop is None else min(stop, length)
+        if start < stop:
+            ranges.append((start, stop))
+    
+    # Сливаем пересекающиеся и соседние диапазоны
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], stop))
+        else:
+            merged.append((start, stop))
+    
+    if len(merged) > MAX_RANGES_PER_REQUEST:
+        return None
+    return merged
+
+def read_file_range(f, start, length):
+    """Читает из открытого файла length байт начиная с start блоками по FILE_CHUNK_SIZE"""
+    f.seek(start)
+    remaining = length
+    while remaining > 0:
+        chunk = f.read(min(FILE_CHUNK_SIZE, remaining))
+        if not chunk:
+            break
+        remaining -= len(chunk)
+        yield chunk
+
+def iter_file_range(f, start, length):
+    """Как read_file_range, но закрывает файл по окончании"""
+    try:
+        yield from read_file_range(f, start, length)
+    finally:
+        f.close()
+
+def file_body(f, start, length):
+    """Тело ответа с фрагментом файла. Если WSGI-сервер предоставляет wsgi.file_wrapper
+    (gunicorn), данные уходят в сокет через os.sendfile без копирования в Python"""
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    # Content-Length соблюдает только sendfile gunicorn, обычные обертки (wsgiref, Werkzeug)
+    # читают файл до конца, поэтому обертка используется, только если диапазон доходит до конца файла
+    if file_wrapper is not None and start + length == os.fstat(f.fileno()).st_size:
+        f.seek(start)
+        return file_wrapper(f, FILE_CHUNK_SIZE)
+    return iter_file_range(f, start, length)
+
+def iter_multipart_ranges(file_path, ranges, parts):
+    """Тело ответа multipart/byteranges"""
+    with open(file_path, 'rb') as f:
+        for (start, stop), header in zip(ranges, parts):
+            yield header
+            yield from read_file_range(f, start, stop - start)
+            yield b'\r\n'
+        yield parts[-1]
+
+# Передачи файлов пользователям: пока они идут, торренты получают меньше полосы (см. bandwidth.py).
+# Маленькие ответы не учитываются — они заканчиваются раньше, чем менеджер успел бы отреагировать
+TRANSFER_TRACKING_MIN_SIZE = 1024 * 1024
+http_activity = HttpActivity()
+http_activity_reporter = None
+http_activity_lock = threading.Lock()
+
+def report_http_activity():
+    """Фоновый поток: сообщает менеджеру загрузок, сколько передач файлов идет в этом процессе"""
+    last_reported = 0
+    while True:
+        active = http_activity.wait(5)
+        if active == 0 and last_reported == 0:
+            continue
         
-        # Для ссылок нет поля size, поэтому сортируем только по дате или имени
-        if sort_by == 'date':
-            query += " ORDER BY add_date"
-        elif sort_by == 'name' or sort_by == 'size':  # При сортировке по размеру для ссылок используем сортировку по имени
-            query += " ORDER BY title"
+        # Встроенный менеджер не запускается ради отчета, если торренты еще не понадобились
+        manager = get_torrent_manager() if TORRENT_MANAGER_SOCKET else torrent_manager
+        if manager is None:
+            continue
+        try:
+            manager.report_activity(os.getpid(), active)
+            last_reported = active
+        except TorrentManagerError as e:
+            print(f"Ошибка отправки отчета о нагрузке менеджеру загрузок: {str(e)}")
+
+def track_transfer(response, length):
+    """Учитывает передачу файла, пока WSGI-сервер не закроет ответ"""
+    global http_activity_reporter
+    if length < TRANSFER_TRACKING_MIN_SIZE:
+        return response
+    
+    if http_activity_reporter is None:
+        with http_activity_lock:
+            if http_activity_reporter is None:
+                http_activity_reporter = threading.Thread(target=report_http_activity, name='http-activity', daemon=True)
+                http_activity_reporter.start()
+    
+    http_activity.begin()
+    response.call_on_close(http_activity.end)
+    return response
+
+# Долгие ответы (потоки событий, передача больших файлов) занимают поток рабочего процесса
+# на все время передачи. Под gunicorn им отдается не больше STREAM_SLOTS потоков процесса,
+# а API_RESERVED_THREADS потоков всегда остаются для обычных запросов (см. gunicorn.conf.py)
+API_RESERVED_THREADS = app.config.get('API_RESERVED_THREADS', 8)
+STREAM_SLOTS = app.config.get('STREAM_SLOTS')
+if STREAM_SLOTS is None and os.environ.get('WALPSERVER_THREADS'):
+    STREAM_SLOTS = max(1, int(os.environ['WALPSERVER_THREADS']) - API_RESERVED_THREADS)
+stream_slots = threading.BoundedSemaphore(STREAM_SLOTS) if STREAM_SLOTS else None
+
+def is_long_response(response):
+    if not response.is_streamed:
+        return False
+    if response.mimetype in ('text/event-stream', 'application/x-ndjson'):
+        return True
+    return response.content_length is None or response.content_length >= TRANSFER_TRACKING_MIN_SIZE
+
+# Через сколько секунд SSE-клиент, которому не хватило слота, подключается снова
+STREAM_BUSY_RETRY = 5
+
+def acquire_stream_slot():
+    """Занимает слот долгого ответа заранее, до того как обработчик откроет ресурсы потока
+    (подписку на шину событий): отказ после создания ответа их бы не освободил.
+    Слот освобождается при закрытии ответа (см. limit_long_responses). False — слотов нет"""
+    if stream_slots is None:
+        return True
+    if not stream_slots.acquire(blocking=False):
+        return False
+    g.stream_slot = True
+    return True
+
+def stream_busy_response(mimetype):
+    """Ответ, когда слотов для долгих ответов нет. EventSource не переподключается после
+    ответа с ошибкой, поэтому SSE-клиент получает пустой поток с паузой переподключения"""
+    if mimetype == 'text/event-stream':
+        response = Response(f"retry: {STREAM_BUSY_RETRY * 1000}\n\n", mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    
+    busy = jsonify({'error': 'Сервер занят, повторите попытку позже'})
+    busy.status_code = 503
+    busy.headers['Retry-After'] = str(STREAM_BUSY_RETRY)
+    return busy
+
+@app.after_request
+def limit_long_responses(response):
+    """Долгий ответ занимает слот до закрытия; если слотов нет, клиент повторит запрос позже"""
+    if g.pop('stream_slot', False):
+        # Слот занят обработчиком заранее (acquire_stream_slot)
+        response.call_on_close(stream_slots.release)
+        return response
+    
+    if stream_slots is None or not is_long_response(response):
+        return response
+    
+    if not stream_slots.acquire(blocking=False):
+        # Генератор ответа еще не запускался: обработчики, которые держат ресурсы
+        # до начала потока, занимают слот сами через acquire_stream_slot
+        response.close()
+        return stream_busy_response(response.mimetype)
+    
+    response.call_on_close(stream_slots.release)
+    return response
+
+# Сжатие ответов. Статика сжимается один раз при первом обращении и хранится в памяти,
+# остальные ответы (страницы, JSON) сжимаются на лету с меньшей степенью сжатия
+COMPRESSION_MIN_SIZE = app.config.get('COMPRESSION_MIN_SIZE', 1024)
+COMPRESSION_LEVEL = app.config.get('COMPRESSION_LEVEL', 6)
+COMPRESSION_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript',
+    'application/json', 'image/svg+xml',
+}
+COMPRESSION_ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+
+def compress_body(data, encoding, static=False):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11 if static else 4)
+    return gzip.compress(data, compresslevel=9 if static else COMPRESSION_LEVEL, mtime=0)
+
+def is_compressible(response):
+    return (response.status_code == 200 and not response.is_streamed and not response.direct_passthrough
+            and 'Content-Encoding' not in response.headers and response.mimetype in COMPRESSION_MIMETYPES)
+
+def add_json_validators(response):
+    """ETag для JSON-ответов на GET: если данные не изменились, клиент получает 304 без тела.
+    ETag слабый, потому что одно и то же содержимое отдается в разных сжатиях"""
+    if (request.method not in ('GET', 'HEAD') or response.status_code != 200 or response.is_streamed
+            or response.mimetype != 'application/json' or 'ETag' in response.headers):
+        return response
+    
+    response.headers.setdefault('Cache-Control', 'private, no-cache')
+    response.add_etag(weak=True)
+    return response.make_conditional(request)
+
+def compress_response(response):
+    if not is_compressible(response):
+        return response
+    
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_SIZE:
+        return response
+    
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(COMPRESSION_ENCODINGS)
+    if encoding is None:
+        return response
+    
+    response.set_data(compress_body(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+@app.after_request
+def finalize_response(response):
+    # ETag считается по несжатому телу, поэтому сжатие идет последним
+    return compress_response(add_json_validators(response))
+
+# Статика: в URL из url_for('static', ...) добавляется версия — хэш содержимого файла,
+# поэтому браузер кэширует такие ответы навсегда, а после изменения файла получает новый URL
+STATIC_CACHE_MAX_AGE = 365 * 24 * 3600
+STATIC_MEMORY_MAX_SIZE = 1024 * 1024  # Файлы крупнее отдаются с диска без сжатия
+static_assets = {}
+static_assets_lock = threading.Lock()
+
+def load_static_asset(filename):
+    """Содержимое, версия и сжатые варианты файла из static/ (None, если файла нет).
+    Перечитывается, когда файл на диске меняется"""
+    path = safe_join(app.static_folder, filename)
+    try:
+        stat = os.stat(path) if path else None
+    except OSError:
+        return None
+    if stat is None or not os.path.isfile(path):
+        return None
+    
+    signature = (stat.st_mtime_ns, stat.st_size)
+    asset = static_assets.get(filename)
+    if asset is not None and asset['signature'] == signature:
+        return asset
+    
+    with static_assets_lock:
+        asset = static_assets.get(filename)
+        if asset is not None and asset['signature'] == signature:
+            return asset
         
-        if order == 'desc':
-            query += " DESC"
-        else:
-            query += " ASC"
-        
-        c.execute(query, params)
-        links = c.fetchall()
-        
-        for link in links:
-            file_list.append({
-                'id': link[0],
-                'title': link[1],
-                'url': link[2],
-                'description': link[3],
-                'category': link[4],
-                'upload_date': link[5],
-                'size': 0,  # Добавляем размер 0 для ссылок, чтобы можно было сортировать вместе с файлами
-                'type': 'link'
-            })
+        digest = hashlib.sha256()
+        chunks = []
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(FILE_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                if stat.st_size <= STATIC_MEMORY_MAX_SIZE:
+                    chunks.append(chunk)
+        data = b''.join(chunks) if stat.st_size <= STATIC_MEMORY_MAX_SIZE else None
+        variants = {'identity': data} if data is not None else {}
+        
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        if data is not None and mimetype in COMPRESSION_MIMETYPES and len(data) >= COMPRESSION_MIN_SIZE:
+            for encoding in COMPRESSION_ENCODINGS:
+                compressed = compress_body(data, encoding, static=True)
+                if len(compressed) < len(data):
+                    variants[encoding] = compressed
+        
+        asset = {
+            'signature': signature,
+            'version': digest.hexdigest()[:12],
+            'mimetype': mimetype,
+            'mtime': stat.st_mtime,
+            'variants': variants,
+        }
+        static_assets[filename] = asset
+        return asset
+
+@app.url_defaults
+def add_static_version(endpoint, values):
+    if endpoint != 'static' or 'v' in values or 'filename' not in values:
+        return
+    asset = load_static_asset(values['filename'])
+    if asset is not None:
+        values['v'] = asset['version']
+
+def serve_static(filename):
+    asset = load_static_asset(filename)
+    if asset is None or not asset['variants']:
+        response = app.send_static_file(filename)
+    else:
+        encodings = [encoding for encoding in COMPRESSION_ENCODINGS if encoding in asset['variants']]
+        encoding = request.accept_encodings.best_match(encodings) if encodings else None
+        response = Response(asset['variants'][encoding or 'identity'], mimetype=asset['mimetype'])
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if encodings:
+            response.vary.add('Accept-Encoding')
+        response.set_etag(asset['version'], weak=True)
+        response.last_modified = asset['mtime']
+    
+    if asset is not None and request.args.get('v') == asset['version']:
+        response.headers['Cache-Control'] = f'public, max-age={STATIC_CACHE_MAX_AGE}, immutable'
+    else:
+        # Без версии (или со старой версией) браузер каждый раз проверяет ETag
+        response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
+app.view_functions['static'] = serve_static
+
+def send_stored_file(file_path, download_name=None, as_attachment=True, mimetype=None):
+    """Отдает файл из хранилища с поддержкой Range, ETag и условных запросов"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return jsonify({'error': 'Файл не найден'}), 404
     
-    conn.close()
+    length = stat.st_size
+    etag = file_etag(stat)
+    mimetype = mimetype or mimetypes.guess_type(download_name or file_path)[0] or 'application/octet-stream'
     
-    # Если выбрана общая сортировка для файлов и ссылок вместе
-    if category == 'all' and file_list:
-        if sort_by == 'date':
-            file_list.sort(key=lambda x: x.get('upload_date'), reverse=(order == 'desc'))
-        elif sort_by == 'name':
-            file_list.sort(key=lambda x: x.get('original_name', x.get('title', '')).lower(), reverse=(order == 'desc'))
-        elif sort_by == 'size':
-            file_list.sort(key=lambda x: x.get('size', 0), reverse=(order == 'desc'))
+    headers = {
+        'ETag': http.quote_etag(etag),
+        'Last-Modified': http.http_date(stat.st_mtime),
+        'Accept-Ranges': 'bytes',
+        'Cache-Control': 'private, no-cache',
+        'Content-Disposition': content_disposition(download_name, as_attachment),
+    }
     
-    return jsonify(file_list)
+    if is_not_modified(etag, stat.st_mtime):
+        return Response(status=304, headers=headers)
+    
+    # За nginx файл отдает сам nginx (в том числе диапазоны), Python только проверяет доступ
+    accel_prefix = app.config.get('X_ACCEL_REDIRECT_PREFIX')
+    if accel_prefix:
+        relative_path = os.path.relpath(file_path, app.config['UPLOAD_FOLDER'])
+        if not relative_path.startswith('..'):
+            headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + urllib.parse.quote(relative_path.replace(os.sep, '/'))
+            return Response(status=200, headers=headers, mimetype=mimetype)
+    
+    ranges = requested_byte_ranges(etag, stat.st_mtime, length)
+    
+    if ranges == []:
+        headers['Content-Range'] = f'bytes */{length}'
+        return Response(status=416, headers=headers)
+    
+    if not ranges:
+        headers['Content-Length'] = str(length)
+        body = file_body(open(file_path, 'rb'), 0, length)
+        return track_transfer(Response(body, status=200, headers=headers, mimetype=mimetype, direct_passthrough=True), length)
+    
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+        headers['Content-Length'] = str(stop - start)
+        body = file_body(open(file_path, 'rb'), start, stop - start)
+        return track_transfer(Response(body, status=206, headers=headers, mimetype=mimetype, direct_passthrough=True), stop - start)
+    
+    # Несколько диапазонов: multipart/byteranges, длину тела считаем заранее
+    boundary = uuid.uuid4().hex
+    parts = []
+    for start, stop in ranges:
+        parts.append((
+            f'--{boundary}\r\n'
+            f'Content-Type: {mimetype}\r\n'
+            f'Content-Range: bytes {start}-{stop - 1}/{length}\r\n\r\n'
+        ).encode('latin-1'))
+    parts.append(f'--{boundary}--\r\n'.encode('latin-1'))
+    
+    content_length = sum(len(part) for part in parts) + sum(stop - start + 2 for start, stop in ranges)
+    headers['Content-Length'] = str(content_length)
+    response = Response(iter_multipart_ranges(file_path, ranges, parts), status=206, headers=headers,
+                        mimetype=f'multipart/byteranges; boundary={boundary}', direct_passthrough=True)
+    return track_transfer(response, content_length)
 
-@app.route('/download/<category>/<filename>')
+def upload_path(category, filename):
+    """Безопасный путь к файлу в хранилище (None, если имя выходит за пределы категории)"""
+    return safe_join(app.config['UPLOAD_FOLDER'], category, filename)
+
+@app.route('/download/<category>/<path:filename>')
 @login_required
 def download_file(category, filename):
     # Проверяем, принадлежит ли файл текущему пользователю
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM files WHERE filename = ? AND user_id = ?", 
              (filename, current_user.id))
     file = c.fetchone()
-    conn.close()
     
     if not file:
         return "Файл не найден", 404
     
-    return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], category), 
-                              filename, as_attachment=True, 
-                              download_name=file[2])  # Оригинальное имя файла
+    file_path = upload_path(category, filename)
+    if not file_path:
+        return "Файл не найден", 404
+    
+    return send_stored_file(file_path, download_name=file[2])  # Оригинальное имя файла
 
 @app.route('/delete_file/<int:file_id>')
 @login_required
 def delete_file(file_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM files WHERE id = ? AND user_id = ?", 
              (file_id, current_user.id))
     file = c.fetchone()
     
     if not file:
-        conn.close()
         return jsonify({'error': 'Файл не найден'}), 404
     
     filename = file[1]
     category = file[3]
     
-    # Удаляем файл
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], category, filename)
-    if os.path.exists(file_path):
-        os.remove(file_path)
-    
-    # Удаляем запись из БД
-    c.execute("DELETE FROM files WHERE id = ?", (file_id,))
+    # Удаляем файл и запись из БД
+    delete_stored_file(c, file_id, category, filename)
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True})
 
 @app.route('/delete_link/<int:link_id>')
 @login_required
 def delete_link(link_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     # Проверяем, принадлежит ли ссылка текущему пользователю
@@ -678,19 +2174,17 @@ def delete_link(link_id):
     link = c.fetchone()
     
     if not link:
-        conn.close()
         return jsonify({'status': 'error', 'message': 'Ссылка не найдена или нет прав доступа'})
     
     c.execute("DELETE FROM links WHERE id = ?", (link_id,))
     conn.commit()
-    conn.close()
     
     return jsonify({'status': 'success'})
 
 @app.route('/file_links')
 @login_required
 def get_file_links():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     # Получаем все файлы пользователя
@@ -704,7 +2198,6 @@ def get_file_links():
     """, (current_user.id,))
     
     files = c.fetchall()
-    conn.close()
     
     file_links = []
     for file in files:
@@ -731,99 +2224,246 @@ def get_file_links():
     
     return jsonify({'status': 'success', 'file_links': file_links})
 
-@app.route('/logout')
-@login_required
-def logout():
-    logout_user()
-    return redirect(url_for('login'))
+@app.route('/logout')
+@login_required
+def logout():
+    logout_user()
+    return redirect(url_for('login'))
+
+# Маркеры подсветки в сниппетах FTS5: управляющие символы не встречаются в тексте,
+# поэтому после экранирования HTML их можно безопасно заменить на <mark>
+SNIPPET_MARK_START = '\x02'
+SNIPPET_MARK_END = '\x03'
+
+def build_fts_query(text):
+    """Превращает пользовательский ввод в запрос FTS5: каждое слово ищется по префиксу,
+    все слова должны присутствовать"""
+    terms = re.findall(r'\w+', text.lower())
+    return ' '.join(f'"{term}"*' for term in terms)
+
+def highlight_snippet(snippet):
+    """Экранирует сниппет и заменяет маркеры совпадений на теги <mark>"""
+    if not snippet:
+        return ''
+    escaped = html.escape(snippet)
+    return escaped.replace(SNIPPET_MARK_START, '<mark>').replace(SNIPPET_MARK_END, '</mark>')
+
+def parse_search_paging(args):
+    """Номер страницы и размер страницы из параметров запроса"""
+    try:
+        page = max(int(args.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    try:
+        per_page = int(args.get('per_page', 50))
+    except ValueError:
+        per_page = 50
+    per_page = min(max(per_page, 1), 200)
+    return page, per_page
+
+def fetch_search_items(c, user_id, kind, ids):
+    """Загружает записи найденных объектов одного типа, возвращает словарь id -> данные"""
+    placeholders = ','.join('?' * len(ids))
+    params = [user_id] + list(ids)
+    items = {}
+
+    if kind == 'file':
+        c.execute(f"""
+        SELECT id, filename, original_filename, category, upload_date, size
+        FROM files WHERE user_id = ? AND id IN ({placeholders})
+        """, params)
+        for row in c.fetchall():
+            items[row[0]] = {
+                'id': row[0],
+                'filename': row[1],
+                'original_name': row[2],
+                'category': row[3],
+                'upload_date': row[4],
+                'size': row[5],
+                'type': 'file'
+            }
+    elif kind == 'link':
+        c.execute(f"""
+        SELECT id, title, url, description, category, add_date
+        FROM links WHERE user_id = ? AND id IN ({placeholders})
+        """, params)
+        for row in c.fetchall():
+            items[row[0]] = {
+                'id': row[0],
+                'title': row[1],
+                'url': row[2],
+                'description': row[3],
+                'category': row[4],
+                'upload_date': row[5],
+                'type': 'link'
+            }
+    elif kind == 'note':
+        c.execute(f"""
+        SELECT id, title, content, create_date, update_date, priority
+        FROM notes WHERE user_id = ? AND id IN ({placeholders})
+        """, params)
+        for row in c.fetchall():
+            items[row[0]] = {
+                'id': row[0],
+                'title': row[1],
+                'content': row[2],
+                'create_date': row[3],
+                'update_date': row[4],
+                'priority': row[5],
+                'type': 'note'
+            }
+    elif kind == 'movie':
+        c.execute(f"""
+        SELECT id, title, original_title, kinopoisk_id, poster_url, year, rating, add_date, watched
+        FROM movies WHERE user_id = ? AND id IN ({placeholders})
+        """, params)
+        for row in c.fetchall():
+            items[row[0]] = {
+                'id': row[0],
+                'title': row[1],
+                'original_title': row[2],
+                'kinopoisk_id': row[3],
+                'poster_url': row[4],
+                'year': row[5],
+                'rating': row[6],
+                'add_date': row[7],
+                'watched': row[8],
+                'type': 'movie'
+            }
+
+    return items
+
+def search_user_content(user_id, text, kinds=None, page=1, per_page=50):
+    """Ранжированный поиск по файлам, ссылкам, заметкам и фильмам пользователя.
+    Возвращает (результаты, есть_ли_следующая_страница)"""
+    kinds = [kind for kind in (kinds or SEARCH_KINDS) if kind in SEARCH_KINDS]
+    fts_query = build_fts_query(text)
+    if not fts_query or not kinds:
+        return [], False
+
+    if not SEARCH_INDEX_ENABLED:
+        return search_user_content_like(user_id, text, kinds, page, per_page)
+
+    conn = get_db()
+    c = conn.cursor()
+
+    kind_placeholders = ','.join('?' * len(kinds))
+    # Заголовок весит больше текста: совпадение в имени файла важнее совпадения в описании
+    c.execute(f"""
+    SELECT kind, item_id,
+           snippet(search_index, 0, ?, ?, '…', 12),
+           snippet(search_index, 1, ?, ?, '…', 16),
+           bm25(search_index, 10.0, 1.0) AS score
+    FROM search_index
+    WHERE search_index MATCH ? AND user_id = ? AND kind IN ({kind_placeholders})
+    ORDER BY score
+    LIMIT ? OFFSET ?
+    """, [SNIPPET_MARK_START, SNIPPET_MARK_END, SNIPPET_MARK_START, SNIPPET_MARK_END,
+          fts_query, user_id] + kinds + [per_page + 1, (page - 1) * per_page])
+    hits = c.fetchall()
+
+    has_more = len(hits) > per_page
+    hits = hits[:per_page]
+
+    # Догружаем сами записи одним запросом на тип
+    ids_by_kind = {}
+    for kind, item_id, _, _, _ in hits:
+        ids_by_kind.setdefault(kind, []).append(item_id)
+    items_by_kind = {kind: fetch_search_items(c, user_id, kind, ids) for kind, ids in ids_by_kind.items()}
+
+    results = []
+    for kind, item_id, title_snippet, body_snippet, score in hits:
+        item = items_by_kind.get(kind, {}).get(item_id)
+        if not item:
+            continue
+        item['snippet'] = highlight_snippet(body_snippet if SNIPPET_MARK_START in (body_snippet or '') else title_snippet)
+        item['title_highlighted'] = highlight_snippet(title_snippet)
+        item['score'] = round(-score, 4)
+        results.append(item)
+
+    return results, has_more
+
+def search_user_content_like(user_id, text, kinds, page, per_page):
+    """Запасной поиск через LIKE для SQLite без FTS5"""
+    conn = get_db()
+    c = conn.cursor()
+    pattern = f'%{text.lower()}%'
+
+    queries = {
+        'file': ("SELECT id FROM files WHERE user_id = ? AND lower(original_filename) LIKE ?", 1),
+        'link': ("SELECT id FROM links WHERE user_id = ? AND (lower(title) LIKE ? OR lower(description) LIKE ?)", 2),
+        'note': ("SELECT id FROM notes WHERE user_id = ? AND (lower(title) LIKE ? OR lower(content) LIKE ?)", 2),
+        'movie': ("SELECT id FROM movies WHERE user_id = ? AND (lower(title) LIKE ? OR lower(original_title) LIKE ?)", 2),
+    }
+
+    matches = []
+    for kind in kinds:
+        query, pattern_count = queries[kind]
+        c.execute(query, [user_id] + [pattern] * pattern_count)
+        matches.extend((kind, row[0]) for row in c.fetchall())
+
+    offset = (page - 1) * per_page
+    page_matches = matches[offset:offset + per_page]
+
+    ids_by_kind = {}
+    for kind, item_id in page_matches:
+        ids_by_kind.setdefault(kind, []).append(item_id)
+    items_by_kind = {kind: fetch_search_items(c, user_id, kind, ids) for kind, ids in ids_by_kind.items()}
+
+    results = [items_by_kind[kind][item_id] for kind, item_id in page_matches
+               if item_id in items_by_kind.get(kind, {})]
+    return results, len(matches) > offset + per_page
 
 @app.route('/search')
 @login_required
 def search():
-    query = request.args.get('q', '').lower()
-    if not query:
+    query = request.args.get('q', '')
+    if not query.strip():
         return jsonify([])
     
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Поиск файлов
-    c.execute("""
-    SELECT * FROM files 
-    WHERE user_id = ? AND lower(original_filename) LIKE ?
-    """, (current_user.id, f'%{query}%'))
-    files = c.fetchall()
-    
-    # Поиск ссылок
-    c.execute("""
-    SELECT * FROM links 
-    WHERE user_id = ? AND (lower(title) LIKE ? OR lower(description) LIKE ?)
-    """, (current_user.id, f'%{query}%', f'%{query}%'))
-    links = c.fetchall()
-    
-    conn.close()
-    
-    results = []
-    
-    for file in files:
-        results.append({
-            'id': file[0],
-            'filename': file[1],
-            'original_name': file[2],
-            'category': file[3],
-            'upload_date': file[4],
-            'size': file[5],
-            'type': 'file'
-        })
+    # По умолчанию ищем только файлы и ссылки, как раньше; заметки и фильмы по запросу
+    kinds = request.args.get('types', 'file,link').split(',')
+    page, per_page = parse_search_paging(request.args)
     
-    for link in links:
-        results.append({
-            'id': link[0],
-            'title': link[1],
-            'url': link[2],
-            'description': link[3],
-            'category': link[4],
-            'upload_date': link[5],
-            'type': 'link'
-        })
+    results, has_more = search_user_content(current_user.id, query, kinds, page, per_page)
     
-    return jsonify(results)
+    response = jsonify(results)
+    response.headers['X-Has-More'] = 'true' if has_more else 'false'
+    return response
+
+def get_user_stats(user_id):
+    """Статистика пользователя из user_stats (одно чтение по первичному ключу)"""
+    rows = get_db().execute("SELECT key, count, size FROM user_stats WHERE user_id = ?", (user_id,)).fetchall()
+    
+    stats = {'files': 0, 'total_size': 0, 'categories': {}, 'notes': 0, 'links': 0, 'movies': 0, 'movies_watched': 0}
+    for key, count, size in rows:
+        if key.startswith('file:'):
+            if count:
+                stats['categories'][key[len('file:'):]] = count
+            stats['files'] += count
+            stats['total_size'] += size
+        else:
+            stats[key] = count
+    return stats
 
 @app.route('/stats')
 @login_required
 def get_stats():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Получаем общее количество файлов и ссылок
-    c.execute("SELECT COUNT(*) FROM files WHERE user_id = ?", (current_user.id,))
-    file_count = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM links WHERE user_id = ?", (current_user.id,))
-    link_count = c.fetchone()[0]
-    
-    # Получаем статистику по категориям
-    c.execute("""
-    SELECT category, COUNT(*) as count 
-    FROM files 
-    WHERE user_id = ? 
-    GROUP BY category
-    """, (current_user.id,))
-    category_stats = {row[0]: row[1] for row in c.fetchall()}
-    
-    # Считаем общий объем хранимых данных
-    c.execute("SELECT SUM(size) FROM files WHERE user_id = ?", (current_user.id,))
-    total_size = c.fetchone()[0] or 0
-    
-    conn.close()
+    stats = get_user_stats(current_user.id)
     
     return jsonify({
-        'file_count': file_count,
-        'link_count': link_count,
-        'category_stats': category_stats,
-        'total_size': total_size
+        'file_count': stats['files'],
+        'link_count': stats['links'],
+        'category_stats': stats['categories'],
+        'total_size': stats['total_size']
     })
 
+@app.route('/stats/http')
+@login_required
+def get_http_stats():
+    """Статистика запросов рабочего процесса к внешним сервисам по хостам (http_client.py)"""
+    return jsonify({'pid': os.getpid(), 'hosts': http_client.snapshot()})
+
 def is_text_file(filename):
     """Определяет, является ли файл текстовым."""
     text_extensions = ['txt', 'md', 'py', 'js', 'html', 'css', 'json', 'xml', 'csv', 
@@ -832,30 +2472,250 @@ def is_text_file(filename):
     ext = filename.rsplit('.', 1)[1].lower() if '.' in filename else ''
     return ext in text_extensions
 
+# Миниатюры для сетки файлов: уменьшенные копии изображений и кадр из видео.
+# Генерируются при первом запросе (и заранее в фоне после загрузки), хранятся
+# в дисковом кэше с вытеснением давно не использовавшихся при превышении лимита
+THUMBNAIL_SIZES = {'small': 160, 'medium': 320, 'large': 640}
+THUMBNAIL_CACHE_FOLDER = app.config.get('THUMBNAIL_CACHE_FOLDER', os.path.join(app.config['UPLOAD_FOLDER'], '.thumbs'))
+THUMBNAIL_CACHE_MAX_BYTES = app.config.get('THUMBNAIL_CACHE_MAX_BYTES', 512 * 1024 * 1024)
+THUMBNAIL_EAGER_SIZE = app.config.get('THUMBNAIL_EAGER_SIZE', 'medium')  # None — только по запросу
+THUMBNAIL_VIDEO_OFFSET = 5  # секунда, с которой ищется характерный кадр видео
+THUMBNAIL_CATEGORIES = ('images', 'videos')
+
+os.makedirs(THUMBNAIL_CACHE_FOLDER, exist_ok=True)
+
+thumbnail_executor = ThreadPoolExecutor(max_workers=app.config.get('THUMBNAIL_WORKERS', 2), thread_name_prefix='thumbnails')
+
+# Блокировки по ключу миниатюры, чтобы одну и ту же миниатюру не строили одновременно несколько потоков
+thumbnail_locks = {}
+thumbnail_locks_guard = threading.Lock()
+
+# Текущий объем кэша; None — еще не подсчитан
+thumbnail_cache_bytes = None
+thumbnail_cache_guard = threading.Lock()
+
+def thumbnail_formats():
+    """Форматы миниатюр в порядке предпочтения, доступные в этой установке"""
+    if Image is None:
+        return ['jpeg']
+    if features.check('webp'):
+        return ['webp', 'jpeg']
+    return ['jpeg']
+
+def negotiate_thumbnail_format():
+    formats = thumbnail_formats()
+    if 'webp' in formats and 'image/webp' in request.headers.get('Accept', ''):
+        return 'webp'
+    return 'jpeg'
+
+def thumbnail_cache_path(file_path, size, fmt):
+    """Путь к миниатюре в кэше. Ключ — inode и время изменения исходного файла, поэтому
+    одинаковые файлы из хранилища по хешу (жесткие ссылки) делят одну миниатюру"""
+    stat = os.stat(file_path)
+    key = f"{stat.st_ino:x}-{stat.st_mtime_ns:x}"
+    return os.path.join(THUMBNAIL_CACHE_FOLDER, key[:2], f"{key}-{size}.{fmt}")
+
+def extract_video_frame(file_path, width, target_path):
+    """Сохраняет характерный кадр видео (фильтр thumbnail ffmpeg) в JPEG шириной width"""
+    ffmpeg = shutil.which('ffmpeg')
+    if not ffmpeg:
+        return False
+    
+    # Для коротких роликов кадра на THUMBNAIL_VIDEO_OFFSET нет, тогда берем с начала
+    for offset in (THUMBNAIL_VIDEO_OFFSET, 0):
+        result = subprocess.run(
+            [ffmpeg, '-v', 'error', '-ss', str(offset), '-i', file_path,
+             '-frames:v', '1', '-vf', f'thumbnail,scale={width}:-2', '-f', 'image2', '-y', target_path],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=60
+        )
+        if result.returncode == 0 and os.path.exists(target_path) and os.path.getsize(target_path) > 0:
+            return True
+    return False
+
+def render_thumbnail(file_path, category, width, fmt, target_path):
+    """Строит миниатюру и атомарно кладет ее в кэш. Возвращает False, если это невозможно"""
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    temp_path = f"{target_path}.{uuid.uuid4().hex}.tmp"
+    
+    try:
+        if category == 'videos':
+            if not extract_video_frame(file_path, width, temp_path):
+                return False
+            if Image is None or fmt == 'jpeg':
+                os.replace(temp_path, target_path)
+                return True
+            file_path = temp_path
+        elif Image is None:
+            return False
+        
+        with Image.open(file_path) as image:
+            # draft позволяет декодеру JPEG сразу читать уменьшенное изображение
+            image.draft('RGB', (width, width))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((width, width), Image.LANCZOS)
+            
+            if fmt == 'webp':
+                if image.mode not in ('RGB', 'RGBA'):
+                    image = image.convert('RGBA' if 'A' in image.getbands() or image.mode == 'P' else 'RGB')
+                image.save(temp_path + '.out', 'WEBP', quality=80, method=4)
+            else:
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                image.save(temp_path + '.out', 'JPEG', quality=85, optimize=True, progressive=True)
+        
+        os.replace(temp_path + '.out', target_path)
+        return True
+    except (OSError, ValueError, subprocess.SubprocessError) as e:
+        print(f"Ошибка при создании миниатюры {file_path}: {str(e)}")
+        return False
+    finally:
+        for path in (temp_path, temp_path + '.out'):
+            if os.path.exists(path):
+                os.remove(path)
+
+def scan_thumbnail_cache():
+    """Все миниатюры кэша: [(время последнего использования, размер, путь)]"""
+    entries = []
+    for root, dirs, files in os.walk(THUMBNAIL_CACHE_FOLDER):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+    return entries
+
+def account_thumbnail(new_path):
+    """Учитывает новую миниатюру и при превышении лимита вытесняет давно не использовавшиеся
+    (кроме только что построенной)"""
+    global thumbnail_cache_bytes
+    
+    with thumbnail_cache_guard:
+        if thumbnail_cache_bytes is None:
+            thumbnail_cache_bytes = sum(entry[1] for entry in scan_thumbnail_cache())
+        else:
+            thumbnail_cache_bytes += os.path.getsize(new_path)
+        
+        if thumbnail_cache_bytes <= THUMBNAIL_CACHE_MAX_BYTES:
+            return
+        
+        # Время изменения файла служит отметкой последнего использования (см. touch в get_thumbnail).
+        # Освобождаем место с запасом, чтобы не сканировать каталог на каждой новой миниатюре
+        entries = scan_thumbnail_cache()
+        entries.sort()
+        total = sum(entry[1] for entry in entries)
+        target = THUMBNAIL_CACHE_MAX_BYTES * 0.9
+        for mtime, entry_size, path in entries:
+            if total <= target:
+                break
+            if path == new_path:
+                continue
+            try:
+                os.remove(path)
+                total -= entry_size
+            except FileNotFoundError:
+                pass
+        thumbnail_cache_bytes = total
+
+def get_thumbnail(file_path, category, size, fmt):
+    """Путь к готовой миниатюре (строит ее при необходимости) или None"""
+    target_path = thumbnail_cache_path(file_path, size, fmt)
+    
+    if os.path.exists(target_path):
+        # Отмечаем использование для LRU-вытеснения
+        try:
+            os.utime(target_path)
+            return target_path
+        except FileNotFoundError:
+            pass
+    
+    with thumbnail_locks_guard:
+        lock = thumbnail_locks.setdefault(target_path, threading.Lock())
+    
+    try:
+        with lock:
+            if os.path.exists(target_path):
+                return target_path
+            if not render_thumbnail(file_path, category, THUMBNAIL_SIZES[size], fmt, target_path):
+                return None
+            account_thumbnail(target_path)
+            return target_path
+    finally:
+        with thumbnail_locks_guard:
+            thumbnail_locks.pop(target_path, None)
+
+def schedule_thumbnail(category, file_path):
+    """Заранее строит миниатюру для сетки в фоновом потоке после загрузки файла"""
+    if not THUMBNAIL_EAGER_SIZE or category not in THUMBNAIL_CATEGORIES:
+        return
+    
+    thumbnail_executor.submit(get_thumbnail, file_path, category, THUMBNAIL_EAGER_SIZE, thumbnail_formats()[0])
+
+@app.route('/thumb/<int:file_id>/<size>')
+@login_required
+def thumbnail(file_id, size):
+    if size not in THUMBNAIL_SIZES:
+        return jsonify({'error': 'Неизвестный размер миниатюры'}), 400
+    
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT filename, category FROM files WHERE id = ? AND user_id = ?", (file_id, current_user.id))
+    file = c.fetchone()
+    
+    if not file or file[1] not in THUMBNAIL_CATEGORIES:
+        return jsonify({'error': 'Файл не найден'}), 404
+    
+    file_path = upload_path(file[1], file[0])
+    if not file_path or not os.path.exists(file_path):
+        return jsonify({'error': 'Файл не найден'}), 404
+    
+    fmt = negotiate_thumbnail_format()
+    # Миниатюру могут вытеснить из кэша между get_thumbnail и отдачей, тогда она строится заново
+    for attempt in range(2):
+        thumb_path = get_thumbnail(file_path, file[1], size, fmt)
+        if not thumb_path:
+            # Без Pillow отдаем само изображение, для видео без ffmpeg миниатюры нет
+            if file[1] == 'images':
+                return send_stored_file(file_path, as_attachment=False)
+            return jsonify({'error': 'Миниатюра недоступна'}), 404
+        
+        response = send_stored_file(thumb_path, as_attachment=False, mimetype=f'image/{fmt}')
+        if isinstance(response, Response):
+            break
+    else:
+        return response
+    
+    response.headers['Vary'] = 'Accept'
+    if request.args.get('v'):
+        # В URL есть версия файла, поэтому содержимое по нему никогда не меняется
+        response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    else:
+        response.headers['Cache-Control'] = 'private, max-age=86400'
+    return response
+
 @app.route('/preview/<category>/<filename>')
 @login_required
 def preview_file(category, filename):
     # Проверяем, принадлежит ли файл текущему пользователю
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM files WHERE filename = ? AND user_id = ?", 
              (filename, current_user.id))
     file = c.fetchone()
-    conn.close()
     
     if not file:
         return jsonify({'error': 'Файл не найден'}), 404
     
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], category, filename)
-    if not os.path.exists(file_path):
+    file_path = upload_path(category, filename)
+    if not file_path or not os.path.exists(file_path):
         return jsonify({'error': 'Файл не найден'}), 404
     
     mime_type, _ = mimetypes.guess_type(file_path)
     
     # Изображения и PDF просто отдаем для отображения в браузере
     if mime_type and (mime_type.startswith('image/') or mime_type == 'application/pdf'):
-        return send_from_directory(os.path.join(app.config['UPLOAD_FOLDER'], category), 
-                                  filename, as_attachment=False)
+        return send_stored_file(file_path, download_name=file[2], as_attachment=False, mimetype=mime_type)
     
     # Для текстовых файлов возвращаем содержимое (не более 100 КБ)
     if is_text_file(filename):
@@ -887,7 +2747,7 @@ def preview_file(category, filename):
 @app.route('/notes')
 @login_required
 def get_notes():
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     c.execute("""
@@ -897,7 +2757,6 @@ def get_notes():
     """, (current_user.id,))
     
     notes = c.fetchall()
-    conn.close()
     
     result = []
     for note in notes:
@@ -925,7 +2784,7 @@ def add_note():
     priority = data.get('priority', 0)
     now = datetime.now().isoformat()
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("""
     INSERT INTO notes (title, content, create_date, update_date, priority, user_id) 
@@ -933,7 +2792,6 @@ def add_note():
     """, (title, content, now, now, priority, current_user.id))
     conn.commit()
     note_id = c.lastrowid
-    conn.close()
     
     return jsonify({
         'success': True, 
@@ -953,7 +2811,7 @@ def update_note(note_id):
     if not data:
         return jsonify({'error': 'Нет данных для обновления'}), 400
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     # Проверяем, принадлежит ли заметка пользователю
@@ -962,7 +2820,6 @@ def update_note(note_id):
     note = c.fetchone()
     
     if not note:
-        conn.close()
         return jsonify({'error': 'Заметка не найдена'}), 404
     
     # Получаем текущие значения
@@ -978,7 +2835,6 @@ def update_note(note_id):
     WHERE id = ?
     """, (title, content, now, priority, note_id))
     conn.commit()
-    conn.close()
     
     return jsonify({
         'success': True,
@@ -992,7 +2848,7 @@ def update_note(note_id):
 @app.route('/delete_note/<int:note_id>')
 @login_required
 def delete_note(note_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     # Проверяем, принадлежит ли заметка пользователю
@@ -1001,13 +2857,11 @@ def delete_note(note_id):
     note = c.fetchone()
     
     if not note:
-        conn.close()
         return jsonify({'error': 'Заметка не найдена'}), 404
     
     # Удаляем заметку
     c.execute("DELETE FROM notes WHERE id = ?", (note_id,))
     conn.commit()
-    conn.close()
     
     return jsonify({'success': True})
 
@@ -1017,7 +2871,7 @@ def delete_note(note_id):
 def get_movies():
     filter_type = request.args.get('filter', 'all')
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     query = "SELECT * FROM movies WHERE user_id = ?"
@@ -1032,7 +2886,6 @@ def get_movies():
     
     c.execute(query, params)
     movies = c.fetchall()
-    conn.close()
     
     result = []
     for movie in movies:
@@ -1087,15 +2940,20 @@ def search_movie():
             'Content-Type': 'application/json',
         }
         
-        url = f"{api_url}?keyword={query}&page=1"
-        print(f"Запрос к API Кинопоиска: {url}")
-        response = requests.get(url, headers=headers)
+        movie_limit = app.config.get('MOVIE_SEARCH_LIMIT', 50)
         
-        if response.status_code == 200:
+        def load():
+            url = f"{api_url}?keyword={urllib.parse.quote(query)}&page=1"
+            print(f"Запрос к API Кинопоиска: {url}")
+            response = http_client.get(url, headers=headers)
+            
+            if response.status_code != 200:
+                print(f"Ошибка API Кинопоиска: {response.status_code} - {response.text}")
+                raise RuntimeError(f'Ошибка API Кинопоиска: {response.status_code}')
+            
             data = response.json()
             results = []
             
-            movie_limit = app.config.get('MOVIE_SEARCH_LIMIT', 50)
             for film in data.get('films', [])[:movie_limit]:  # Используем лимит из конфигурации
                 movie_data = {
                     'kinopoisk_id': str(film.get('filmId')),
@@ -1109,10 +2967,12 @@ def search_movie():
                 }
                 results.append(movie_data)
             
-            return jsonify(results)
-        else:
-            print(f"Ошибка API Кинопоиска: {response.status_code} - {response.text}")
-            return jsonify([])
+            return results
+        
+        # Повторные запросы того же фильма отдаются из кэша, не расходуя квоту API
+        results = result_cache.get_or_load('kinopoisk_search', normalize_key(query, movie_limit), load,
+                                           is_negative=lambda value: not value)
+        return jsonify(results)
             
     except Exception as e:
         print(f"Ошибка при поиске фильма: {str(e)}")
@@ -1135,7 +2995,7 @@ def add_movie():
     genres = data.get('genres', '')
     description = data.get('description', '')
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     # Проверяем, есть ли уже такой фильм у пользователя
@@ -1144,7 +3004,6 @@ def add_movie():
     existing_movie = c.fetchone()
     
     if existing_movie:
-        conn.close()
         return jsonify({'error': 'Этот фильм уже добавлен в вашу коллекцию'}), 400
     
     # Добавляем фильм
@@ -1158,7 +3017,6 @@ def add_movie():
     
     conn.commit()
     movie_id = c.lastrowid
-    conn.close()
     
     return jsonify({
         'success': True,
@@ -1166,11 +3024,23 @@ def add_movie():
         'message': 'Фильм успешно добавлен'
     })
 
+# Зеркала Кинопоиска для просмотра фильмов проверяются в фоне (см. mirrors.py)
+KINOPOISK_MIRRORS = app.config.get('KINOPOISK_MIRRORS') or ['https://kinopoisk.film', 'https://kinopoisk.gold']
+mirror_monitor = MirrorMonitor(
+    [mirror.rstrip('/') for mirror in KINOPOISK_MIRRORS],
+    probe_path=app.config.get('MIRROR_PROBE_PATH', '/'),
+    interval=app.config.get('MIRROR_PROBE_INTERVAL', 60),
+    timeout=app.config.get('MIRROR_PROBE_TIMEOUT', 2),
+    failure_threshold=app.config.get('MIRROR_FAILURE_THRESHOLD', 3),
+    race_candidates=app.config.get('MIRROR_RACE_CANDIDATES', 3),
+    client=http_client
+)
+
 @app.route('/watch_movie/<int:movie_id>')
 @login_required
 def watch_movie(movie_id):
     # Сначала проверяем, что фильм принадлежит пользователю
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     c.execute("SELECT kinopoisk_id FROM movies WHERE id = ? AND user_id = ?", 
@@ -1178,55 +3048,14 @@ def watch_movie(movie_id):
     movie = c.fetchone()
     
     if not movie:
-        conn.close()
         return jsonify({'error': 'Фильм не найден'}), 404
     
     kinopoisk_id = movie[0]
-    conn.close()
-    
-    # Формируем список зеркал для пробы
-    mirrors = app.config.get('KINOPOISK_MIRRORS', [])
-    
-    if not mirrors:
-        # Если зеркала не настроены, используем значения по умолчанию
-        mirrors = ['https://kinopoisk.film', 'https://kinopoisk.gold']
-        print("Зеркала не настроены, используем значения по умолчанию")
-    
-    random.shuffle(mirrors)  # Перемешиваем для равномерного распределения нагрузки
-    
-    # Устанавливаем URL по умолчанию (будет использован, если все зеркала недоступны)
-    redirect_url = f"https://kinopoisk.film/film/{kinopoisk_id}/"
-    
-    # Отключаем проверку SSL сертификата для ускорения проверки зеркал
-    session = requests.Session()
-    session.verify = False
     
-    working_mirrors = []
-    for mirror in mirrors:
-        mirror_url = f"{mirror}/film/{kinopoisk_id}/"
-        try:
-            print(f"Проверка зеркала: {mirror_url}")
-            response = session.head(mirror_url, timeout=2, allow_redirects=False)
-            status = response.status_code
-            
-            # 200, 301, 302 статусы считаем рабочими
-            if status < 400:
-                print(f"Зеркало {mirror} доступно, статус: {status}")
-                working_mirrors.append(mirror_url)
-                
-                # Если нашли рабочее зеркало, сразу устанавливаем его
-                if status == 200:
-                    redirect_url = mirror_url
-                    break
-        except Exception as e:
-            print(f"Ошибка при проверке зеркала {mirror}: {str(e)}")
-            continue
-    
-    # Если нашли хоть одно рабочее зеркало, используем первое
-    if working_mirrors:
-        redirect_url = working_mirrors[0]
+    # Зеркало берется из таблицы фоновой проверки; если все недоступны — первое из списка
+    mirror = mirror_monitor.choose() or mirror_monitor.mirrors[0]
+    redirect_url = f"{mirror}/film/{kinopoisk_id}/"
     
-    print(f"Перенаправление на: {redirect_url}")
     return jsonify({
         'success': True,
         'url': redirect_url
@@ -1235,7 +3064,7 @@ def watch_movie(movie_id):
 @app.route('/toggle_watched/<int:movie_id>')
 @login_required
 def toggle_watched(movie_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     # Проверяем, что фильм принадлежит пользователю
@@ -1244,7 +3073,6 @@ def toggle_watched(movie_id):
     movie = c.fetchone()
     
     if not movie:
-        conn.close()
         return jsonify({'error': 'Фильм не найден'}), 404
     
     # Инвертируем статус "просмотрено"
@@ -1264,7 +3092,6 @@ def toggle_watched(movie_id):
         updated_movie = c.fetchone()
         
         if not updated_movie or updated_movie[0] != new_status:
-            conn.close()
             return jsonify({
                 'success': False,
                 'error': 'Не удалось обновить статус фильма'
@@ -1274,7 +3101,6 @@ def toggle_watched(movie_id):
         
         print(f"Фильм с ID {movie_id} отмечен как {status_text}")
         
-        conn.close()
         return jsonify({
             'success': True,
             'watched': new_status,
@@ -1282,7 +3108,6 @@ def toggle_watched(movie_id):
         })
     except Exception as e:
         conn.rollback()
-        conn.close()
         print(f"Ошибка при обновлении статуса фильма: {str(e)}")
         return jsonify({
             'success': False,
@@ -1292,7 +3117,7 @@ def toggle_watched(movie_id):
 @app.route('/delete_movie/<int:movie_id>')
 @login_required
 def delete_movie(movie_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     # Проверяем, что фильм принадлежит пользователю
@@ -1301,12 +3126,10 @@ def delete_movie(movie_id):
     movie = c.fetchone()
     
     if not movie:
-        conn.close()
         return jsonify({'error': 'Фильм не найден'}), 404
     
     c.execute("DELETE FROM movies WHERE id = ?", (movie_id,))
     conn.commit()
-    conn.close()
     
     return jsonify({
         'success': True,
@@ -1331,642 +3154,166 @@ def add_movie_by_id(movie_id):
             'Content-Type': 'application/json',
         }
         
-        url = f"{film_api_url}{movie_id}"
-        print(f"Запрос к API Кинопоиска для получения информации о фильме: {url}")
-        response = requests.get(url, headers=headers)
-        
-        if response.status_code == 200:
-            film = response.json()
-            
-            # Преобразуем полученные данные для добавления в БД
-            kinopoisk_id = str(film.get('kinopoiskId') or film.get('filmId') or movie_id)
-            title = film.get('nameRu', 'Без названия')
-            original_title = film.get('nameEn', '') or film.get('nameOriginal', '')
-            poster_url = film.get('posterUrl', '')
-            year = film.get('year', 0)
-            rating = film.get('ratingKinopoisk', 0) or film.get('rating', 0) or 0
-            genres = ', '.join([genre.get('genre', '') for genre in film.get('genres', [])])
-            description = film.get('description', '')
-            
-            # Проверяем, есть ли уже такой фильм у пользователя
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            
-            c.execute("SELECT id FROM movies WHERE kinopoisk_id = ? AND user_id = ?", 
-                     (kinopoisk_id, current_user.id))
-            existing_movie = c.fetchone()
-            
-            if existing_movie:
-                conn.close()
-                return jsonify({'error': 'Этот фильм уже добавлен в вашу коллекцию'}), 400
+        def load():
+            url = f"{film_api_url}{movie_id}"
+            print(f"Запрос к API Кинопоиска для получения информации о фильме: {url}")
+            response = http_client.get(url, headers=headers)
             
-            # Добавляем фильм
-            c.execute("""
-            INSERT INTO movies 
-            (title, original_title, kinopoisk_id, poster_url, year, rating, genres, 
-            description, add_date, watched, user_id) 
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (title, original_title, kinopoisk_id, poster_url, year, rating, genres,
-                 description, datetime.now().isoformat(), 0, current_user.id))
-            
-            conn.commit()
-            movie_id = c.lastrowid
-            conn.close()
-            
-            return jsonify({
-                'success': True,
-                'id': movie_id,
-                'message': 'Фильм успешно добавлен'
-            })
-        else:
-            print(f"Ошибка API Кинопоиска: {response.status_code} - {response.text}")
-            return jsonify({'error': f'Ошибка API Кинопоиска: {response.status_code}'}), 500
+            if response.status_code != 200:
+                print(f"Ошибка API Кинопоиска: {response.status_code} - {response.text}")
+                raise RuntimeError(f'Ошибка API Кинопоиска: {response.status_code}')
+            return response.json()
+        
+        try:
+            film = result_cache.get_or_load('kinopoisk_film', normalize_key(movie_id), load)
+        except (RuntimeError, CachedFailure) as e:
+            return jsonify({'error': str(e)}), 500
+        
+        # Преобразуем полученные данные для добавления в БД
+        kinopoisk_id = str(film.get('kinopoiskId') or film.get('filmId') or movie_id)
+        title = film.get('nameRu', 'Без названия')
+        original_title = film.get('nameEn', '') or film.get('nameOriginal', '')
+        poster_url = film.get('posterUrl', '')
+        year = film.get('year', 0)
+        rating = film.get('ratingKinopoisk', 0) or film.get('rating', 0) or 0
+        genres = ', '.join([genre.get('genre', '') for genre in film.get('genres', [])])
+        description = film.get('description', '')
+        
+        # Проверяем, есть ли уже такой фильм у пользователя
+        conn = get_db()
+        c = conn.cursor()
+        
+        c.execute("SELECT id FROM movies WHERE kinopoisk_id = ? AND user_id = ?", 
+                 (kinopoisk_id, current_user.id))
+        existing_movie = c.fetchone()
+        
+        if existing_movie:
+            return jsonify({'error': 'Этот фильм уже добавлен в вашу коллекцию'}), 400
+        
+        # Добавляем фильм
+        c.execute("""
+        INSERT INTO movies 
+        (title, original_title, kinopoisk_id, poster_url, year, rating, genres, 
+        description, add_date, watched, user_id) 
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (title, original_title, kinopoisk_id, poster_url, year, rating, genres,
+             description, datetime.now().isoformat(), 0, current_user.id))
+        
+        conn.commit()
+        movie_id = c.lastrowid
+        
+        return jsonify({
+            'success': True,
+            'id': movie_id,
+            'message': 'Фильм успешно добавлен'
+        })
             
     except Exception as e:
         print(f"Ошибка при добавлении фильма: {str(e)}")
         return jsonify({'error': f'Ошибка при добавлении фильма: {str(e)}'}), 500
 
+# Поиск торрентов: провайдеры из trackers.py опрашиваются параллельно с общим дедлайном
+TORRENT_SEARCH_DEADLINE = app.config.get('TORRENT_SEARCH_DEADLINE', 12)  # секунд на весь поиск
+TORRENT_SEARCH_LIMIT = app.config.get('TORRENT_SEARCH_LIMIT', 30)  # лучших раздач в ответе
+trackers.configure(app.config.get('TORRENT_SEARCH_WORKERS', 16), result_cache, http_client)
+
+def torrent_fallback_trackers():
+    """Трекеры из конфигурации для ссылок на ручной поиск"""
+    trackers_config = app.config.get('TORRENT_TRACKERS', [])
+    
+    if not trackers_config:
+        # Если трекеры не настроены, используем значения по умолчанию
+        trackers_config = [
+            {'name': 'The Pirate Bay', 'search_url': 'https://thepiratebay.org/search/{query}/0/99/0'},
+            {'name': 'RARBG', 'search_url': 'https://rarbgprx.org/torrents.php?search={query}'},
+            {'name': 'RuTracker', 'search_url': 'https://rutracker.org/forum/tracker.php?nm={query}'},
+            {'name': 'Kinozal', 'search_url': 'https://kinozal.tv/browse.php?s={query}'}
+        ]
+    return trackers_config
+
+def finish_torrent_search(ctx, results):
+    """Итоговый список: повторы объединены, лучшие раздачи по оценке и запасные ссылки,
+    если торрентов найдено слишком мало"""
+    results = trackers.rank_results(results, ctx, TORRENT_SEARCH_LIMIT)
+    query = ctx['search_queries'][0] if ctx['search_queries'] else ''
+    if len(results) < 3 and query:
+        results = results + trackers.fallback_links(query, torrent_fallback_trackers())
+    return results
+
+def wants_stream():
+    """Клиент просит отдавать результаты по мере готовности (NDJSON или SSE)"""
+    if request.args.get('stream') in ('ndjson', 'sse'):
+        return request.args['stream']
+    accept = request.headers.get('Accept', '')
+    if 'application/x-ndjson' in accept:
+        return 'ndjson'
+    if 'text/event-stream' in accept:
+        return 'sse'
+    return None
+
 @app.route('/search_torrents/<int:movie_id>')
 @login_required
 def search_torrents(movie_id):
     """Поиск торрентов для конкретного фильма"""
     # Получаем информацию о фильме из БД
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     c.execute("SELECT title, original_title, year FROM movies WHERE id = ? AND user_id = ?", 
              (movie_id, current_user.id))
     movie = c.fetchone()
-    conn.close()
     
     if not movie:
         return jsonify({'error': 'Фильм не найден'}), 404
     
-    title_ru = movie[0]
-    title_en = movie[1]
-    year = movie[2]
-    
-    # Создаем различные варианты поисковых запросов для улучшения результатов
-    search_queries = []
-    
-    # Получаем очищенные названия (без специальных символов)
-    def clean_title(title):
-        if not title:
-            return ""
-        # Удаляем специальные символы, которые могут мешать поиску
-        cleaned = re.sub(r'[^\w\s]', ' ', title)
-        # Удаляем лишние пробелы
-        cleaned = re.sub(r'\s+', ' ', cleaned).strip()
-        return cleaned
-    
-    clean_title_ru = clean_title(title_ru)
-    clean_title_en = clean_title(title_en)
-    
-    # Добавляем запросы в порядке приоритета
-    if title_en:
-        search_queries.append(f"{title_en} {year}")  # Оригинальное название + год
-        search_queries.append(clean_title_en + f" {year}")  # Очищенное название + год
-    
-    if title_ru and title_ru != title_en:  # Если есть русское название и оно отличается от английского
-        search_queries.append(f"{title_ru} {year}")  # Русское название + год
-        search_queries.append(clean_title_ru + f" {year}")  # Очищенное русское название + год
-    
-    # Добавляем запросы без года как запасные варианты
-    if title_en:
-        search_queries.append(title_en)
-    if title_ru and title_ru != title_en:
-        search_queries.append(title_ru)
-    
-    # Удаляем дубликаты, сохраняя порядок
-    search_queries = list(dict.fromkeys(search_queries))
-    
-    print(f"Поисковые запросы для фильма '{title_ru or title_en}': {search_queries}")
-    
-    # Получаем список трекеров из конфигурации
-    trackers = app.config.get('TORRENT_TRACKERS', [])
-    
-    if not trackers:
-        # Если трекеры не настроены, используем значения по умолчанию
-        trackers = [
-            {'name': 'The Pirate Bay', 'search_url': 'https://thepiratebay.org/search/{query}/0/99/0'},
-            {'name': 'RARBG', 'search_url': 'https://rarbgprx.org/torrents.php?search={query}'},
-            {'name': 'RuTracker', 'search_url': 'https://rutracker.org/forum/tracker.php?nm={query}'},
-            {'name': 'Kinozal', 'search_url': 'https://kinozal.tv/browse.php?s={query}'}
-        ]
-    
-    results = []
-    
-    # Создаем сессию для запросов
-    session = requests.Session()
-    session.headers.update({
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    })
-    
-    # Устанавливаем таймаут для запросов
-    request_timeout = 5  # секунд
-    
-    # 1. Поиск на Rutor (русские и зарубежные фильмы)
-    try:
-        for query in search_queries[:2]:  # Используем только первые два запроса
-            rutor_search_url = f"http://rutor.info/search/{urllib.parse.quote(query)}"
-            try:
-                response = session.get(rutor_search_url, timeout=request_timeout)
-                if response.status_code == 200:
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    
-                    # Находим таблицу с результатами
-                    result_table = soup.select_one('#index')
-                    if result_table:
-                        rows = result_table.select('tr:not(:first-child)')
-                        
-                        for row in rows[:10]:  # Берем только первые 10 результатов
-                            try:
-                                cells = row.select('td')
-                                if len(cells) >= 4:
-                                    name_cell = cells[1]
-                                    size_cell = cells[3]
-                                    seeds_cell = cells[4]
-                                    leech_cell = cells[5]
-                                    
-                                    # Ссылка на торрент
-                                    magnet_link = name_cell.select_one('a[href^="magnet:"]')
-                                    torrent_link = name_cell.select_one('a.downgif')
-                                    
-                                    # Название торрента (берем из тега b, который содержит название)
-                                    name_tag = name_cell.select_one('a:not([href^="magnet:"])')
-                                    if not name_tag:
-                                        continue
-                                    
-                                    torrent_name = name_tag.get_text(strip=True)
-                                    
-                                    # Проверяем соответствие запросу по году
-                                    if year and str(year) not in torrent_name and re.search(r'\(\d{4}\)', torrent_name) and not re.search(fr'\({year}\)', torrent_name):
-                                        continue
-                                    
-                                    # Проверяем, чтобы название содержало как минимум часть запроса
-                                    query_parts = query.lower().split()
-                                    torrent_name_lower = torrent_name.lower()
-                                    
-                                    if not any(part in torrent_name_lower for part in query_parts if len(part) > 2):
-                                        continue
-                                    
-                                    # URL для деталей
-                                    detail_url = "http://rutor.info" + name_tag['href'] if name_tag and name_tag.has_attr('href') else None
-                                    
-                                    # Определяем качество из названия
-                                    quality = "Unknown"
-                                    quality_patterns = [
-                                        '4K', '2160p', '1080p', '720p', 'BDRip', 'HDRip', 'WEB-DL', 
-                                        'BluRay', 'HDTV', 'DVD', 'DVDRip', 'UHD', 'HDR'
-                                    ]
-                                    for pattern in quality_patterns:
-                                        if pattern in torrent_name:
-                                            quality = pattern
-                                            break
-                                    
-                                    size = size_cell.get_text(strip=True) if size_cell else "Unknown"
-                                    seeds = seeds_cell.get_text(strip=True) if seeds_cell else "0"
-                                    leeches = leech_cell.get_text(strip=True) if leech_cell else "0"
-                                    
-                                    # URL для использования в приложении (магнет или страница с деталями)
-                                    url = magnet_link['href'] if magnet_link else (detail_url if detail_url else "")
-                                    
-                                    results.append({
-                                        'name': torrent_name,
-                                        'url': url,
-                                        'size': size,
-                                        'quality': quality,
-                                        'seeds': seeds,
-                                        'leech': leeches,
-                                        'engine': 'Rutor',
-                                        'magnet': magnet_link['href'] if magnet_link else None,
-                                        'torrent': "http://rutor.info" + torrent_link['href'] if torrent_link and torrent_link.has_attr('href') else None
-                                    })
-                            except Exception as e:
-                                print(f"Ошибка при разборе результата Rutor: {str(e)}")
-                                continue
-                        
-                        # Если нашли хотя бы 3 результата, можно прекратить поиск на данном трекере
-                        if len([r for r in results if r['engine'] == 'Rutor']) >= 3:
-                            break
-            except Exception as e:
-                print(f"Ошибка при поиске на Rutor: {str(e)}")
-    except Exception as e:
-        print(f"Общая ошибка при работе с Rutor: {str(e)}")
-    
-    # 2. Поиск на YTS/YIFY через API (хорошо для иностранных фильмов)
-    try:
-        for query in search_queries[:2]:  # Используем только первые два запроса для YTS
-            yts_api_url = f"https://yts.mx/api/v2/list_movies.json?query_term={urllib.parse.quote(query)}&limit=10&sort=seeds"
-            try:
-                yts_response = session.get(yts_api_url, timeout=request_timeout)
-                
-                if yts_response.status_code == 200:
-                    yts_data = yts_response.json()
-                    if yts_data.get('status') == 'ok' and yts_data.get('data', {}).get('movie_count', 0) > 0:
-                        for movie_data in yts_data.get('data', {}).get('movies', []):
-                            movie_title = movie_data.get('title_long', '')
-                            movie_year = movie_data.get('year', 0)
-                            
-                            # Проверяем соответствие года (если указан)
-                            if year and abs(int(movie_year) - year) > 1:
-                                continue
-                                
-                            for torrent in movie_data.get('torrents', []):
-                                quality = torrent.get('quality', 'Unknown')
-                                size = torrent.get('size', 'Unknown')
-                                seeds = torrent.get('seeds', 0)
-                                peers = torrent.get('peers', 0)
-                                torrent_url = torrent.get('url', '')
-                                
-                                if torrent_url:
-                                    torrent_name = f"{movie_title} [{quality}]"
-                                    results.append({
-                                        'name': torrent_name,
-                                        'url': torrent_url,
-                                        'size': size,
-                                        'quality': quality,
-                                        'seeds': seeds,
-                                        'leech': peers,
-                                        'engine': 'YTS/YIFY',
-                                        'torrent': torrent_url,
-                                        'magnet': None  # YTS дает только .torrent файлы
-                                    })
-                        
-                        # Если нашли результаты, переходим к следующему источнику
-                        if len([r for r in results if r['engine'] == 'YTS/YIFY']) > 0:
-                            break
-            except Exception as e:
-                print(f"Ошибка при поиске YTS: {str(e)}")
-    except Exception as e:
-        print(f"Общая ошибка при поиске на YTS: {str(e)}")
-    
-    # 3. Поиск на 1337x через скрапинг
-    try:
-        for query in search_queries:
-            # Сначала пробуем основной домен
-            domains = ['https://1337x.to', 'https://1337x.st', 'https://1337x.is']
-            
-            for domain in domains:
-                try:
-                    search_url = f"{domain}/search/{urllib.parse.quote(query)}/1/"
-                    response = session.get(search_url, timeout=request_timeout)
-                    
-                    if response.status_code == 200:
-                        soup = BeautifulSoup(response.text, 'html.parser')
-                        
-                        # Находим все строки таблицы с результатами
-                        rows = soup.select('table.table-list tbody tr')
-                        
-                        if rows:
-                            for row in rows[:10]:  # Ограничиваем до 10 результатов
-                                try:
-                                    name_cell = row.select_one('td.name')
-                                    if name_cell:
-                                        torrent_name = name_cell.select_one('a:nth-child(2)').text.strip()
-                                        torrent_link = name_cell.select_one('a:nth-child(2)')['href']
-                                        
-                                        # Проверка соответствия запросу
-                                        query_parts = query.lower().split()
-                                        torrent_name_lower = torrent_name.lower()
-                                        
-                                        # Проверяем наличие ключевых слов из запроса в названии
-                                        if not any(part in torrent_name_lower for part in query_parts if len(part) > 2):
-                                            continue
-                                        
-                                        # Проверяем год, если он указан в запросе
-                                        if year and str(year) not in torrent_name and re.search(r'\d{4}', torrent_name) and not re.search(fr'{year}', torrent_name):
-                                            continue
-                                        
-                                        # Информация о размере и сидах/личах
-                                        size = row.select_one('td.size').get_text(strip=True)
-                                        seeds = row.select_one('td.seeds').get_text(strip=True)
-                                        leeches = row.select_one('td.leeches').get_text(strip=True)
-                                        
-                                        # Определяем качество видео из названия
-                                        quality = "Unknown"
-                                        quality_patterns = [
-                                            '4K', '2160p', '1080p', '720p', 'BDRip', 'HDRip', 'WEB-DL', 
-                                            'BluRay', 'HDTV', 'DVD', 'DVDRip', 'UHD', 'HDR'
-                                        ]
-                                        for pattern in quality_patterns:
-                                            if pattern in torrent_name:
-                                                quality = pattern
-                                                break
-                                        
-                                        # Формируем ссылку на детальную страницу торрента
-                                        detail_url = f"{domain}{torrent_link}"
-                                        
-                                        results.append({
-                                            'name': torrent_name,
-                                            'url': detail_url,
-                                            'size': size,
-                                            'quality': quality,
-                                            'seeds': seeds,
-                                            'leech': leeches,
-                                            'engine': '1337x',
-                                            'magnet': None,  # Будет получено по запросу
-                                            'torrent': None  # Будет получено по запросу
-                                        })
-                                except Exception as e:
-                                    print(f"Ошибка при парсинге результата 1337x: {str(e)}")
-                                    continue
-                            
-                            # Если нашли хотя бы 3 результата, прекращаем поиск на этом трекере
-                            if len([r for r in results if r['engine'] == '1337x']) >= 3:
-                                break
-                except Exception as e:
-                    print(f"Ошибка при доступе к домену 1337x {domain}: {str(e)}")
-                    continue
-            
-            # Если нашли результаты для текущего запроса, переходим к следующему трекеру
-            if len([r for r in results if r['engine'] == '1337x']) > 0:
-                break
-    except Exception as e:
-        print(f"Общая ошибка при поиске на 1337x: {str(e)}")
-    
-    # 4. Для русских фильмов особенно полезен RuTracker
-    if title_ru:
-        try:
-            query = title_ru
-            if year:
-                query += f" {year}"
-            
-            # RuTracker использует POST-запрос для поиска
-            rutracker_search_url = 'https://rutracker.org/forum/tracker.php'
-            form_data = {'nm': query}
-            
-            try:
-                rutracker_response = session.post(rutracker_search_url, data=form_data, timeout=request_timeout)
-                
-                if rutracker_response.status_code == 200:
-                    soup = BeautifulSoup(rutracker_response.text, 'html.parser')
-                    
-                    # Найдем все строки таблицы с результатами
-                    rows = soup.select('table.forumline tr.hl-tr')
-                    
-                    for row in rows[:7]:  # Ограничиваем до 7 результатов
-                        try:
-                            title_cell = row.select_one('td.t-title')
-                            if title_cell:
-                                torrent_name = title_cell.select_one('a').text.strip()
-                                torrent_link = title_cell.select_one('a')['href']
-                                
-                                # Проверяем название на соответствие запросу
-                                title_parts = [clean_title_ru, clean_title_en]
-                                title_parts = [p.lower() for p in title_parts if p]
-                                
-                                if not any(part in torrent_name.lower() for part in title_parts if part):
-                                    continue
-                                
-                                # Проверяем год, если он указан
-                                if year and str(year) not in torrent_name and re.search(r'\d{4}', torrent_name) and not re.search(fr'{year}', torrent_name):
-                                    continue
-                                
-                                # Получаем сиды и личи
-                                seeds = row.select_one('td.seedmed b').text.strip() if row.select_one('td.seedmed b') else '0'
-                                leeches = row.select_one('td.leechmed b').text.strip() if row.select_one('td.leechmed b') else '0'
-                                
-                                # Получаем размер
-                                size_cell = row.select_one('td.tor-size')
-                                size = size_cell.get_text(strip=True) if size_cell else 'Unknown'
-                                
-                                # Определяем качество из названия
-                                quality = "Unknown"
-                                quality_patterns = [
-                                    '4K', '2160p', '1080p', '720p', 'BDRip', 'HDRip', 'WEB-DL', 
-                                    'BluRay', 'HDTV', 'DVD', 'DVDRip', 'UHD', 'HDR'
-                                ]
-                                for pattern in quality_patterns:
-                                    if pattern in torrent_name:
-                                        quality = pattern
-                                        break
-                                
-                                # Формируем ссылку на страницу с торрентом
-                                if not torrent_link.startswith('http'):
-                                    torrent_link = f"https://rutracker.org/forum/{torrent_link}"
-                                
-                                results.append({
-                                    'name': torrent_name,
-                                    'url': torrent_link,
-                                    'size': size,
-                                    'quality': quality,
-                                    'seeds': seeds,
-                                    'leech': leeches,
-                                    'engine': 'RuTracker',
-                                    'magnet': None,  # Будет получено по запросу
-                                    'torrent': None  # Будет получено по запросу
-                                })
-                        except Exception as e:
-                            print(f"Ошибка при парсинге результата RuTracker: {str(e)}")
-                            continue
-            except Exception as e:
-                print(f"Ошибка запроса к RuTracker: {str(e)}")
-        except Exception as e:
-            print(f"Общая ошибка при поиске на RuTracker: {str(e)}")
+    ctx = trackers.build_search_context(movie[0], movie[1], movie[2], time.monotonic() + TORRENT_SEARCH_DEADLINE)
+    query = ctx['search_queries'][0] if ctx['search_queries'] else ''
     
-    # 5. Kinozal для русских релизов
-    if title_ru:
-        try:
-            query = title_ru
-            if year:
-                query += f" {year}"
-            
-            kinozal_search_url = 'https://kinozal.tv/browse.php'
-            params = {'s': query}
-            
-            try:
-                kinozal_response = session.get(kinozal_search_url, params=params, timeout=request_timeout)
-                
-                if kinozal_response.status_code == 200:
-                    soup = BeautifulSoup(kinozal_response.text, 'html.parser')
-                    
-                    # Находим таблицу результатов
-                    rows = soup.select('table.t_peer.w100p tr:not(.bg)')
-                    
-                    for row in rows[:7]:  # Ограничиваем до 7 результатов
-                        try:
-                            cells = row.select('td')
-                            if len(cells) >= 5:
-                                name_cell = cells[1]
-                                size_cell = cells[3]
-                                seeds_cell = cells[4]
-                                
-                                link = name_cell.select_one('a')
-                                if not link:
-                                    continue
-                                
-                                torrent_name = link.get_text(strip=True)
-                                detail_url = 'https://kinozal.tv' + link['href'] if link.has_attr('href') else None
-                                
-                                # Проверяем соответствие запросу
-                                if not any(part.lower() in torrent_name.lower() for part in [title_ru, title_en] if part):
-                                    continue
-                                
-                                # Проверяем год, если он указан
-                                if year and str(year) not in torrent_name and re.search(r'\d{4}', torrent_name) and not re.search(fr'{year}', torrent_name):
-                                    continue
-                                
-                                # Извлекаем размер и сиды
-                                size = size_cell.get_text(strip=True) if size_cell else 'Unknown'
-                                seeds = ''.join(filter(str.isdigit, seeds_cell.get_text(strip=True) if seeds_cell else '0'))
-                                
-                                # Определяем качество из названия
-                                quality = "Unknown"
-                                quality_patterns = [
-                                    '4K', '2160p', '1080p', '720p', 'BDRip', 'HDRip', 'WEB-DL', 
-                                    'BluRay', 'HDTV', 'DVD', 'DVDRip', 'UHD', 'HDR'
-                                ]
-                                for pattern in quality_patterns:
-                                    if pattern in torrent_name:
-                                        quality = pattern
-                                        break
-                                
-                                results.append({
-                                    'name': torrent_name,
-                                    'url': detail_url,
-                                    'size': size,
-                                    'quality': quality,
-                                    'seeds': seeds,
-                                    'leech': '0',  # Kinozal не показывает личей в результатах поиска
-                                    'engine': 'Kinozal',
-                                    'magnet': None,  # Требуется регистрация
-                                    'torrent': None   # Требуется регистрация
-                                })
-                        except Exception as e:
-                            print(f"Ошибка при парсинге результата Kinozal: {str(e)}")
-                            continue
-            except Exception as e:
-                print(f"Ошибка запроса к Kinozal: {str(e)}")
-        except Exception as e:
-            print(f"Общая ошибка при поиске на Kinozal: {str(e)}")
+    print(f"Поисковые запросы для фильма '{movie[0] or movie[1]}': {ctx['search_queries']}")
     
-    # 6. Если это сериал, попробуем EZTV
-    is_series = any(word in (title_en or "").lower() + (title_ru or "").lower() for word in ['season', 'series', 'episode', 'сезон', 'серия', 'эпизод'])
-    if is_series or (not results and 'season' in search_queries[0].lower()):
-        try:
-            eztv_search_url = f"https://eztv.re/search/{urllib.parse.quote(search_queries[0])}"
-            try:
-                eztv_response = session.get(eztv_search_url, timeout=request_timeout)
-                
-                if eztv_response.status_code == 200:
-                    soup = BeautifulSoup(eztv_response.text, 'html.parser')
-                    
-                    rows = soup.select('table tr.forum_header_border')
-                    
-                    for row in rows[:10]:  # Ограничиваем до 10 результатов
-                        try:
-                            title_element = row.select_one('td.forum_thread_post a.epinfo')
-                            if title_element:
-                                torrent_name = title_element.text.strip()
-                                
-                                # Проверка соответствия запросу
-                                words_in_query = [word.lower() for word in search_queries[0].split()]
-                                if not any(word in torrent_name.lower() for word in words_in_query if len(word) > 2):
-                                    continue
-                                
-                                # Ссылка на магнет в третьей ячейке
-                                magnet_element = row.select_one('td:nth-child(3) a')
-                                if magnet_element and 'magnet:' in magnet_element.get('href', ''):
-                                    magnet_url = magnet_element.get('href')
-                                    
-                                    # Получаем размер и сиды/личи
-                                    size = row.select_one('td:nth-child(4)').get_text(strip=True) if row.select_one('td:nth-child(4)') else 'Unknown'
-                                    seeds = row.select_one('td:nth-child(6)').get_text(strip=True) if row.select_one('td:nth-child(6)') else '0'
-                                    
-                                    # Определяем качество видео из названия
-                                    quality = "Unknown"
-                                    quality_patterns = [
-                                        '4K', '2160p', '1080p', '720p', 'BDRip', 'HDRip', 'WEB-DL', 
-                                        'BluRay', 'HDTV', 'DVD', 'DVDRip', 'UHD', 'HDR'
-                                    ]
-                                    for pattern in quality_patterns:
-                                        if pattern in torrent_name:
-                                            quality = pattern
-                                            break
-                                    
-                                    # Добавляем торрент в результаты
-                                    results.append({
-                                        'name': torrent_name,
-                                        'url': magnet_url,
-                                        'size': size,
-                                        'quality': quality,
-                                        'seeds': seeds,
-                                        'leech': '0',  # EZTV не показывает личей
-                                        'engine': 'EZTV',
-                                        'magnet': magnet_url,
-                                        'torrent': None
-                                    })
-                        except Exception as e:
-                            print(f"Ошибка при парсинге результата EZTV: {str(e)}")
-                            continue
-            except Exception as e:
-                print(f"Ошибка при запросе к EZTV: {str(e)}")
-        except Exception as e:
-            print(f"Общая ошибка при поиске на EZTV: {str(e)}")
-    
-    # Если после всех попыток торренты не найдены или их слишком мало, добавляем ссылки на поисковые системы
-    if len(results) < 3:
-        # Безопасные поисковые системы, которые можно использовать как запасной вариант
-        search_engines = [
-            {'name': 'Google', 'url': f'https://www.google.com/search?q={urllib.parse.quote(search_queries[0])}+torrent'},
-            {'name': 'Yandex', 'url': f'https://yandex.ru/search/?text={urllib.parse.quote(search_queries[0])}+torrent'},
-            {'name': 'DuckDuckGo', 'url': f'https://duckduckgo.com/?q={urllib.parse.quote(search_queries[0])}+torrent'}
-        ]
+    stream = wants_stream()
+    if not stream:
+        results = []
+        for provider_result in trackers.search_providers(ctx):
+            results.extend(provider_result['results'])
         
-        for engine in search_engines:
-            results.append({
-                'name': f'Поиск в {engine["name"]}: {search_queries[0]}',
-                'url': engine['url'],
-                'size': 'N/A',
-                'quality': 'N/A',
-                'seeds': 'N/A',
-                'leech': 'N/A',
-                'engine': engine['name'],
-                'magnet': None,
-                'torrent': None
-            })
-        
-        # Добавляем прямые ссылки на трекеры с безопасным поиском
-        for tracker in trackers:
-            query_url = tracker['search_url'].format(query=urllib.parse.quote(search_queries[0]))
-            results.append({
-                'name': f'Поиск на {tracker["name"]}: {search_queries[0]}',
-                'url': query_url,
-                'size': 'N/A',
-                'quality': 'N/A',
-                'seeds': 'N/A',
-                'leech': 'N/A',
-                'engine': tracker['name'],
-                'magnet': None,
-                'torrent': None
-            })
-    
-    # Сортируем результаты по количеству сидов (если они есть)
-    # Исправленная версия сортировки, которая правильно обрабатывает разные типы данных
-    def get_seeds_value(item):
-        seeds = item.get('seeds', 0)
-        if isinstance(seeds, int):
-            return seeds
-        elif isinstance(seeds, str) and seeds.isdigit():
-            return int(seeds)
-        return 0
-    
-    # Сначала вывести настоящие торренты, затем поисковые запросы
-    proper_torrents = [item for item in results if item.get('seeds') != 'N/A']
-    search_links = [item for item in results if item.get('seeds') == 'N/A']
+        return jsonify({
+            'success': True,
+            'query': query,
+            'results': finish_torrent_search(ctx, results)
+        })
     
-    # Сортируем настоящие торренты по количеству сидов
-    proper_torrents.sort(key=get_seeds_value, reverse=True)
+    def format_event(event):
+        if stream == 'sse':
+            return f"event: {event['type']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        return json.dumps(event, ensure_ascii=False) + "\n"
     
-    # Объединяем отсортированные торренты и поисковые запросы
-    results = proper_torrents + search_links
+    def generate():
+        # Каждый провайдер отдается отдельным событием сразу, как только ответил
+        results = []
+        for provider_result in trackers.search_providers(ctx):
+            results.extend(provider_result['results'])
+            yield format_event({'type': 'provider', **provider_result})
+        
+        yield format_event({
+            'type': 'done',
+            'success': True,
+            'query': query,
+            'results': finish_torrent_search(ctx, results)
+        })
     
-    return jsonify({
-        'success': True,
-        'query': search_queries[0],
-        'results': results
-    })
+    mimetype = 'text/event-stream' if stream == 'sse' else 'application/x-ndjson'
+    # X-Accel-Buffering отключает буферизацию nginx, иначе события придут одной пачкой
+    return Response(generate(), mimetype=mimetype, headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Запросы к страницам раздач для get_torrent_link (см. trackers.parse_html)
+MAGNET_LINKS = etree.XPath('//a[starts-with(@href, "magnet:")]')
+DOWNLOAD_BUTTON_LINKS = etree.XPath(f'//a[{trackers.has_class("btn-download")}]')
+RUTRACKER_DOWNLOAD_LINKS = etree.XPath(f'//a[{trackers.has_class("dl-stub")} or {trackers.has_class("dl-link")}]')
+TORRENT_FILE_LINKS = etree.XPath(
+    '//a[substring(@href, string-length(@href) - 7) = ".torrent"'
+    f' or {trackers.has_class("torrent-download-link")} or {trackers.has_class("dl-link")} or {trackers.has_class("download")}]'
+)
 
 @app.route('/get_torrent_link')
 @login_required
@@ -1979,11 +3326,8 @@ def get_torrent_link():
         return jsonify({'error': 'URL не указан'}), 400
     
     try:
-        # Создаем сессию для запросов с пользовательским агентом
-        session = requests.Session()
-        session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        })
+        # Сессия с общим пулом соединений и пользовательским агентом браузера
+        session = http_client.session()
         
         result = {
             'success': True,
@@ -2003,13 +3347,10 @@ def get_torrent_link():
             response = session.get(url, timeout=5)
             
             if response.status_code == 200:
-                soup = BeautifulSoup(response.text, 'html.parser')
+                doc = trackers.parse_html(response)
                 
                 # Ищем ссылку на скачивание торрент-файла
-                download_links = soup.select('a.btn-download')
-                magnet_links = soup.select('a[href^="magnet:"]')
-                
-                for link in download_links:
+                for link in DOWNLOAD_BUTTON_LINKS(doc):
                     href = link.get('href')
                     if href:
                         if not href.startswith('http'):
@@ -2017,7 +3358,7 @@ def get_torrent_link():
                             href = f"{base_domain}{href}"
                         result['torrent_links'].append(href)
                 
-                for link in magnet_links:
+                for link in MAGNET_LINKS(doc):
                     href = link.get('href')
                     if href:
                         result['magnet_links'].append(href)
@@ -2029,16 +3370,16 @@ def get_torrent_link():
             response = session.get(url, timeout=5)
             
             if response.status_code == 200:
-                soup = BeautifulSoup(response.text, 'html.parser')
+                doc = trackers.parse_html(response)
                 
                 # Ищем магнет-ссылку
-                magnet_link = soup.select_one('a[href^="magnet:"]')
-                if magnet_link:
-                    result['magnet_links'].append(magnet_link['href'])
+                magnet_link = trackers.first(MAGNET_LINKS, doc)
+                if magnet_link is not None:
+                    result['magnet_links'].append(magnet_link.get('href'))
                 
                 # Ищем ссылку на скачивание .torrent файла
-                download_link = soup.select_one('a.dl-stub, a.dl-link')
-                if download_link:
+                download_link = trackers.first(RUTRACKER_DOWNLOAD_LINKS, doc)
+                if download_link is not None:
                     href = download_link.get('href')
                     if href:
                         if not href.startswith('http'):
@@ -2061,10 +3402,9 @@ def get_torrent_link():
                 response = session.get(url, timeout=5)
                 
                 if response.status_code == 200:
-                    soup = BeautifulSoup(response.text, 'html.parser')
-                    magnet_link = soup.select_one('a[href^="magnet:"]')
-                    if magnet_link:
-                        result['magnet_links'].append(magnet_link['href'])
+                    magnet_link = trackers.first(MAGNET_LINKS, trackers.parse_html(response))
+                    if magnet_link is not None:
+                        result['magnet_links'].append(magnet_link.get('href'))
                 else:
                     return jsonify({'error': f'Ошибка доступа к странице EZTV: {response.status_code}'}), response.status_code
             else:
@@ -2075,16 +3415,14 @@ def get_torrent_link():
             response = session.get(url, timeout=5)
             
             if response.status_code == 200:
-                soup = BeautifulSoup(response.text, 'html.parser')
+                doc = trackers.parse_html(response)
                 
                 # Ищем все магнет-ссылки
-                magnet_links = soup.select('a[href^="magnet:"]')
-                for link in magnet_links:
-                    result['magnet_links'].append(link['href'])
+                for link in MAGNET_LINKS(doc):
+                    result['magnet_links'].append(link.get('href'))
                 
                 # Ищем ссылки на .torrent файлы (обычно содержат ".torrent" в href или имеют соответствующие классы)
-                torrent_links = soup.select('a[href$=".torrent"], a.torrent-download-link, a.dl-link, a.download')
-                for link in torrent_links:
+                for link in TORRENT_FILE_LINKS(doc):
                     href = link.get('href')
                     if href:
                         if not href.startswith('http'):
@@ -2118,11 +3456,8 @@ def download_torrent():
         return jsonify({'error': 'URL не указан'}), 400
     
     try:
-        # Создаем сессию для запросов
-        session = requests.Session()
-        session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        })
+        # Сессия с общим пулом соединений и пользовательским агентом браузера
+        session = http_client.session()
         
         # Делаем запрос к ссылке на скачивание
         response = session.get(url, timeout=10, stream=True, allow_redirects=True)
@@ -2171,14 +3506,13 @@ def create_share_link():
     expiry_days = request.json.get('expiry_days', 30)  # По умолчанию 30 дней
     
     # Проверяем существование файла и принадлежность пользователю
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM files WHERE id = ? AND user_id = ?", 
              (file_id, current_user.id))
     file = c.fetchone()
     
     if not file:
-        conn.close()
         return jsonify({'error': 'Файл не найден'}), 404
     
     # Генерируем уникальный токен
@@ -2198,7 +3532,6 @@ def create_share_link():
     # Создаем URL для шаринга
     share_url = request.host_url + f'shared/{token}'
     
-    conn.close()
     return jsonify({
         'id': share_id,
         'token': token,
@@ -2209,7 +3542,7 @@ def create_share_link():
 @app.route('/shared/<token>')
 def view_shared_file(token):
     """Открытый доступ к файлу по ссылке без аутентификации"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     # Проверяем токен и актуальность ссылки
@@ -2222,7 +3555,6 @@ def view_shared_file(token):
     ''', (token, current_date))
     
     result = c.fetchone()
-    conn.close()
     
     if not result:
         return "Ссылка недействительна или срок её действия истёк", 404
@@ -2242,7 +3574,7 @@ def view_shared_file(token):
     
     file_path = os.path.join(app.config['UPLOAD_FOLDER'], share_link['category'], share_link['filename'])
     if os.path.exists(file_path):
-        return send_file(file_path, download_name=share_link['original_filename'], as_attachment=True)
+        return send_stored_file(file_path, download_name=share_link['original_filename'])
     
     return "Файл не найден", 404
 
@@ -2250,7 +3582,7 @@ def view_shared_file(token):
 @login_required
 def get_my_share_links():
     """Получение списка созданных пользователем ссылок"""
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     c.execute('''
@@ -2263,7 +3595,6 @@ def get_my_share_links():
     ''', (current_user.id,))
     
     results = c.fetchall()
-    conn.close()
     
     share_links = []
     for result in results:
@@ -2284,7 +3615,7 @@ def get_my_share_links():
 @app.route('/delete_share_link/<int:link_id>', methods=['DELETE'])
 @login_required
 def delete_share_link(link_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
@@ -2299,7 +3630,6 @@ def delete_share_link(link_id):
         share_link = cursor.fetchone()
         
         if not share_link:
-            conn.close()
             return jsonify({
                 'status': 'error',
                 'message': 'Ссылка не найдена или у вас нет прав доступа'
@@ -2308,7 +3638,6 @@ def delete_share_link(link_id):
         # Удаляем ссылку
         cursor.execute("DELETE FROM share_links WHERE id = ?", (link_id,))
         conn.commit()
-        conn.close()
         
         return jsonify({
             'status': 'success',
@@ -2316,7 +3645,6 @@ def delete_share_link(link_id):
         })
         
     except Exception as e:
-        conn.close()
         return jsonify({
             'status': 'error',
             'message': f'Произошла ошибка: {str(e)}'
@@ -2325,7 +3653,7 @@ def delete_share_link(link_id):
 @app.route('/delete_file_link/<int:link_id>', methods=['DELETE'])
 @login_required
 def delete_file_link(link_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     cursor = conn.cursor()
     
     try:
@@ -2340,7 +3668,6 @@ def delete_file_link(link_id):
         share_link = cursor.fetchone()
         
         if not share_link:
-            conn.close()
             return jsonify({
                 'status': 'error',
                 'message': 'Ссылка не найдена или у вас нет прав доступа'
@@ -2349,7 +3676,6 @@ def delete_file_link(link_id):
         # Удаляем только ссылку, сам файл остается
         cursor.execute("DELETE FROM share_links WHERE id = ?", (link_id,))
         conn.commit()
-        conn.close()
         
         return jsonify({
             'status': 'success',
@@ -2357,14 +3683,75 @@ def delete_file_link(link_id):
         })
         
     except Exception as e:
-        conn.close()
         return jsonify({
             'status': 'error',
             'message': f'Произошла ошибка: {str(e)}'
         }), 500
 
-# Словарь для хранения активных торрент-загрузок
-active_torrent_downloads = {}
+# Менеджер торрент-загрузок: одна сессия libtorrent на все торренты, задания в таблице torrent_jobs.
+# Если задан TORRENT_MANAGER_SOCKET, менеджер работает отдельным процессом (python torrent_manager.py),
+# а рабочие процессы веб-сервера обращаются к нему через Unix-сокет; иначе он запускается внутри процесса
+# serve.py запускает менеджер сам и передает путь к сокету через окружение
+TORRENT_MANAGER_SOCKET = os.environ.get('TORRENT_MANAGER_SOCKET') or app.config.get('TORRENT_MANAGER_SOCKET')
+torrent_manager = None
+torrent_manager_lock = threading.Lock()
+
+def create_torrent_manager():
+    return TorrentManager(
+        DB_PATH,
+        app.config['DOWNLOAD_FOLDER'],
+        max_active=app.config.get('TORRENT_MAX_ACTIVE', 3),
+        listen_port=app.config.get('TORRENT_LISTEN_PORT', 6881),
+        on_complete=move_downloaded_files,
+        on_file_complete=import_downloaded_file,
+        finished_ttl=app.config.get('TORRENT_FINISHED_TTL', 300),
+        bandwidth=BandwidthScheduler(
+            download_limit=app.config.get('TORRENT_DOWNLOAD_LIMIT', 0),
+            upload_limit=app.config.get('TORRENT_UPLOAD_LIMIT', 0),
+            user_download_limit=app.config.get('TORRENT_USER_DOWNLOAD_LIMIT', 0),
+            user_upload_limit=app.config.get('TORRENT_USER_UPLOAD_LIMIT', 0),
+            schedule=app.config.get('TORRENT_BANDWIDTH_SCHEDULE'),
+            busy_download_limit=app.config.get('TORRENT_BUSY_DOWNLOAD_LIMIT', 0),
+            busy_upload_limit=app.config.get('TORRENT_BUSY_UPLOAD_LIMIT', 256 * 1024)
+        )
+    )
+
+def get_torrent_manager():
+    """Менеджер загрузок процесса: встроенный (запускается при первом обращении) или клиент внешнего"""
+    global torrent_manager
+    if torrent_manager is None:
+        with torrent_manager_lock:
+            if torrent_manager is None:
+                if TORRENT_MANAGER_SOCKET:
+                    torrent_manager = TorrentManagerClient(TORRENT_MANAGER_SOCKET)
+                else:
+                    manager = create_torrent_manager()
+                    manager.start()
+                    atexit.register(manager.shutdown)
+                    torrent_manager = manager
+    return torrent_manager
+
+def serve_torrent_manager():
+    """Запуск менеджера загрузок отдельным процессом"""
+    socket_path = TORRENT_MANAGER_SOCKET or os.path.join(os.path.dirname(DB_PATH), 'torrent_manager.sock')
+    manager = create_torrent_manager()
+    manager.start()
+    server = TorrentManagerServer(manager, socket_path)
+
+    def stop(signum, frame):
+        # shutdown() ждет завершения serve_forever, поэтому вызывается из другого потока
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    print(f"Менеджер торрент-загрузок слушает {socket_path}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        manager.shutdown()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
 
 @app.route('/download_torrent_on_server', methods=['POST'])
 @login_required
@@ -2379,197 +3766,31 @@ def download_torrent_on_server():
         return jsonify({'error': 'Не указаны все необходимые параметры'})
     
     # Проверяем, принадлежит ли файл текущему пользователю
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM files WHERE id = ? AND user_id = ?", (file_id, current_user.id))
     file = c.fetchone()
-    conn.close()
     
     if not file:
         return jsonify({'error': 'Файл не найден или у вас нет доступа к нему'})
     
     # Проверяем существование файла на диске
-    torrent_path = os.path.join(app.config['UPLOAD_FOLDER'], category, filename)
-    if not os.path.exists(torrent_path):
+    torrent_path = upload_path(category, filename)
+    if not torrent_path or not os.path.exists(torrent_path):
         return jsonify({'error': 'Торрент-файл не найден на сервере'})
     
-    # Генерируем уникальный ID для загрузки
-    download_id = str(uuid.uuid4())
+    priority = data.get('priority', 'normal')
+    if priority not in PRIORITY_WEIGHTS:
+        return jsonify({'error': 'Неизвестный приоритет загрузки'})
     
-    # Создаем директорию для загрузки
-    download_dir = os.path.join(app.config['DOWNLOAD_FOLDER'], 'torrents', download_id)
-    os.makedirs(download_dir, exist_ok=True)
-    
-    # Запускаем загрузку в отдельном потоке
+    # Ставим торрент в очередь менеджера загрузок
     try:
-        thread = threading.Thread(target=start_torrent_download, args=(download_id, torrent_path, download_dir, file_id))
-        thread.daemon = True
-        thread.start()
-        
-        return jsonify({'success': True, 'download_id': download_id})
-    except Exception as e:
+        # sequential — качать файлы по порядку, чтобы смотреть видео до конца загрузки
+        job = get_torrent_manager().add(current_user.id, file[0], torrent_path, priority, bool(data.get('sequential')))
+        return jsonify({'success': True, 'download_id': job['id'], 'status': job['status']})
+    except TorrentManagerError as e:
         return jsonify({'error': f'Ошибка при запуске загрузки: {str(e)}'})
 
-def start_torrent_download(download_id, torrent_path, download_dir, file_id):
-    try:
-        # Создаем объект для загрузки
-        torrent_download = {
-            'id': download_id,
-            'torrent_path': torrent_path,
-            'download_dir': download_dir,
-            'file_id': file_id,
-            'start_time': time.time(),
-            'status': 'downloading',
-            'progress': 0,
-            'download_speed': 0,
-            'eta': '--:--:--',
-            'downloaded': '0 MB',
-            'total_size': '0 MB',
-            'downloader': None,
-            'downloader_instance': None,
-            'paused': False,
-            'target_category': None,
-            'target_filename': None
-        }
-        
-        # Сохраняем информацию о загрузке
-        active_torrent_downloads[download_id] = torrent_download
-        
-        # Запускаем загрузку в асинхронном режиме
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        # Инициализируем загрузчик
-        downloader = TorrentDownloader(torrent_path, download_dir)
-        torrent_download['downloader'] = downloader
-        
-        # Создаем функцию для обновления прогресса
-        async def update_progress():
-            try:
-                # Небольшая задержка, чтобы дать время торренту инициализироваться
-                await asyncio.sleep(2)
-                
-                # Получаем статус загрузки
-                try:
-                    # Пытаемся вызвать метод status доступный через downloader._file
-                    if hasattr(downloader, '_file') and downloader._file is not None and hasattr(downloader._file, 'status'):
-                        try:
-                            status = downloader._file.status()
-                            torrent_download['downloader_instance'] = downloader._file
-                            
-                            while torrent_download['status'] == 'downloading':
-                                await asyncio.sleep(1)
-                                
-                                if not torrent_download['paused']:
-                                    try:
-                                        # Проверяем, что объект _file все еще существует
-                                        if not hasattr(downloader, '_file') or downloader._file is None:
-                                            print("Объект downloader._file стал недоступен")
-                                            torrent_download['status'] = 'error'
-                                            torrent_download['error'] = "Объект загрузчика недоступен"
-                                            break
-                                        
-                                        # Проверяем, что метод status все еще доступен
-                                        if not hasattr(downloader._file, 'status'):
-                                            print("Метод status стал недоступен")
-                                            torrent_download['status'] = 'error'
-                                            torrent_download['error'] = "Метод status недоступен в объекте загрузчика"
-                                            break
-                                        
-                                        # Обновляем статус
-                                        try:
-                                            status = downloader._file.status()
-                                        except AttributeError as ae:
-                                            print(f"AttributeError при вызове status: {str(ae)}")
-                                            if "has no attribute 'id'" in str(ae):
-                                                torrent_download['status'] = 'error'
-                                                torrent_download['error'] = "Ошибка доступа к атрибуту id: объект загрузчика был изменен"
-                                            else:
-                                                torrent_download['status'] = 'error'
-                                                torrent_download['error'] = str(ae)
-                                            break
-                                        
-                                        if status:
-                                            # Получаем прогресс в процентах
-                                            progress = status.progress * 100
-                                            download_speed = status.download_rate / 1024  # Конвертируем в KB/s
-                                            
-                                            # Рассчитываем оставшееся время
-                                            if download_speed > 0:
-                                                total_bytes = status.total_wanted
-                                                downloaded_bytes = total_bytes * status.progress
-                                                remaining_bytes = total_bytes - downloaded_bytes
-                                                remaining_seconds = remaining_bytes / (download_speed * 1024)
-                                                
-                                                # Форматируем оставшееся время в ЧЧ:ММ:СС
-                                                hours, remainder = divmod(int(remaining_seconds), 3600)
-                                                minutes, seconds = divmod(remainder, 60)
-                                                eta = f"{hours:02d}:{minutes:02d}:{seconds:02d}"
-                                            else:
-                                                eta = '--:--:--'
-                                            
-                                            # Форматируем размеры
-                                            downloaded = format_size(status.total_wanted * status.progress)
-                                            total_size = format_size(status.total_wanted)
-                                            
-                                            # Обновляем информацию о загрузке
-                                            torrent_download['progress'] = round(progress, 1)
-                                            torrent_download['download_speed'] = round(download_speed, 1)
-                                            torrent_download['eta'] = eta
-                                            torrent_download['downloaded'] = downloaded
-                                            torrent_download['total_size'] = total_size
-                                            
-                                            # Если загрузка завершена
-                                            if progress >= 100:
-                                                # Определяем тип скачанного файла и перемещаем его в соответствующую категорию
-                                                move_downloaded_files(download_id, download_dir)
-                                                torrent_download['status'] = 'completed'
-                                                break
-                                    except Exception as e:
-                                        print(f"Ошибка обновления статуса: {str(e)}")
-                        except Exception as e:
-                            print(f"Ошибка при инициализации статуса: {str(e)}")
-                            torrent_download['status'] = 'error'
-                            torrent_download['error'] = str(e)
-                    else:
-                        print("Объект загрузчика не инициализирован или не имеет нужных методов")
-                        torrent_download['status'] = 'error'
-                        torrent_download['error'] = "Объект загрузчика не инициализирован или не имеет нужных методов"
-                            
-                except Exception as e:
-                    print(f"Ошибка при получении статуса: {str(e)}")
-                    torrent_download['status'] = 'error'
-                    torrent_download['error'] = str(e)
-            except Exception as e:
-                print(f"Ошибка в update_progress: {str(e)}")
-                torrent_download['status'] = 'error'
-                torrent_download['error'] = str(e)
-        
-        # Запускаем задачи
-        async def run_tasks():
-            try:
-                # Запускаем загрузку и обновление прогресса параллельно
-                download_task = asyncio.create_task(downloader.start_download(download_speed=0, upload_speed=0))
-                progress_task = asyncio.create_task(update_progress())
-                
-                # Ждем завершения обеих задач
-                await asyncio.gather(download_task, progress_task)
-            except Exception as e:
-                print(f"Ошибка в run_tasks: {str(e)}")
-                torrent_download['status'] = 'error'
-                torrent_download['error'] = str(e)
-        
-        # Запускаем цикл событий
-        loop.run_until_complete(run_tasks())
-        loop.close()
-        
-    except Exception as e:
-        print(f"Ошибка загрузки торрента: {str(e)}")
-        torrent_download = active_torrent_downloads.get(download_id)
-        if torrent_download:
-            torrent_download['status'] = 'error'
-            torrent_download['error'] = str(e)
-
 def format_size(size_bytes):
     """Форматирует размер в байтах в человекочитаемый формат"""
     if size_bytes == 0:
@@ -2581,294 +3802,403 @@ def format_size(size_bytes):
         i += 1
     return f"{size_bytes:.2f} {size_names[i]}"
 
-def move_downloaded_files(download_id, download_dir):
-    """Перемещает скачанные файлы в соответствующие категории"""
-    torrent_download = active_torrent_downloads.get(download_id)
-    if not torrent_download:
-        return
+def format_eta(seconds):
+    """Оставшееся время в формате ЧЧ:ММ:СС"""
+    if seconds is None:
+        return '--:--:--'
+    hours, remainder = divmod(int(seconds), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+def torrent_progress_state(job):
+    """Состояние загрузки в том виде, в каком его ожидает клиент"""
+    return {
+        'download_id': job['id'],
+        'file_id': job['file_id'],
+        'name': job['name'],
+        'status': job['status'],
+        'progress': job['progress'],
+        'download_speed': round(job['download_rate'] / 1024, 1),  # KB/s
+        'eta': format_eta(job['eta']),
+        'downloaded': format_size(job['downloaded']),
+        'total_size': format_size(job['total_size']),
+        'target_category': job['target_category'],
+        'error': job['error'] or '',
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at'],
+        # У записей истории нет приоритета и скоростей
+        'priority': job.get('priority', 'normal'),
+        'download_limit': job.get('download_limit', 0),
+        'upload_limit': job.get('upload_limit', 0),
+        'upload_speed': round((job.get('upload_rate') or 0) / 1024, 1),  # KB/s
+        'import_progress': job.get('import_progress'),
+        'sequential': job.get('sequential', False),
+        # Файлы, которые уже можно открыть, хотя торрент еще скачивается
+        'ready_files': [
+            {'category': item['category'], 'filename': item['filename']}
+            for item in job.get('imported_files') or []
+        ]
+    }
+
+# Перенос скачанного торрента в хранилище. Внутри одного диска файлы переименовываются,
+# между дисками (DOWNLOAD_FOLDER и UPLOAD_FOLDER на разных устройствах) копируются в несколько потоков
+import_executor = ThreadPoolExecutor(max_workers=app.config.get('TORRENT_IMPORT_WORKERS', 4), thread_name_prefix='torrent-import')
+
+def import_item(download_dir, path):
+    """Файл загрузки: path — путь внутри папки загрузки, его папки сохраняются внутри категории"""
+    file_name = os.path.basename(path)
+    return {
+        'path': path,
+        'source': os.path.join(download_dir, path),
+        'name': file_name,
+        'category': get_category(file_name),
+        'folder': os.path.dirname(path),
+        'size': os.path.getsize(os.path.join(download_dir, path)),
+        'stored_name': None,
+        'target': None,
+        'created': False,
+    }
+
+def import_plan(download_dir, skip=()):
+    """Файлы загрузки, кроме уже зарегистрированных (skip)"""
+    plan = []
+    for root, dirs, files in os.walk(download_dir):
+        dirs.sort()
+        for file_name in sorted(files):
+            path = os.path.relpath(os.path.join(root, file_name), download_dir)
+            if path not in skip:
+                plan.append(import_item(download_dir, path))
+    return plan
+
+# Функции переноса создают файл в хранилище, не перезаписывая существующий: если имя занято
+# (две серии с одинаковым именем в один момент), к нему добавляется суффикс, а в item
+# записываются итоговые имя и путь. created — файл создан этим переносом и удаляется при откате
+
+def rename_downloaded_file(item, progress):
+    def move(path):
+        # os.rename молча заменил бы существующий файл, поэтому жесткая ссылка и удаление исходного
+        os.link(item['source'], path)
+        item['created'] = True
+        os.unlink(item['source'])
+    
+    item['stored_name'], item['target'], _ = create_upload_target(item['stored_name'], item['target'], move)
+    progress(item['size'])
+    return hash_file(item['target']) if CONTENT_ADDRESSED_STORAGE else None
+
+def link_downloaded_file(item, progress):
+    """Жесткая ссылка на файл, который торрент еще раздает и докачивает рядом"""
+    item['stored_name'], item['target'], _ = create_upload_target(
+        item['stored_name'], item['target'], lambda path: os.link(item['source'], path))
+    item['created'] = True
+    progress(item['size'])
+    return hash_file(item['target']) if CONTENT_ADDRESSED_STORAGE else None
+
+def copy_downloaded_file(item, progress):
+    """Копирует файл блоками, сообщая прогресс; при включенном хранилище по хешу
+    заодно считает SHA-256, чтобы не перечитывать файл"""
+    hasher = hashlib.sha256() if CONTENT_ADDRESSED_STORAGE else None
+    item['stored_name'], item['target'], dst = create_upload_target(
+        item['stored_name'], item['target'], lambda path: open(path, 'xb'))
+    item['created'] = True
+    with open(item['source'], 'rb') as src, dst:
+        for data in iter(lambda: src.read(HASH_CHUNK_SIZE), b''):
+            if hasher:
+                hasher.update(data)
+            dst.write(data)
+            progress(len(data))
+    return hasher.hexdigest() if hasher else None
+
+def rollback_import(plan, transfer):
+    """Возвращает переименованные файлы в папку загрузки и удаляет скопированные"""
+    for item in plan:
+        if not item['created']:
+            continue
+        try:
+            if transfer is rename_downloaded_file and not os.path.exists(item['source']):
+                os.rename(item['target'], item['source'])
+            else:
+                os.remove(item['target'])
+        except OSError as e:
+            print(f"Ошибка отката переноса файла {item['target']}: {str(e)}")
+
+def import_files(plan, user_id, transfer, report=None):
+    """Переносит файлы плана в хранилище функцией transfer и добавляет их в files одной транзакцией.
+    report(перенесено, всего) вызывается по мере переноса (в байтах)"""
+    total = sum(item['size'] for item in plan)
+    done = 0
+    done_lock = threading.Lock()
+    
+    def progress(size):
+        nonlocal done
+        with done_lock:
+            done += size
+            current = done
+        if report:
+            report(current, total)
+    
+    for item in plan:
+        item['stored_name'], item['target'] = prepare_upload_target(item['name'], item['category'], item['folder'])
+    
+    conn = get_db()
+    c = conn.cursor()
+    try:
+        futures = [import_executor.submit(transfer, item, progress) for item in plan]
+        # Дожидаемся всех файлов, чтобы откат не пересекся с незавершенным копированием
+        wait(futures)
+        digests = [future.result() for future in futures]
+        
+        upload_date = datetime.now().isoformat()
+        for item, digest in zip(plan, digests):
+            if digest:
+                link_blob(c, digest, item['target'])
+        c.executemany("""
+        INSERT INTO files (filename, original_filename, category, upload_date, size, user_id, blob_digest)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, [(item['stored_name'], item['name'], item['category'], upload_date, item['size'], user_id, digest)
+              for item, digest in zip(plan, digests)])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        rollback_import(plan, transfer)
+        raise
     
+    for item in plan:
+        schedule_thumbnail(item['category'], item['target'])
+
+def same_device(download_dir):
+    return os.stat(download_dir).st_dev == os.stat(app.config['UPLOAD_FOLDER']).st_dev
+
+def move_downloaded_files(job, report=None):
+    """Переносит скачанные файлы в соответствующие категории, сохраняя структуру папок торрента.
+    Файлы, зарегистрированные до завершения торрента, пропускаются.
+    Возвращает категорию и имя первого перенесенного файла"""
+    imported = job.get('imported_files') or []
+    plan = import_plan(job['download_dir'], skip={item['path'] for item in imported})
+    if not plan and not imported:
+        raise RuntimeError('В загрузке нет файлов')
+    
+    # Владелец записан в задании, отдельный запрос к БД на каждый файл не нужен
+    if plan:
+        transfer = rename_downloaded_file if same_device(job['download_dir']) else copy_downloaded_file
+        import_files(plan, job['user_id'], transfer, report)
+    
+    first = imported[0] if imported else {'category': plan[0]['category'], 'filename': plan[0]['stored_name']}
+    return first['category'], first['filename']
+
+def import_downloaded_file(job, path):
+    """Регистрирует в хранилище один докачанный файл торрента, пока остальные еще скачиваются.
+    Торрент продолжает раздавать файл, поэтому он не переносится, а связывается или копируется"""
+    item = import_item(job['download_dir'], path)
+    import_files([item], job['user_id'], link_downloaded_file if same_device(job['download_dir']) else copy_downloaded_file)
+    return item['category'], item['stored_name']
+
+# Как часто (в секундах) в простаивающий SSE-поток отправляется комментарий, чтобы соединение не закрылось
+TORRENT_STREAM_HEARTBEAT = 15
+
+def torrent_event(job):
+    return f"data: {json.dumps(torrent_progress_state(job))}\n\n"
+
+def torrent_event_stream(subscription, initial, until_finished=False):
+    """SSE-поток изменений загрузок. Поток не опрашивает менеджер, а спит,
+    пока шина не опубликует изменение; отправляются только изменившиеся загрузки"""
     try:
-        # Получаем список всех скачанных файлов
-        downloaded_files = []
-        for root, dirs, files in os.walk(download_dir):
-            for file in files:
-                file_path = os.path.join(root, file)
-                downloaded_files.append(file_path)
-        
-        # Если файлов нет, выходим
-        if not downloaded_files:
-            return
+        # gunicorn отправляет заголовки вместе с первым фрагментом тела: без него пустой поток
+        # выглядел бы для клиента зависшим до первого события
+        yield ": connected\n\n"
+        for job in initial:
+            yield torrent_event(job)
+            if until_finished and job['status'] in FINISHED_STATUSES:
+                return
         
-        # Перемещаем каждый файл в соответствующую категорию
-        for file_path in downloaded_files:
-            file_name = os.path.basename(file_path)
-            category = get_category(file_name)
-            
-            # Создаем новое имя файла с временной меткой
-            timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-            new_filename = f"{timestamp}_{file_name}"
-            
-            # Путь назначения
-            dest_path = os.path.join(app.config['UPLOAD_FOLDER'], category, new_filename)
-            
-            # Перемещаем файл
-            os.rename(file_path, dest_path)
-            
-            # Сохраняем информацию о файле в БД
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            
-            # Получаем ID пользователя из оригинального торрент-файла
-            c.execute("SELECT user_id FROM files WHERE id = ?", (torrent_download['file_id'],))
-            user_record = c.fetchone()
-            
-            # Проверяем, был ли найден файл
-            if user_record is None:
-                print(f"Не найден файл с ID {torrent_download['file_id']} в базе данных")
-                conn.close()
+        while True:
+            changes = subscription.get(TORRENT_STREAM_HEARTBEAT)
+            if not changes:
+                yield ": keepalive\n\n"
                 continue
-                
-            user_id = user_record[0]
-            
-            # Добавляем запись о новом файле
-            c.execute("""
-            INSERT INTO files (filename, original_filename, category, upload_date, size, user_id) 
-            VALUES (?, ?, ?, ?, ?, ?)
-            """, (new_filename, file_name, category, datetime.now().isoformat(), 
-                  os.path.getsize(dest_path), user_id))
             
-            conn.commit()
-            conn.close()
-            
-            # Сохраняем информацию о перемещенном файле
-            if torrent_download['target_category'] is None:
-                torrent_download['target_category'] = category
-                torrent_download['target_filename'] = new_filename
-    
-    except Exception as e:
-        print(f"Ошибка при перемещении файлов: {str(e)}")
-        torrent_download['status'] = 'error'
-        torrent_download['error'] = str(e)
+            for job in changes:
+                yield torrent_event(job)
+                # Завершенная, остановленная или упавшая загрузка больше не изменится
+                if until_finished and job['status'] in FINISHED_STATUSES:
+                    return
+    finally:
+        subscription.close()
+
+def torrent_event_response(stream):
+    response = Response(stream, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/torrent_download_progress/<download_id>')
 @login_required
 def torrent_download_progress(download_id):
-    def generate():
-        torrent_download = active_torrent_downloads.get(download_id)
-        if not torrent_download:
-            yield f"data: {json.dumps({'status': 'error', 'error': 'Загрузка не найдена'})}\n\n"
-            return
-        
-        try:
-            # Проверяем, принадлежит ли загрузка текущему пользователю
-            conn = sqlite3.connect(DB_PATH)
-            c = conn.cursor()
-            c.execute("SELECT user_id FROM files WHERE id = ?", (torrent_download['file_id'],))
-            file = c.fetchone()
-            conn.close()
-            
-            # Проверяем, был ли найден файл и принадлежит ли он текущему пользователю
-            if not file:
-                yield f"data: {json.dumps({'status': 'error', 'error': 'Файл не найден в базе данных'})}\n\n"
-                return
-            
-            if file[0] != current_user.id:
-                yield f"data: {json.dumps({'status': 'error', 'error': 'У вас нет доступа к этой загрузке'})}\n\n"
-                return
-            
-            last_progress = -1
-            
-            while True:
-                # Если статус изменился на completed или error, отправляем последнее сообщение и завершаем
-                if torrent_download['status'] in ['completed', 'error']:
-                    # Если это ошибка с NoneType, заменяем её на общее сообщение об ошибке
-                    error_message = torrent_download.get('error', '')
-                    if "has no attribute 'id'" in error_message:
-                        error_message = "Ошибка при загрузке торрента"
-                    
-                    yield f"data: {json.dumps({
-                        'status': torrent_download['status'],
-                        'progress': torrent_download['progress'],
-                        'download_speed': torrent_download['download_speed'],
-                        'eta': torrent_download['eta'],
-                        'downloaded': torrent_download['downloaded'],
-                        'total_size': torrent_download['total_size'],
-                        'target_category': torrent_download['target_category'],
-                        'error': error_message
-                    })}\n\n"
-                    break
-                
-                # Если прогресс изменился, отправляем обновление
-                if torrent_download['progress'] != last_progress:
-                    last_progress = torrent_download['progress']
-                    yield f"data: {json.dumps({
-                        'status': torrent_download['status'],
-                        'progress': torrent_download['progress'],
-                        'download_speed': torrent_download['download_speed'],
-                        'eta': torrent_download['eta'],
-                        'downloaded': torrent_download['downloaded'],
-                        'total_size': torrent_download['total_size']
-                    })}\n\n"
-                
-                time.sleep(1)
-        
-        except Exception as e:
-            yield f"data: {json.dumps({'status': 'error', 'error': str(e)})}\n\n"
+    if not acquire_stream_slot():
+        return stream_busy_response('text/event-stream')
     
-    return Response(generate(), mimetype='text/event-stream')
+    manager = get_torrent_manager()
+    # Подписка оформляется до чтения текущего состояния, чтобы не пропустить изменение между ними
+    subscription = manager.subscribe(current_user.id, download_id)
+    try:
+        job = manager.get(download_id)
+    except TorrentManagerError as e:
+        subscription.close()
+        return torrent_event_response([f"data: {json.dumps({'status': 'error', 'error': str(e)})}\n\n"])
+    
+    if not job or job['user_id'] != current_user.id:
+        subscription.close()
+        error = 'Загрузка не найдена' if not job else 'У вас нет доступа к этой загрузке'
+        return torrent_event_response([f"data: {json.dumps({'status': 'error', 'error': error})}\n\n"])
+    
+    return torrent_event_response(torrent_event_stream(subscription, [job], until_finished=True))
 
-@app.route('/stop_torrent_download', methods=['POST'])
+@app.route('/torrent_downloads/stream')
 @login_required
-def stop_torrent_download():
+def torrent_downloads_stream():
+    """Один поток изменений всех загрузок пользователя: сначала текущее состояние, затем изменения"""
+    if not acquire_stream_slot():
+        return stream_busy_response('text/event-stream')
+    
+    manager = get_torrent_manager()
+    subscription = manager.subscribe(current_user.id)
+    try:
+        jobs = manager.list_jobs(current_user.id)
+    except TorrentManagerError as e:
+        subscription.close()
+        return torrent_event_response([f"data: {json.dumps({'status': 'error', 'error': str(e)})}\n\n"])
+    
+    return torrent_event_response(torrent_event_stream(subscription, jobs))
+
+def control_torrent_download(action):
+    """Общая часть обработчиков остановки, паузы и возобновления загрузки по ID торрент-файла"""
     data = request.json
     file_id = data.get('file_id')
     
     if file_id is None:
         return jsonify({'error': 'Не указан ID файла'})
     
-    # Находим загрузку по file_id
-    download_id = None
-    for d_id, download in active_torrent_downloads.items():
-        if download['file_id'] == file_id:
-            download_id = d_id
-            break
-    
-    if not download_id:
-        return jsonify({'error': 'Загрузка не найдена'})
-    
-    # Проверяем, принадлежит ли загрузка текущему пользователю
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM files WHERE id = ?", (file_id,))
-    file = c.fetchone()
-    conn.close()
-    
-    if not file:
-        return jsonify({'error': 'Файл не найден в базе данных'})
-    
-    if file[0] != current_user.id:
-        return jsonify({'error': 'У вас нет доступа к этой загрузке'})
-    
-    # Останавливаем загрузку
-    torrent_download = active_torrent_downloads.get(download_id)
-    if torrent_download and torrent_download.get('downloader'):
-        try:
-            torrent_download['downloader'].stop_download()
-            torrent_download['status'] = 'stopped'
-            
-            return jsonify({'success': True})
-        except Exception as e:
-            return jsonify({'error': str(e)})
-    
-    return jsonify({'error': 'Невозможно остановить загрузку'})
+    try:
+        manager = get_torrent_manager()
+        
+        # Находим загрузку по file_id; владелец хранится в самом задании
+        job = manager.find(int(file_id))
+        if not job:
+            return jsonify({'error': 'Загрузка не найдена'})
+        
+        if job['user_id'] != current_user.id:
+            return jsonify({'error': 'У вас нет доступа к этой загрузке'})
+        
+        result = manager.control(current_user.id, action, [job['id']])[job['id']]
+        if 'status' not in result:
+            return jsonify({'error': result['error']})
+        return jsonify({'success': True, 'status': result['status']})
+    except (TorrentManagerError, ValueError) as e:
+        return jsonify({'error': str(e)})
+
+@app.route('/stop_torrent_download', methods=['POST'])
+@login_required
+def stop_torrent_download():
+    return control_torrent_download('stop')
 
 @app.route('/pause_torrent_download', methods=['POST'])
 @login_required
 def pause_torrent_download():
-    data = request.json
-    file_id = data.get('file_id')
-    
-    if file_id is None:
-        return jsonify({'error': 'Не указан ID файла'})
-    
-    # Находим загрузку по file_id
-    download_id = None
-    for d_id, download in active_torrent_downloads.items():
-        if download['file_id'] == file_id:
-            download_id = d_id
-            break
-    
-    if not download_id:
-        return jsonify({'error': 'Загрузка не найдена'})
-    
-    # Проверяем, принадлежит ли загрузка текущему пользователю
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM files WHERE id = ?", (file_id,))
-    file = c.fetchone()
-    conn.close()
-    
-    if not file:
-        return jsonify({'error': 'Файл не найден в базе данных'})
-    
-    if file[0] != current_user.id:
-        return jsonify({'error': 'У вас нет доступа к этой загрузке'})
-    
-    # Приостанавливаем загрузку
-    torrent_download = active_torrent_downloads.get(download_id)
-    if torrent_download and torrent_download.get('downloader'):
-        try:
-            torrent_download['downloader'].pause_download()
-            torrent_download['paused'] = True
-            
-            return jsonify({'success': True})
-        except Exception as e:
-            return jsonify({'error': str(e)})
-    
-    return jsonify({'error': 'Невозможно приостановить загрузку'})
+    return control_torrent_download('pause')
 
 @app.route('/resume_torrent_download', methods=['POST'])
 @login_required
 def resume_torrent_download():
-    data = request.json
-    file_id = data.get('file_id')
-    
-    if file_id is None:
-        return jsonify({'error': 'Не указан ID файла'})
-    
-    # Находим загрузку по file_id
-    download_id = None
-    for d_id, download in active_torrent_downloads.items():
-        if download['file_id'] == file_id:
-            download_id = d_id
-            break
-    
-    if not download_id:
-        return jsonify({'error': 'Загрузка не найдена'})
+    return control_torrent_download('resume')
+
+@app.route('/torrent_downloads')
+@login_required
+def list_torrent_downloads():
+    """Текущие и недавно завершенные загрузки пользователя; с history=1 — еще и история"""
+    try:
+        manager = get_torrent_manager()
+        result = {'downloads': [torrent_progress_state(job) for job in manager.list_jobs(current_user.id)]}
+        
+        if request.args.get('history') in ('1', 'true'):
+            limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+            result['history'] = [torrent_progress_state(job) for job in manager.history(current_user.id, limit)]
+        
+        return jsonify(result)
+    except TorrentManagerError as e:
+        return jsonify({'error': str(e)})
+
+@app.route('/torrent_downloads/control', methods=['POST'])
+@login_required
+def control_torrent_downloads():
+    """Пакетное управление загрузками: {"action": "pause|resume|stop", "download_ids": [...]}.
+    Без download_ids действие применяется ко всем загрузкам пользователя"""
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    download_ids = data.get('download_ids')
+    
+    if action not in ('pause', 'resume', 'stop'):
+        return jsonify({'error': 'Неизвестное действие'}), 400
+    if download_ids is not None and (not isinstance(download_ids, list) or not all(isinstance(i, str) for i in download_ids)):
+        return jsonify({'error': 'download_ids должен быть списком ID загрузок'}), 400
     
-    # Проверяем, принадлежит ли загрузка текущему пользователю
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute("SELECT user_id FROM files WHERE id = ?", (file_id,))
-    file = c.fetchone()
-    conn.close()
+    try:
+        results = get_torrent_manager().control(current_user.id, action, download_ids)
+    except TorrentManagerError as e:
+        return jsonify({'error': str(e)})
     
-    if not file:
-        return jsonify({'error': 'Файл не найден в базе данных'})
+    return jsonify({
+        'success': True,
+        'results': {
+            download_id: torrent_progress_state(result) if 'status' in result else result
+            for download_id, result in results.items()
+        }
+    })
+
+@app.route('/torrent_downloads/settings', methods=['POST'])
+@login_required
+def configure_torrent_downloads():
+    """Приоритет и ограничения скорости загрузок:
+    {"download_ids": [...], "priority": "low|normal|high", "download_limit": <байт/с>, "upload_limit": <байт/с>,
+     "sequential": true|false}"""
+    data = request.get_json(silent=True) or {}
+    download_ids = data.get('download_ids')
     
-    if file[0] != current_user.id:
-        return jsonify({'error': 'У вас нет доступа к этой загрузке'})
+    if not isinstance(download_ids, list) or not all(isinstance(i, str) for i in download_ids):
+        return jsonify({'error': 'download_ids должен быть списком ID загрузок'}), 400
     
-    # Возобновляем загрузку
-    torrent_download = active_torrent_downloads.get(download_id)
-    if torrent_download and torrent_download.get('downloader'):
-        try:
-            torrent_download['downloader'].resume_download()
-            torrent_download['paused'] = False
-            
-            return jsonify({'success': True})
-        except Exception as e:
-            return jsonify({'error': str(e)})
+    try:
+        results = get_torrent_manager().configure(
+            current_user.id, download_ids,
+            priority=data.get('priority'),
+            download_limit=data.get('download_limit'),
+            upload_limit=data.get('upload_limit'),
+            sequential=data.get('sequential')
+        )
+    except TorrentManagerError as e:
+        return jsonify({'error': str(e)}), 400
     
-    return jsonify({'error': 'Невозможно возобновить загрузку'})
+    return jsonify({
+        'success': True,
+        'results': {
+            download_id: torrent_progress_state(result) if 'status' in result else result
+            for download_id, result in results.items()
+        }
+    })
 
-@app.route('/media_player/<category>/<filename>')
+@app.route('/media_player/<category>/<path:filename>')
 @login_required
 def media_player(category, filename):
     # Проверяем, принадлежит ли файл текущему пользователю
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM files WHERE filename = ? AND category = ? AND user_id = ?", 
              (filename, category, current_user.id))
     file = c.fetchone()
-    conn.close()
     
     if not file:
         return jsonify({"error": "Файл не найден или у вас нет доступа к нему"}), 404
     
     # Получаем тип файла
     mime_type, _ = mimetypes.guess_type(filename)
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], category, filename)
     
     if category == 'videos' or (mime_type and mime_type.startswith('video/')):
         # Для видео-файлов создаем HTML с видеоплеером
@@ -2900,11 +4230,10 @@ def api_register():
     username = data.get('username')
     password = data.get('password')
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM users WHERE username = ?", (username,))
     if c.fetchone():
-        conn.close()
         return jsonify({'message': 'Пользователь уже существует'}), 409
     
     hashed_password = generate_password_hash(password)
@@ -2914,7 +4243,7 @@ def api_register():
     
     c.execute("SELECT id FROM users WHERE username = ?", (username,))
     user_id = c.fetchone()[0]
-    conn.close()
+    invalidate_user(user_id)
     
     return jsonify({
         'message': 'Пользователь успешно зарегистрирован',
@@ -2932,23 +4261,77 @@ def api_login():
     username = data.get('username')
     password = data.get('password')
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM users WHERE username = ?", (username,))
     user = c.fetchone()
-    conn.close()
     
     if user and check_password_hash(user[2], password):
-        token = create_token(user[0])
+        token = create_token(user[0], user[1])
+        refresh_token = create_refresh_token(c, user[0])
+        conn.commit()
         return jsonify({
             'message': 'Авторизация успешна',
             'token': token,
+            'refresh_token': refresh_token,
             'user_id': user[0],
             'username': user[1]
         })
     
     return jsonify({'message': 'Неверное имя пользователя или пароль'}), 401
 
+@app.route('/api/auth/refresh', methods=['POST'])
+def api_refresh_token():
+    """Новая пара токенов по refresh-токену, без проверки пароля.
+    Использованный refresh-токен отзывается; повторное его предъявление значит, что токен
+    украден, и тогда отзываются все refresh-токены пользователя"""
+    data = request.get_json(silent=True) or {}
+    claims = decode_token(data.get('refresh_token') or '', token_type='refresh')
+    if isinstance(claims, str):
+        return jsonify({'message': claims}), 401
+    
+    conn = get_db()
+    c = conn.cursor()
+    c.execute("SELECT revoked FROM refresh_tokens WHERE jti = ? AND user_id = ?", (claims['jti'], claims['sub']))
+    token = c.fetchone()
+    if not token:
+        return jsonify({'message': 'Недействительный токен. Пожалуйста, войдите снова.'}), 401
+    if token[0]:
+        c.execute("UPDATE refresh_tokens SET revoked = 1 WHERE user_id = ?", (claims['sub'],))
+        conn.commit()
+        return jsonify({'message': 'Токен уже использован. Пожалуйста, войдите снова.'}), 401
+    
+    user = get_user(claims['sub'])
+    if not user:
+        return jsonify({'message': 'Пользователь не найден!'}), 401
+    
+    # Отзыв проверяется в том же UPDATE, чтобы два одновременных запроса не получили две пары токенов
+    c.execute("UPDATE refresh_tokens SET revoked = 1 WHERE jti = ? AND revoked = 0", (claims['jti'],))
+    if c.rowcount == 0:
+        conn.rollback()
+        return jsonify({'message': 'Токен уже использован. Пожалуйста, войдите снова.'}), 401
+    refresh_token = create_refresh_token(c, user.id)
+    c.execute("DELETE FROM refresh_tokens WHERE expires_at < ?", (datetime.utcnow().isoformat(),))
+    conn.commit()
+    
+    return jsonify({
+        'token': create_token(user.id, user.username),
+        'refresh_token': refresh_token
+    })
+
+@app.route('/api/auth/logout', methods=['POST'])
+def api_logout():
+    """Отзывает refresh-токен; токен доступа действует до истечения срока"""
+    data = request.get_json(silent=True) or {}
+    claims = decode_token(data.get('refresh_token') or '', token_type='refresh')
+    if isinstance(claims, str):
+        return jsonify({'message': claims}), 401
+    
+    conn = get_db()
+    conn.execute("UPDATE refresh_tokens SET revoked = 1 WHERE jti = ?", (claims['jti'],))
+    conn.commit()
+    return jsonify({'message': 'Выход выполнен'})
+
 @app.route('/api/users/me', methods=['GET'])
 @token_required
 def api_get_current_user(current_user):
@@ -2962,38 +4345,18 @@ def api_get_current_user(current_user):
 @token_required
 def api_list_files(current_user):
     category = request.args.get('category', 'all')
-    sort_by = request.args.get('sort', 'date')
-    order = request.args.get('order', 'desc')
+    params, error = parse_list_params(request.args)
+    if error:
+        return jsonify({'message': error}), 400
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
-    query = "SELECT * FROM files WHERE user_id = ?"
-    params = [current_user.id]
-    
-    if category != 'all':
-        query += " AND category = ?"
-        params.append(category)
-    
-    # Добавляем сортировку
-    if sort_by == 'date':
-        query += " ORDER BY upload_date"
-    elif sort_by == 'name':
-        query += " ORDER BY original_filename"
-    elif sort_by == 'size':
-        query += " ORDER BY size"
-    
-    if order == 'desc':
-        query += " DESC"
-    else:
-        query += " ASC"
-    
-    c.execute(query, params)
-    files = c.fetchall()
-    conn.close()
+    stream = iter_user_files(c, current_user.id, category, params['sort_by'], params['desc'], params['after'])
+    page, next_cursor = take_page(stream, params['limit'])
     
     file_list = []
-    for file in files:
+    for _, file in page:
         file_item = {
             'id': file[0],
             'filename': file[1],
@@ -3002,20 +4365,19 @@ def api_list_files(current_user):
             'upload_date': file[4],
             'size': file[5],
             'size_formatted': format_size(file[5]),
-            'torrent_category': file[7] if len(file) > 7 and file[7] else None
+            'torrent_category': file[6] or None
         }
-        file_list.append(file_item)
+        file_list.append(project_fields(file_item, params['fields']))
     
-    return jsonify({'files': file_list})
+    return jsonify({'files': file_list, 'next_cursor': next_cursor})
 
 @app.route('/api/files/<int:file_id>', methods=['GET'])
 @token_required
 def api_get_file(current_user, file_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM files WHERE id = ? AND user_id = ?", (file_id, current_user.id))
     file = c.fetchone()
-    conn.close()
     
     if not file:
         return jsonify({'message': 'Файл не найден или у вас нет доступа'}), 404
@@ -3046,49 +4408,25 @@ def api_upload_file(current_user):
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
         category = get_category(filename)
-        timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
-        new_filename = f"{timestamp}_{filename}"
-        
-        # Проверяем, есть ли путь для сохранения структуры папок
-        path = request.form.get('path', '')
+        stored_name, file_path = prepare_upload_target(filename, category, request.form.get('path', ''))
         
         # Получаем категорию торрента, если файл является торрентом
         torrent_category = None
         if category == 'torrents':
             torrent_category = request.form.get('torrent_category', 'other')
         
-        if path:
-            # Создаем подпапку с учетом пути
-            folder_path = os.path.join(app.config['UPLOAD_FOLDER'], category, path)
-            os.makedirs(folder_path, exist_ok=True)
-            file_path = os.path.join(folder_path, new_filename)
-        else:
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], category, new_filename)
-        
-        file.save(file_path)
+        stored_name, file_path, digest = create_upload_target(
+            stored_name, file_path, lambda path: write_upload_stream(file.stream, path))
+        new_filename = os.path.basename(stored_name)
         
         # Сохраняем информацию о файле в БД
-        conn = sqlite3.connect(DB_PATH)
+        conn = get_db()
         c = conn.cursor()
-        
-        if category == 'torrents':
-            c.execute("""
-            INSERT INTO files (filename, original_filename, category, upload_date, size, user_id, torrent_category) 
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, (new_filename if not path else os.path.join(path, new_filename), 
-                filename, category, datetime.now().isoformat(), 
-                os.path.getsize(file_path), current_user.id, torrent_category))
-        else:
-            c.execute("""
-            INSERT INTO files (filename, original_filename, category, upload_date, size, user_id) 
-            VALUES (?, ?, ?, ?, ?, ?)
-            """, (new_filename if not path else os.path.join(path, new_filename), 
-                filename, category, datetime.now().isoformat(), 
-                os.path.getsize(file_path), current_user.id))
-        
-        file_id = c.lastrowid
+        if digest:
+            link_blob(c, digest, file_path)
+        file_id = save_file_record(c, stored_name, filename, category, os.path.getsize(file_path), current_user.id, torrent_category, digest)
         conn.commit()
-        conn.close()
+        schedule_thumbnail(category, file_path)
         
         return jsonify({
             'message': 'Файл успешно загружен',
@@ -3104,14 +4442,55 @@ def api_upload_file(current_user):
     
     return jsonify({'message': 'Недопустимый формат файла'}), 400
 
+@app.route('/api/files/upload/check', methods=['POST'])
+@token_required
+def api_check_upload(current_user):
+    return upload_status_response(*check_existing_upload(current_user.id, request.get_json(silent=True) or {}), 'message')
+
+@app.route('/api/files/upload/sessions', methods=['POST'])
+@token_required
+def api_create_upload(current_user):
+    return upload_status_response(*create_upload_session(current_user.id, request.get_json(silent=True) or {}), 'message')
+
+@app.route('/api/files/upload/sessions/<upload_id>', methods=['GET'])
+@token_required
+def api_upload_status(current_user, upload_id):
+    c = get_db().cursor()
+    session = get_upload_session(c, upload_id, current_user.id)
+    if not session:
+        return jsonify({'message': 'Сессия загрузки не найдена'}), 404
+    return jsonify(upload_session_state(c, session))
+
+@app.route('/api/files/upload/sessions/<upload_id>/chunks/<int:index>', methods=['PUT'])
+@token_required
+def api_upload_chunk(current_user, upload_id, index):
+    return upload_status_response(*write_upload_chunk(current_user.id, upload_id, index), 'message')
+
+@app.route('/api/files/upload/sessions/<upload_id>/finalize', methods=['POST'])
+@token_required
+def api_finalize_upload(current_user, upload_id):
+    result, error, status = finalize_upload_session(current_user.id, upload_id)
+    if error:
+        return jsonify({'message': error}), status
+    return jsonify({
+        'message': 'Файл успешно загружен',
+        **result,
+        'upload_date': datetime.now().isoformat(),
+        'size_formatted': format_size(result['size'])
+    }), 201
+
+@app.route('/api/files/upload/sessions/<upload_id>', methods=['DELETE'])
+@token_required
+def api_abort_upload(current_user, upload_id):
+    return upload_status_response(*abort_upload_session(current_user.id, upload_id), 'message')
+
 @app.route('/api/files/<int:file_id>/download', methods=['GET'])
 @token_required
 def api_download_file(current_user, file_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM files WHERE id = ? AND user_id = ?", (file_id, current_user.id))
     file = c.fetchone()
-    conn.close()
     
     if not file:
         return jsonify({'message': 'Файл не найден или у вас нет доступа'}), 404
@@ -3125,40 +4504,32 @@ def api_download_file(current_user, file_id):
     if not os.path.exists(file_path):
         return jsonify({'message': 'Файл не найден на сервере'}), 404
     
-    return send_file(file_path, as_attachment=True, download_name=original_filename)
+    return send_stored_file(file_path, download_name=original_filename)
 
 @app.route('/api/files/<int:file_id>', methods=['DELETE'])
 @token_required
 def api_delete_file(current_user, file_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM files WHERE id = ? AND user_id = ?", (file_id, current_user.id))
     file = c.fetchone()
     
     if not file:
-        conn.close()
         return jsonify({'message': 'Файл не найден или у вас нет доступа'}), 404
     
     filename = file[1]
     category = file[3]
     
-    # Удаляем файл
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], category, filename)
-    
+    # Удаляем файл и запись из БД
     try:
-        if os.path.exists(file_path):
-            os.remove(file_path)
+        delete_stored_file(c, file_id, category, filename)
     except Exception as e:
         return jsonify({'message': f'Ошибка при удалении файла: {str(e)}'}), 500
     
-    # Удаляем запись из БД
-    c.execute("DELETE FROM files WHERE id = ?", (file_id,))
-    
     # Удаляем связанные ссылки на шаринг
     c.execute("DELETE FROM share_links WHERE file_id = ?", (file_id,))
     
     conn.commit()
-    conn.close()
     
     return jsonify({'message': 'Файл успешно удален'})
 
@@ -3166,11 +4537,10 @@ def api_delete_file(current_user, file_id):
 @app.route('/api/notes', methods=['GET'])
 @token_required
 def api_get_notes(current_user):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM notes WHERE user_id = ? ORDER BY priority DESC, update_date DESC", (current_user.id,))
     notes = c.fetchall()
-    conn.close()
     
     notes_list = []
     for note in notes:
@@ -3188,11 +4558,10 @@ def api_get_notes(current_user):
 @app.route('/api/notes/<int:note_id>', methods=['GET'])
 @token_required
 def api_get_note(current_user, note_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user.id))
     note = c.fetchone()
-    conn.close()
     
     if not note:
         return jsonify({'message': 'Заметка не найдена или у вас нет доступа'}), 404
@@ -3221,7 +4590,7 @@ def api_add_note(current_user):
     priority = data.get('priority', 0)
     now = datetime.now().isoformat()
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("""
     INSERT INTO notes (title, content, create_date, update_date, priority, user_id) 
@@ -3230,7 +4599,6 @@ def api_add_note(current_user):
     
     note_id = c.lastrowid
     conn.commit()
-    conn.close()
     
     return jsonify({
         'message': 'Заметка успешно создана',
@@ -3250,13 +4618,12 @@ def api_update_note(current_user, note_id):
     if not data:
         return jsonify({'message': 'Данные не предоставлены'}), 400
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user.id))
     note = c.fetchone()
     
     if not note:
-        conn.close()
         return jsonify({'message': 'Заметка не найдена или у вас нет доступа'}), 404
     
     title = data.get('title', note[1])
@@ -3270,7 +4637,6 @@ def api_update_note(current_user, note_id):
     """, (title, content, update_date, priority, note_id))
     
     conn.commit()
-    conn.close()
     
     return jsonify({
         'message': 'Заметка успешно обновлена',
@@ -3284,18 +4650,16 @@ def api_update_note(current_user, note_id):
 @app.route('/api/notes/<int:note_id>', methods=['DELETE'])
 @token_required
 def api_delete_note(current_user, note_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM notes WHERE id = ? AND user_id = ?", (note_id, current_user.id))
     note = c.fetchone()
     
     if not note:
-        conn.close()
         return jsonify({'message': 'Заметка не найдена или у вас нет доступа'}), 404
     
     c.execute("DELETE FROM notes WHERE id = ?", (note_id,))
     conn.commit()
-    conn.close()
     
     return jsonify({'message': 'Заметка успешно удалена'})
 
@@ -3303,11 +4667,10 @@ def api_delete_note(current_user, note_id):
 @app.route('/api/links', methods=['GET'])
 @token_required
 def api_get_links(current_user):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM links WHERE user_id = ? ORDER BY add_date DESC", (current_user.id,))
     links = c.fetchall()
-    conn.close()
     
     links_list = []
     for link in links:
@@ -3336,7 +4699,7 @@ def api_add_link(current_user):
     category = data.get('category', 'links')
     add_date = datetime.now().isoformat()
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("""
     INSERT INTO links (title, url, description, category, add_date, user_id) 
@@ -3345,7 +4708,6 @@ def api_add_link(current_user):
     
     link_id = c.lastrowid
     conn.commit()
-    conn.close()
     
     return jsonify({
         'message': 'Ссылка успешно добавлена',
@@ -3360,18 +4722,16 @@ def api_add_link(current_user):
 @app.route('/api/links/<int:link_id>', methods=['DELETE'])
 @token_required
 def api_delete_link(current_user, link_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM links WHERE id = ? AND user_id = ?", (link_id, current_user.id))
     link = c.fetchone()
     
     if not link:
-        conn.close()
         return jsonify({'message': 'Ссылка не найдена или у вас нет доступа'}), 404
     
     c.execute("DELETE FROM links WHERE id = ?", (link_id,))
     conn.commit()
-    conn.close()
     
     return jsonify({'message': 'Ссылка успешно удалена'})
 
@@ -3383,7 +4743,7 @@ def api_get_movies(current_user):
     order = request.args.get('order', 'desc')
     filter_watched = request.args.get('watched')
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     query = "SELECT * FROM movies WHERE user_id = ?"
@@ -3411,7 +4771,6 @@ def api_get_movies(current_user):
     
     c.execute(query, params)
     movies = c.fetchall()
-    conn.close()
     
     movies_list = []
     for movie in movies:
@@ -3438,11 +4797,10 @@ def api_get_movies(current_user):
 @app.route('/api/movies/<int:movie_id>', methods=['GET'])
 @token_required
 def api_get_movie(current_user, movie_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM movies WHERE id = ? AND user_id = ?", (movie_id, current_user.id))
     movie = c.fetchone()
-    conn.close()
     
     if not movie:
         return jsonify({'message': 'Фильм не найден или у вас нет доступа'}), 404
@@ -3487,7 +4845,7 @@ def api_add_movie(current_user):
     watched = data.get('watched', False)
     watch_date = data.get('watch_date', None)
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     
     # Проверяем, существует ли фильм с таким kinopoisk_id у пользователя
@@ -3496,7 +4854,6 @@ def api_add_movie(current_user):
                  (kinopoisk_id, current_user.id))
         existing_movie = c.fetchone()
         if existing_movie:
-            conn.close()
             return jsonify({'message': 'Фильм уже добавлен в вашу коллекцию',
                            'movie_id': existing_movie[0]}), 409
     
@@ -3509,7 +4866,6 @@ def api_add_movie(current_user):
     
     movie_id = c.lastrowid
     conn.commit()
-    conn.close()
     
     return jsonify({
         'message': 'Фильм успешно добавлен',
@@ -3521,13 +4877,12 @@ def api_add_movie(current_user):
 @app.route('/api/movies/<int:movie_id>/toggle_watched', methods=['POST'])
 @token_required
 def api_toggle_watched(current_user, movie_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT watched FROM movies WHERE id = ? AND user_id = ?", (movie_id, current_user.id))
     movie = c.fetchone()
     
     if not movie:
-        conn.close()
         return jsonify({'message': 'Фильм не найден или у вас нет доступа'}), 404
     
     current_status = bool(movie[0])
@@ -3540,7 +4895,6 @@ def api_toggle_watched(current_user, movie_id):
     """, (1 if new_status else 0, watch_date, movie_id))
     
     conn.commit()
-    conn.close()
     
     return jsonify({
         'message': f'Статус просмотра изменен на {"просмотрено" if new_status else "не просмотрено"}',
@@ -3552,78 +4906,62 @@ def api_toggle_watched(current_user, movie_id):
 @app.route('/api/movies/<int:movie_id>', methods=['DELETE'])
 @token_required
 def api_delete_movie(current_user, movie_id):
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_db()
     c = conn.cursor()
     c.execute("SELECT * FROM movies WHERE id = ? AND user_id = ?", (movie_id, current_user.id))
     movie = c.fetchone()
     
     if not movie:
-        conn.close()
         return jsonify({'message': 'Фильм не найден или у вас нет доступа'}), 404
     
     c.execute("DELETE FROM movies WHERE id = ?", (movie_id,))
     conn.commit()
-    conn.close()
     
     return jsonify({'message': 'Фильм успешно удален'})
 
 @app.route('/api/stats', methods=['GET'])
 @token_required
 def api_get_stats(current_user):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # Статистика по файлам
-    c.execute("SELECT COUNT(*) FROM files WHERE user_id = ?", (current_user.id,))
-    total_files = c.fetchone()[0]
-    
-    c.execute("SELECT SUM(size) FROM files WHERE user_id = ?", (current_user.id,))
-    total_size = c.fetchone()[0] or 0
-    
-    c.execute("SELECT category, COUNT(*) FROM files WHERE user_id = ? GROUP BY category", (current_user.id,))
-    files_by_category = c.fetchall()
-    
-    # Статистика по заметкам
-    c.execute("SELECT COUNT(*) FROM notes WHERE user_id = ?", (current_user.id,))
-    total_notes = c.fetchone()[0]
-    
-    # Статистика по ссылкам
-    c.execute("SELECT COUNT(*) FROM links WHERE user_id = ?", (current_user.id,))
-    total_links = c.fetchone()[0]
-    
-    # Статистика по фильмам
-    c.execute("SELECT COUNT(*) FROM movies WHERE user_id = ?", (current_user.id,))
-    total_movies = c.fetchone()[0]
-    
-    c.execute("SELECT COUNT(*) FROM movies WHERE user_id = ? AND watched = 1", (current_user.id,))
-    watched_movies = c.fetchone()[0]
-    
-    conn.close()
-    
-    # Собираем категории файлов
-    categories = {}
-    for category, count in files_by_category:
-        categories[category] = count
+    stats = get_user_stats(current_user.id)
     
     return jsonify({
         'files': {
-            'total': total_files,
-            'total_size': total_size,
-            'total_size_formatted': format_size(total_size),
-            'categories': categories
+            'total': stats['files'],
+            'total_size': stats['total_size'],
+            'total_size_formatted': format_size(stats['total_size']),
+            'categories': stats['categories']
         },
         'notes': {
-            'total': total_notes
+            'total': stats['notes']
         },
         'links': {
-            'total': total_links
+            'total': stats['links']
         },
         'movies': {
-            'total': total_movies,
-            'watched': watched_movies,
-            'unwatched': total_movies - watched_movies
+            'total': stats['movies'],
+            'watched': stats['movies_watched'],
+            'unwatched': stats['movies'] - stats['movies_watched']
         }
     })
 
+@app.route('/api/search', methods=['GET'])
+@token_required
+def api_search(current_user):
+    query = request.args.get('q', '')
+    if not query.strip():
+        return jsonify({'message': 'Не указан поисковый запрос'}), 400
+    
+    kinds = request.args.get('types', ','.join(SEARCH_KINDS)).split(',')
+    page, per_page = parse_search_paging(request.args)
+    
+    results, has_more = search_user_content(current_user.id, query, kinds, page, per_page)
+    
+    return jsonify({
+        'results': results,
+        'page': page,
+        'per_page': per_page,
+        'has_more': has_more
+    })
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
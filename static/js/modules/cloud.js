@@ -161,13 +161,6 @@ const CloudModule = {
             
             const file = this.elements.fileUpload.files[0];
             
-            // Проверяем размер файла
-            if (file.size > 1024 * 1024 * 1024) { // 1GB
-                Utils.showNotification(t('file_too_large'), 'warning');
-                this.elements.fileUpload.value = '';
-                return;
-            }
-            
             // Проверяем, является ли файл торрентом
             if (file.name.toLowerCase().endsWith('.torrent')) {
                 // Показываем модальное окно для выбора категории торрента
@@ -175,33 +168,21 @@ const CloudModule = {
                 return;
             }
             
-            const formData = new FormData();
-            formData.append('file', file);
-            
             // Показываем индикатор загрузки
             this.showLoading(t('uploading_file'));
             
-            fetch('/upload', {
-                method: 'POST',
-                body: formData
-            })
-            .then(response => response.json())
-            .then(data => {
-                if (data.success) {
-                    this.loadFiles();
-                    Utils.loadStats();
-                    this.elements.fileUpload.value = '';
-                    
-                    // Показываем уведомление об успешной загрузке
-                    Utils.showNotification(t('file_uploaded_success').replace('{filename}', file.name), 'success');
-                } else {
-                    Utils.showNotification(`${t('error')}: ${data.error}`, 'error');
-                    this.loadFiles();
-                }
+            this.uploadChunked(file)
+            .then(() => {
+                this.loadFiles();
+                Utils.loadStats();
+                this.elements.fileUpload.value = '';
+                
+                // Показываем уведомление об успешной загрузке
+                Utils.showNotification(t('file_uploaded_success').replace('{filename}', file.name), 'success');
             })
             .catch(error => {
                 console.error('Ошибка загрузки файла:', error);
-                Utils.showNotification(t('file_upload_error'), 'error');
+                Utils.showNotification(error.message ? `${t('error')}: ${error.message}` : t('file_upload_error'), 'error');
                 this.loadFiles();
             });
         });
@@ -307,51 +288,221 @@ const CloudModule = {
     
     // Загрузка файла
     uploadFile: function(file, path = '') {
-        // Проверяем размер файла
-        if (file.size > 1024 * 1024 * 1024) { // 1GB
-            Utils.showNotification(`Файл "${file.name}" слишком большой. Максимальный размер - 1GB`, 'warning');
-            return;
+        this.uploadChunked(file, path)
+        .then(() => {
+            this.loadFiles();
+            Utils.loadStats();
+            
+            // Показываем уведомление только при единичной загрузке
+            if (!path) {
+                Utils.showNotification(`Файл "${file.name}" успешно загружен`, 'success');
+            }
+        })
+        .catch(error => {
+            console.error('Ошибка загрузки файла:', error);
+            Utils.showNotification(`Ошибка загрузки "${file.name}": ${error.message}`, 'error');
+        });
+    },
+    
+    // URL миниатюры; дата загрузки в URL делает его неизменным, и браузер кэширует его надолго
+    thumbnailUrl: function(file, size = 'medium') {
+        return `/thumb/${file.id}/${size}?v=${encodeURIComponent(file.upload_date || '')}`;
+    },
+    
+    // Параметры загрузки по частям
+    uploadChunkSize: 8 * 1024 * 1024,
+    uploadParallelism: 4,
+    uploadRetries: 5,
+    
+    // Ключ в localStorage, по которому загрузку можно продолжить после перезагрузки страницы
+    uploadResumeKey: function(file, path) {
+        return `upload:${path}${file.name}:${file.size}:${file.lastModified}`;
+    },
+    
+    // Контрольная сумма части для заголовка Upload-Checksum
+    // (crypto.subtle доступен только по HTTPS и на localhost)
+    chunkChecksum: async function(blob) {
+        if (!window.crypto || !window.crypto.subtle) {
+            return null;
+        }
+        const digest = await window.crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+        let binary = '';
+        new Uint8Array(digest).forEach(byte => {
+            binary += String.fromCharCode(byte);
+        });
+        return `sha256 ${btoa(binary)}`;
+    },
+    
+    // Файлы до этого размера перед загрузкой проверяются по хешу: если такое содержимое
+    // уже есть на сервере, файл добавляется без передачи данных
+    dedupeCheckLimit: 256 * 1024 * 1024,
+    dedupeEnabled: true,
+    
+    checkExistingUpload: async function(file, path, torrentCategory) {
+        if (!this.dedupeEnabled || file.size > this.dedupeCheckLimit || !window.crypto || !window.crypto.subtle) {
+            return null;
         }
         
-        const formData = new FormData();
-        formData.append('file', file);
+        const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+        const sha256 = Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join('');
+        const body = { sha256: sha256, size: file.size, filename: file.name, path: path };
+        if (torrentCategory) {
+            body.torrent_category = torrentCategory;
+        }
         
-        // Добавляем путь, если он есть (для сохранения структуры папок)
-        if (path) {
-            formData.append('path', path);
+        const response = await fetch('/upload/check', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(body)
+        });
+        if (!response.ok) {
+            return null;
         }
         
-        fetch('/upload', {
+        const data = await response.json();
+        if (data.enabled === false) {
+            // На сервере хранилище по хешу выключено, больше не тратим время на хеширование
+            this.dedupeEnabled = false;
+        }
+        return data.exists ? data : null;
+    },
+    
+    // Начинает новую сессию загрузки или продолжает сохраненную
+    openUploadSession: async function(file, path, torrentCategory) {
+        const resumeKey = this.uploadResumeKey(file, path);
+        const savedId = localStorage.getItem(resumeKey);
+        
+        if (savedId) {
+            const response = await fetch(`/upload/sessions/${savedId}`);
+            if (response.ok) {
+                return response.json();
+            }
+            localStorage.removeItem(resumeKey);
+        }
+        
+        const body = { filename: file.name, size: file.size, chunk_size: this.uploadChunkSize, path: path };
+        if (torrentCategory) {
+            body.torrent_category = torrentCategory;
+        }
+        
+        const response = await fetch('/upload/sessions', {
             method: 'POST',
-            body: formData
-        })
-        .then(response => response.json())
-        .then(data => {
-            if (data.success) {
-                this.loadFiles();
-                Utils.loadStats();
-                
-                // Показываем уведомление только при единичной загрузке
-                if (!path) {
-                    Utils.showNotification(`Файл "${file.name}" успешно загружен`, 'success');
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify(body)
+        });
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error);
+        }
+        
+        localStorage.setItem(resumeKey, data.upload_id);
+        return data;
+    },
+    
+    // Отправка одной части с повторами при обрывах связи
+    uploadChunk: async function(file, session, index) {
+        const start = index * session.chunk_size;
+        const blob = file.slice(start, Math.min(start + session.chunk_size, file.size));
+        const headers = { 'Content-Type': 'application/octet-stream' };
+        const checksum = await this.chunkChecksum(blob);
+        if (checksum) {
+            headers['Upload-Checksum'] = checksum;
+        }
+        
+        for (let attempt = 1; ; attempt++) {
+            let error;
+            try {
+                const response = await fetch(`/upload/sessions/${session.upload_id}/chunks/${index}`, {
+                    method: 'PUT',
+                    headers: headers,
+                    body: blob
+                });
+                if (response.ok) {
+                    return;
                 }
-            } else {
-                Utils.showNotification(`Ошибка загрузки "${file.name}": ${data.error}`, 'error');
+                const data = await response.json().catch(() => ({}));
+                error = new Error(data.error || response.statusText);
+                if (response.status === 404) {
+                    throw error;
+                }
+            } catch (e) {
+                error = e;
             }
-        })
-        .catch(error => {
-            console.error('Ошибка загрузки файла:', error);
-            Utils.showNotification(`Ошибка загрузки "${file.name}"`, 'error');
-        });
+            
+            if (attempt >= this.uploadRetries) {
+                throw error;
+            }
+            await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
+        }
     },
     
-    // Загрузка списка файлов
+    // Возобновляемая загрузка файла по частям: уже принятые сервером части пропускаются,
+    // остальные отправляются в несколько параллельных потоков
+    uploadChunked: async function(file, path = '', torrentCategory = null) {
+        const existing = await this.checkExistingUpload(file, path, torrentCategory);
+        if (existing) {
+            return existing;
+        }
+        
+        const session = await this.openUploadSession(file, path, torrentCategory);
+        
+        const received = new Set(session.received_chunks);
+        const pending = [];
+        for (let index = 0; index < session.chunk_count; index++) {
+            if (!received.has(index)) {
+                pending.push(index);
+            }
+        }
+        
+        const worker = async () => {
+            while (pending.length) {
+                await this.uploadChunk(file, session, pending.shift());
+            }
+        };
+        const workers = [];
+        for (let i = 0; i < Math.min(this.uploadParallelism, pending.length); i++) {
+            workers.push(worker());
+        }
+        await Promise.all(workers);
+        
+        const response = await fetch(`/upload/sessions/${session.upload_id}/finalize`, { method: 'POST' });
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error);
+        }
+        
+        localStorage.removeItem(this.uploadResumeKey(file, path));
+        return data;
+    },
+    
+    // Размер одной страницы списка файлов
+    pageSize: 200,
+    
+    // Загрузка списка файлов: первая страница сразу, следующие - по мере прокрутки
     loadFiles: function() {
         this.showLoading(t('loading_files'));
         
-        fetch(`/files?category=${this.state.currentCategory}&sort=${this.state.currentSort}&order=${this.state.currentOrder}`)
-            .then(response => response.json())
-            .then(files => {
+        this.state.nextCursor = null;
+        this.state.listRequestId = (this.state.listRequestId || 0) + 1;
+        this.loadFilesPage(this.state.listRequestId, null);
+    },
+    
+    // Загрузка одной страницы списка файлов
+    loadFilesPage: function(requestId, cursor) {
+        let url = `/files?category=${this.state.currentCategory}&sort=${this.state.currentSort}&order=${this.state.currentOrder}&limit=${this.pageSize}`;
+        if (cursor) {
+            url += `&cursor=${encodeURIComponent(cursor)}`;
+        }
+        
+        fetch(url)
+            .then(response => {
+                const nextCursor = response.headers.get('X-Next-Cursor');
+                return response.json().then(files => ({ files, nextCursor }));
+            })
+            .then(({ files, nextCursor }) => {
+                // Пока страница загружалась, пользователь мог сменить категорию или сортировку
+                if (requestId !== this.state.listRequestId) return;
+                
                 if (this.state.searchTerm) {
                     files = files.filter(file => {
                         if (file.type === 'file') {
@@ -364,12 +515,14 @@ const CloudModule = {
                     });
                 }
                 
-                if (files.length === 0) {
-                    this.showEmptyMessage();
-                    return;
+                if (!cursor) {
+                    if (files.length === 0 && !nextCursor) {
+                        this.showEmptyMessage();
+                        return;
+                    }
+                    this.elements.filesContainer.innerHTML = '';
                 }
                 
-                this.elements.filesContainer.innerHTML = '';
                 files.forEach(item => {
                     if (item.type === 'file') {
                         const fileElement = this.createFileElement(item);
@@ -379,6 +532,9 @@ const CloudModule = {
                         this.elements.filesContainer.appendChild(linkElement);
                     }
                 });
+                
+                this.state.nextCursor = nextCursor;
+                this.observeNextPage(nextCursor ? () => this.loadFilesPage(requestId, nextCursor) : null);
             })
             .catch(error => {
                 console.error('Ошибка загрузки файлов:', error);
@@ -386,21 +542,66 @@ const CloudModule = {
             });
     },
     
-    // Поиск файлов
+    // Подгрузка следующей страницы, когда конец списка становится видимым.
+    // loadNext загружает следующую страницу (null - страниц больше нет)
+    observeNextPage: function(loadNext) {
+        if (this.pageObserver) {
+            this.pageObserver.disconnect();
+            this.pageObserver = null;
+        }
+        
+        const oldSentinel = this.elements.filesContainer.querySelector('.files-page-sentinel');
+        if (oldSentinel) oldSentinel.remove();
+        
+        if (!loadNext) return;
+        
+        const sentinel = document.createElement('div');
+        sentinel.className = 'files-page-sentinel';
+        this.elements.filesContainer.appendChild(sentinel);
+        
+        this.pageObserver = new IntersectionObserver(entries => {
+            if (entries.some(entry => entry.isIntersecting)) {
+                this.pageObserver.disconnect();
+                this.pageObserver = null;
+                sentinel.remove();
+                loadNext();
+            }
+        }, { rootMargin: '400px' });
+        this.pageObserver.observe(sentinel);
+    },
+    
+    // Размер одной страницы результатов поиска
+    searchPageSize: 50,
+    
+    // Поиск файлов: первая страница результатов сразу, следующие - по мере прокрутки
     searchFiles: function() {
         if (!this.state.searchTerm) return this.loadFiles();
         
         this.showLoading(t('searching'));
         
-        fetch(`/search?q=${encodeURIComponent(this.state.searchTerm)}`)
-            .then(response => response.json())
-            .then(results => {
-                if (results.length === 0) {
-                    this.showEmptyMessage(t('search_no_results').replace('{query}', this.state.searchTerm));
-                    return;
+        this.state.listRequestId = (this.state.listRequestId || 0) + 1;
+        this.searchFilesPage(this.state.listRequestId, this.state.searchTerm, 1);
+    },
+    
+    // Загрузка одной страницы результатов поиска
+    searchFilesPage: function(requestId, searchTerm, page) {
+        fetch(`/search?q=${encodeURIComponent(searchTerm)}&page=${page}&per_page=${this.searchPageSize}`)
+            .then(response => {
+                const hasMore = response.headers.get('X-Has-More') === 'true';
+                return response.json().then(results => ({ results, hasMore }));
+            })
+            .then(({ results, hasMore }) => {
+                // Пока страница загружалась, пользователь мог изменить запрос или открыть другую категорию
+                if (requestId !== this.state.listRequestId) return;
+                
+                if (page === 1) {
+                    if (results.length === 0) {
+                        this.showEmptyMessage(t('search_no_results').replace('{query}', searchTerm));
+                        return;
+                    }
+                    this.elements.filesContainer.innerHTML = '';
                 }
                 
-                this.elements.filesContainer.innerHTML = '';
                 results.forEach(item => {
                     if (item.type === 'file') {
                         const fileElement = this.createFileElement(item);
@@ -410,6 +611,8 @@ const CloudModule = {
                         this.elements.filesContainer.appendChild(linkElement);
                     }
                 });
+                
+                this.observeNextPage(hasMore ? () => this.searchFilesPage(requestId, searchTerm, page + 1) : null);
             })
             .catch(error => {
                 console.error('Ошибка поиска:', error);
@@ -434,8 +637,8 @@ const CloudModule = {
         filePreview.className = `file-preview ${this.getFilePreviewClass(file.category)}`;
         
         if (file.category === 'images') {
-            // Для изображений показываем превью
-            filePreview.style.backgroundImage = `url('/download/${file.category}/${file.filename}')`;
+            // Для изображений показываем миниатюру, а не оригинал
+            filePreview.style.backgroundImage = `url('${this.thumbnailUrl(file)}')`;
         } else {
             // Для других типов файлов показываем иконку
             const icon = document.createElement('i');
@@ -476,6 +679,16 @@ const CloudModule = {
             }
             
             filePreview.appendChild(icon);
+            
+            if (file.category === 'videos') {
+                // Кадр из видео показываем только если сервер смог его построить
+                const frame = new Image();
+                frame.onload = () => {
+                    filePreview.style.backgroundImage = `url('${frame.src}')`;
+                    icon.remove();
+                };
+                frame.src = this.thumbnailUrl(file);
+            }
         }
         
         const fileInfo = document.createElement('div');
@@ -1297,6 +1510,41 @@ const CloudModule = {
         return parseFloat((bytes / Math.pow(k, i)).toFixed(2)) + ' ' + sizes[i];
     },
     
+    // Общий поток изменений всех торрент-загрузок пользователя: одно соединение на страницу
+    torrentStream: null,
+    torrentWatchers: {},
+    
+    // Подписка на изменения загрузки downloadId
+    watchTorrentDownload: function(downloadId, handler) {
+        this.torrentWatchers[downloadId] = handler;
+        if (this.torrentStream) return;
+        
+        this.torrentStream = new EventSource('/torrent_downloads/stream');
+        this.torrentStream.onmessage = (event) => {
+            const progress = JSON.parse(event.data);
+            const watcher = this.torrentWatchers[progress.download_id];
+            if (watcher) watcher(progress);
+        };
+        
+        // После обрыва EventSource переподключается сам и снова получает текущее состояние загрузок;
+        // сдаемся, только если браузер закрыл соединение окончательно
+        this.torrentStream.onerror = () => {
+            if (this.torrentStream.readyState === EventSource.CLOSED) {
+                this.torrentStream = null;
+                this.torrentWatchers = {};
+                Utils.showNotification(t('server_connection_error'), 'error');
+            }
+        };
+    },
+    
+    unwatchTorrentDownload: function(downloadId) {
+        delete this.torrentWatchers[downloadId];
+        if (Object.keys(this.torrentWatchers).length === 0 && this.torrentStream) {
+            this.torrentStream.close();
+            this.torrentStream = null;
+        }
+    },
+    
     // Скачивание торрента на сервере
     downloadTorrentOnServer: function(category, filename, fileId) {
         // Показываем уведомление о начале загрузки
@@ -1326,16 +1574,11 @@ const CloudModule = {
                 return;
             }
             
-            // Подключаемся к обновлениям через EventSource
-            const eventSource = new EventSource(`/torrent_download_progress/${data.download_id}`);
-            
-            // Обрабатываем события от сервера
-            eventSource.onmessage = function(event) {
-                const progress = JSON.parse(event.data);
-                
-                // Если загрузка завершена, показываем уведомление и закрываем соединение
+            // Подписываемся на изменения загрузки в общем потоке
+            this.watchTorrentDownload(data.download_id, (progress) => {
+                // Если загрузка завершена, показываем уведомление и отписываемся
                 if (progress.status === 'completed') {
-                    eventSource.close();
+                    this.unwatchTorrentDownload(data.download_id);
                     Utils.showNotification(
                         t('download_completed').replace('{filename}', filename) + 
                         (progress.target_category ? ` (${t(progress.target_category)})` : ''),
@@ -1347,25 +1590,16 @@ const CloudModule = {
                         this.loadFiles();
                     }, 1000);
                 } 
-                // Если возникла ошибка, показываем уведомление и закрываем соединение
+                // Загрузка отменена: обновлений больше не будет
+                else if (progress.status === 'stopped') {
+                    this.unwatchTorrentDownload(data.download_id);
+                }
+                // Если возникла ошибка, показываем уведомление и отписываемся
                 else if (progress.status === 'error') {
-                    eventSource.close();
-                    
-                    // Скрываем конкретную ошибку с NoneType
-                    if (progress.error && progress.error.includes("'NoneType' object has no attribute 'id'")) {
-                        console.error("Скрытая ошибка:", progress.error);
-                        Utils.showNotification(t('download_error') + ": " + t('unknown_error'), 'error');
-                    } else {
-                        Utils.showNotification(`${t('download_error')}: ${progress.error || t('unknown_error')}`, 'error');
-                    }
+                    this.unwatchTorrentDownload(data.download_id);
+                    Utils.showNotification(`${t('download_error')}: ${progress.error || t('unknown_error')}`, 'error');
                 }
-            }.bind(this);
-            
-            // Обработка ошибок соединения
-            eventSource.onerror = function() {
-                eventSource.close();
-                Utils.showNotification(t('server_connection_error'), 'error');
-            };
+            });
         })
         .catch(error => {
             console.error('Ошибка при скачивании торрента:', error);
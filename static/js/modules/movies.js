@@ -920,36 +920,85 @@ const MoviesModule = {
             this.elements.torrentsLoading.classList.remove('hidden');
         }
         
-        fetch(`/search_torrents/${movieId}`)
-            .then(response => {
+        // Результаты приходят построчно (NDJSON): по событию на каждый трекер и итоговое событие done
+        const found = [];
+        let finished = false;
+        
+        const handleEvent = (event) => {
+            if (event.type === 'provider') {
+                if (event.results && event.results.length > 0) {
+                    found.push(...event.results);
+                    this.fillTorrentsList(found);
+                    
+                    // Показываем блок с результатами, не дожидаясь остальных трекеров
+                    if (this.elements.torrentsResults) {
+                        this.elements.torrentsResults.classList.remove('hidden');
+                    }
+                }
+                return;
+            }
+            
+            if (event.type !== 'done') {
+                return;
+            }
+            finished = true;
+            
+            // Скрываем индикатор загрузки
+            if (this.elements.torrentsLoading) {
+                this.elements.torrentsLoading.classList.add('hidden');
+            }
+            
+            this.state.torrentsSearched = true;
+            
+            // Проверяем наличие результатов
+            if (event.success && event.results && event.results.length > 0) {
+                // Итоговый список уже отсортирован и дополнен ссылками на ручной поиск
+                this.fillTorrentsList(event.results);
+                
+                if (this.elements.torrentsResults) {
+                    this.elements.torrentsResults.classList.remove('hidden');
+                }
+            } else {
+                if (this.elements.torrentsResults) {
+                    this.elements.torrentsResults.classList.add('hidden');
+                }
+                // Показываем сообщение об ошибке
+                if (this.elements.torrentsError) {
+                    this.elements.torrentsError.classList.remove('hidden');
+                }
+            }
+        };
+        
+        fetch(`/search_torrents/${movieId}?stream=ndjson`, { headers: { 'Accept': 'application/x-ndjson' } })
+            .then(async response => {
                 if (!response.ok) {
                     throw new Error(`Ошибка HTTP: ${response.status}`);
                 }
-                return response.json();
-            })
-            .then(data => {
-                // Скрываем индикатор загрузки
-                if (this.elements.torrentsLoading) {
-                    this.elements.torrentsLoading.classList.add('hidden');
-                }
                 
-                this.state.torrentsSearched = true;
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
                 
-                // Проверяем наличие результатов
-                if (data.success && data.results && data.results.length > 0) {
-                    // Заполняем список торрентов
-                    this.fillTorrentsList(data.results);
-                    
-                    // Показываем блок с результатами
-                    if (this.elements.torrentsResults) {
-                        this.elements.torrentsResults.classList.remove('hidden');
+                while (true) {
+                    const { done, value } = await reader.read();
+                    if (done) {
+                        break;
                     }
-                } else {
-                    // Показываем сообщение об ошибке
-                    if (this.elements.torrentsError) {
-                        this.elements.torrentsError.classList.remove('hidden');
+                    buffer += decoder.decode(value, { stream: true });
+                    
+                    let newline;
+                    while ((newline = buffer.indexOf('\n')) >= 0) {
+                        const line = buffer.slice(0, newline).trim();
+                        buffer = buffer.slice(newline + 1);
+                        if (line) {
+                            handleEvent(JSON.parse(line));
+                        }
                     }
                 }
+                
+                if (!finished) {
+                    throw new Error('Поиск прерван');
+                }
             })
             .catch(error => {
                 // Обработка ошибок
@@ -960,6 +1009,11 @@ const MoviesModule = {
                     this.elements.torrentsLoading.classList.add('hidden');
                 }
                 
+                // Если часть трекеров уже ответила, оставляем их результаты на экране
+                if (found.length > 0) {
+                    return;
+                }
+                
                 // Показываем сообщение об ошибке
                 if (this.elements.torrentsError) {
                     this.elements.torrentsError.classList.remove('hidden');
@@ -982,8 +1036,12 @@ const MoviesModule = {
         const realTorrents = torrents.filter(t => t.seeds !== 'N/A');
         const searchLinks = torrents.filter(t => t.seeds === 'N/A');
         
-        // Сортируем настоящие торренты по количеству сидов
+        // Сортируем настоящие торренты: по оценке сервера, если она есть, иначе по количеству сидов
         realTorrents.sort((a, b) => {
+            if (typeof a.score === 'number' && typeof b.score === 'number') {
+                return b.score - a.score;
+            }
+            
             // Добавляем более надежную обработку значения seeds
             let seedsA = 0;
             let seedsB = 0;
@@ -1152,7 +1210,8 @@ const MoviesModule = {
                 }
                 
                 // Информация о сидах/личах
-                if (torrent.seeds && torrent.seeds !== 'N/A') {
+                // Сиды приходят числом, 0 тоже показываем
+                if (torrent.seeds !== undefined && torrent.seeds !== null && torrent.seeds !== 'N/A') {
                     const seedsSpan = document.createElement('span');
                     seedsSpan.className = 'torrent-seeds';
                     // Выделяем хорошие показатели сидов
@@ -0,0 +1,95 @@
+"""Хранилище по хешу: ссылки на блоки и их освобождение из разных соединений"""
+import hashlib
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# server.py читает config.py при импорте
+if not os.path.exists(os.path.join(ROOT, 'config.py')):
+    pytest.skip('нет config.py', allow_module_level=True)
+
+import server
+
+CONTENT = b'matrix'
+DIGEST = hashlib.sha256(CONTENT).hexdigest()
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, 'BLOB_FOLDER', str(tmp_path / '.blobs'))
+    path = str(tmp_path / 'users.db')
+    conn = sqlite3.connect(path)
+    server.run_migrations(conn)
+    conn.close()
+    return path
+
+
+def connect(path):
+    # Как у рабочих процессов gunicorn: у каждого свое соединение
+    return sqlite3.connect(path, timeout=0.1)
+
+
+def store(conn, tmp_path, name):
+    file_path = str(tmp_path / name)
+    with open(file_path, 'wb') as f:
+        f.write(CONTENT)
+    c = conn.cursor()
+    server.link_blob(c, DIGEST, file_path)
+    file_id = server.save_file_record(c, name, name, 'documents', len(CONTENT), 1, blob_digest=DIGEST)
+    conn.commit()
+    return file_id
+
+
+def refcount(conn):
+    row = conn.execute("SELECT refcount FROM blobs WHERE digest = ?", (DIGEST,)).fetchone()
+    return row[0] if row else None
+
+
+def test_blob_released_with_last_reference(db_path, tmp_path):
+    conn = connect(db_path)
+    first = store(conn, tmp_path, 'a.txt')
+    second = store(conn, tmp_path, 'b.txt')
+    assert refcount(conn) == 2
+    
+    c = conn.cursor()
+    server.release_blob(c, DIGEST)
+    conn.commit()
+    assert os.path.exists(server.blob_path(DIGEST))
+    
+    for file_id in (first, second):
+        c.execute("DELETE FROM files WHERE id = ?", (file_id,))
+        server.release_blob(c, DIGEST)
+        conn.commit()
+    assert refcount(conn) is None
+    assert not os.path.exists(server.blob_path(DIGEST))
+
+
+def test_blob_transaction_blocks_other_connections(db_path, tmp_path):
+    worker = connect(db_path)
+    other = connect(db_path)
+    file_id = store(worker, tmp_path, 'a.txt')
+    
+    c = worker.cursor()
+    c.execute("DELETE FROM files WHERE id = ?", (file_id,))
+    server.release_blob(c, DIGEST)
+    # Пока освобождение не зафиксировано, другой процесс не может сослаться на блок
+    with pytest.raises(sqlite3.OperationalError):
+        server.begin_blob_transaction(other.cursor())
+    worker.commit()
+    
+    assert not os.path.exists(server.blob_path(DIGEST))
+    store(other, tmp_path, 'b.txt')
+    assert refcount(other) == 1
+    assert os.path.exists(server.blob_path(DIGEST))
+
+
+@pytest.mark.parametrize('size', [True, -1, '6', None])
+def test_check_existing_upload_rejects_bad_size(monkeypatch, size):
+    monkeypatch.setattr(server, 'CONTENT_ADDRESSED_STORAGE', True)
+    result, error, status = server.check_existing_upload(1, {'sha256': DIGEST, 'size': size, 'filename': 'a.txt'})
+    assert result is None and status == 400
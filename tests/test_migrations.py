@@ -0,0 +1,57 @@
+"""Миграции схемы и планы запросов: горячие выборки должны идти по индексам"""
+import os
+import sqlite3
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# server.py читает config.py при импорте
+if not os.path.exists(os.path.join(ROOT, 'config.py')):
+    pytest.skip('нет config.py', allow_module_level=True)
+
+import server
+
+# Запрос: индекс, по которому он должен выполняться
+INDEXED_QUERIES = [
+    ("SELECT id FROM files WHERE user_id = ? ORDER BY upload_date DESC LIMIT 50",
+     (1,), 'idx_files_user_date'),
+    ("SELECT id FROM files WHERE user_id = ? AND category = ? ORDER BY size DESC LIMIT 50",
+     (1, 'videos'), 'idx_files_user_category_size'),
+    ("SELECT id, category FROM files WHERE filename = ? AND user_id = ?",
+     ('20240101000000_a.mkv', 1), 'idx_files_filename_user'),
+    ("SELECT file_id, expiry_date, is_active FROM share_links WHERE token = ?",
+     ('token',), 'sqlite_autoindex_share_links_1'),
+    ("SELECT id FROM movies WHERE user_id = ? AND kinopoisk_id = ?",
+     (1, '301'), 'idx_movies_user_kinopoisk'),
+]
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / 'users.db'))
+    server.run_migrations(conn)
+    yield conn
+    conn.close()
+
+
+def query_plan(conn, query, params):
+    return ' '.join(row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + query, params))
+
+
+def test_migrations_set_schema_version(conn):
+    assert server.get_schema_version(conn) == server.MIGRATIONS[-1][0]
+
+
+def test_migrations_are_idempotent(conn):
+    server.run_migrations(conn)
+    assert server.get_schema_version(conn) == server.MIGRATIONS[-1][0]
+
+
+@pytest.mark.parametrize('query, params, index', INDEXED_QUERIES)
+def test_query_uses_index(conn, query, params, index):
+    plan = query_plan(conn, query, params)
+    assert index in plan, plan
+    assert 'SCAN files' not in plan and 'SCAN movies' not in plan and 'SCAN share_links' not in plan, plan
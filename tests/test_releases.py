@@ -0,0 +1,81 @@
+"""Разбор названий релизов, размеров и чисел сидов"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from releases import parse_release, parse_size, parse_count, quality_label, year_mismatch
+
+
+@pytest.mark.parametrize('value, expected', [
+    (57, 57),
+    (3.0, 3),
+    ('57', 57),
+    (' 57 ', 57),
+    ('1 024', 1024),
+    ('1\u00a0024', 1024),
+    ('12,345', 12345),
+    ('1.2k', 1),
+    ('1,5', 1),
+    ('—', 0),
+    ('', 0),
+    (None, 0),
+])
+def test_parse_count(value, expected):
+    assert parse_count(value) == expected
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('1.46 GB', int(1.46 * 1024 ** 3)),
+    ('700 МБ', 700 * 1024 ** 2),
+    ('1,5 ГБ', int(1.5 * 1024 ** 3)),
+    (1024, 1024),
+    ('Unknown', None),
+])
+def test_parse_size(text, expected):
+    assert parse_size(text) == expected
+
+
+@pytest.mark.parametrize('name, source', [
+    ('Матрица / The Matrix (1999) WEB-DLRip | P', 'WEBRip'),
+    ('The.Matrix.1999.WEBDLRip.x264', 'WEBRip'),
+    ('The.Matrix.1999.1080p.WEB-DL.H.264', 'WEB-DL'),
+    ('The Matrix 1999 WEB 1080p', 'WEB-DL'),
+    ('The.Matrix.1999.1080p.BluRay.x264', 'BluRay'),
+    ('Матрица (1999) BDRip-AVC', 'BDRip'),
+])
+def test_parse_release_source(name, source):
+    assert parse_release(name)['source'] == source
+
+
+def test_parse_release_fields():
+    release = parse_release('The.Matrix.1999.2160p.UHD.BluRay.x265.10bit.HDR')
+    assert release['resolution'] == 2160
+    assert release['codec'] == 'H.265'
+    assert release['hdr'] == 'HDR'
+    assert release['year'] == 1999
+
+
+def test_parse_release_season_and_episode():
+    release = parse_release('The Matrix Season 3 S03E08 2160p WEB x264')
+    assert (release['season'], release['episode']) == (3, 8)
+
+
+@pytest.mark.parametrize('name, label', [
+    ('The Matrix 1999 4K HDR', '4K'),
+    ('The.Matrix.1999.2160p.UHD.BluRay', '2160p'),
+    ('The Matrix 1999 720p HDRip', '720p'),
+    ('Матрица (1999) DVDRip', 'DVDRip'),
+    ('Матрица', 'Unknown'),
+])
+def test_quality_label(name, label):
+    assert quality_label(parse_release(name), name) == label
+
+
+def test_year_mismatch_checks_every_year():
+    release = parse_release('Бегущий по лезвию 2049 (2017) BDRip')
+    assert not year_mismatch(release, 2017)
+    assert year_mismatch(release, 1982)
@@ -0,0 +1,107 @@
+"""Слияние и ранжирование результатов трекеров на страницах из benchmarks/fixtures"""
+import base64
+import math
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import trackers
+from releases import parse_release
+from tracker_parsing import FIXTURES, load_response
+
+HASH = 'c84d8dbc74254770f58904dba41ecccc3fc1626e'
+
+
+@pytest.fixture(scope='module')
+def ctx():
+    return trackers.build_search_context('Матрица', 'The Matrix', 1999, math.inf)
+
+
+@pytest.fixture(scope='module')
+def page_results(ctx):
+    """Результаты parse_page всех провайдеров по трекерам"""
+    providers = {provider.name: provider for provider in trackers.PROVIDERS}
+    results = {}
+    for name, (filename, content_type, query, base_url, _) in FIXTURES.items():
+        doc = trackers.parse_html(load_response(filename, content_type))
+        results[name] = providers[name].parse_page(doc, ctx, query, base_url)
+    return results
+
+
+def result(name, url, engine, seeds=0, magnet=None, torrent=None):
+    return {'name': name, 'url': url, 'engine': engine, 'seeds': seeds, 'leech': 0,
+            'magnet': magnet, 'torrent': torrent, 'release': parse_release(name)}
+
+
+def test_fixture_pages_keep_distinct_releases(ctx, page_results):
+    all_results = [item for results in page_results.values() for item in results]
+    ranked = trackers.rank_results(all_results, ctx, len(all_results))
+
+    for name, results in page_results.items():
+        assert results, name
+        merged = [item for item in ranked if item['sources'] == [name]]
+        # На странице поиска каждая строка — отдельная раздача
+        assert len(merged) == len(results), name
+        assert sorted(item['seeds'] for item in merged) == sorted(item['seeds'] for item in results), name
+
+
+def test_topics_of_one_tracker_stay_separate():
+    items = [
+        result('Матрица / The Matrix (1999) BDRip', 'https://rutracker.org/forum/viewtopic.php?t=1', 'RuTracker', 10),
+        result('Матрица / The Matrix (1999) WEB-DL', 'https://rutracker.org/forum/viewtopic.php?t=2', 'RuTracker', 20),
+    ]
+    merged = trackers.merge_results(items)
+    assert sorted(item['seeds'] for item in merged) == [10, 20]
+
+
+def test_mirror_pages_merge_without_double_counting():
+    items = [
+        result('The.Matrix.1999.1080p.BluRay', 'https://1337x.to/torrent/1/The-Matrix/', '1337x', 30),
+        result('The.Matrix.1999.1080p.BluRay', 'https://1337x.st/torrent/1/The-Matrix/', '1337x', 25),
+    ]
+    merged = trackers.merge_results(items)
+    assert len(merged) == 1
+    assert merged[0]['seeds'] == 30
+
+
+def test_same_infohash_sums_seeds_across_trackers():
+    base32 = base64.b32encode(bytes.fromhex(HASH)).decode()
+    items = [
+        result('The Matrix 1999 1080p', 'https://a/1', 'Rutor', 10, magnet=f'magnet:?xt=urn:btih:{HASH}'),
+        result('The Matrix 1999 1080p', 'https://a/2', 'Rutor', 7, magnet=f'magnet:?xt=urn:btih:{HASH.upper()}'),
+        result('The.Matrix.1999.1080p', 'https://b/1', 'YTS', 5, torrent=f'https://yts.mx/torrent/download/{HASH.upper()}'),
+        result('The.Matrix.1999.720p', 'https://c/1', 'EZTV', 3, magnet=f'magnet:?xt=urn:btih:{base32}'),
+    ]
+    [merged] = trackers.merge_results(items)
+    assert merged['infohash'] == HASH
+    # С одного трекера берется максимум, с разных трекеров сиды складываются
+    assert merged['seeds'] == 10 + 5 + 3
+    assert merged['sources'] == ['Rutor', 'YTS', 'EZTV']
+    assert merged['torrent'].endswith(HASH.upper())
+
+
+@pytest.mark.parametrize('name, year', [
+    ('Бегущий по лезвию 2049 (2017) BDRip 1080p', 2017),
+    ('1917 (2019) WEB-DL 1080p', 2019),
+    ('2012 (2009) BDRip 720p', 2009),
+])
+def test_year_score_uses_every_year_in_name(name, year):
+    ctx = trackers.build_search_context(None, name.split(' (')[0], year, math.inf)
+    ctx_other = trackers.build_search_context(None, name.split(' (')[0], year + 1, math.inf)
+    item = result(name, 'https://a/1', 'Rutor', 10)
+    [ranked] = trackers.rank_results([item], ctx, 10)
+    [other] = trackers.rank_results([item], ctx_other, 10)
+    assert ranked['score'] > other['score']
+
+
+def test_rank_results_returns_top_by_score(ctx, page_results):
+    all_results = [item for results in page_results.values() for item in results]
+    ranked = trackers.rank_results(all_results, ctx, 5)
+    assert len(ranked) == 5
+    scores = [item['score'] for item in ranked]
+    assert scores == sorted(scores, reverse=True)
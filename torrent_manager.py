@@ -0,0 +1,1082 @@
+"""Менеджер торрент-загрузок.
+
+Все торренты обслуживает одна сессия libtorrent и один фоновый поток, который
+разбирает ее события. Задания хранятся в таблице torrent_jobs и после
+перезапуска продолжаются с сохраненных resume data. Одновременно скачивается
+не больше max_active торрентов, остальные ждут своей очереди. Изменения
+состояния загрузок публикуются один раз в ProgressBus, а она раздает их
+подписчикам (SSE-потокам веб-сервера).
+
+Менеджер работает либо внутри веб-процесса (встроенный режим), либо отдельным
+процессом, с которым рабочие процессы веб-сервера общаются через Unix-сокет
+(TorrentManagerServer / TorrentManagerClient):
+
+    python torrent_manager.py
+"""
+import json
+import os
+import shutil
+import socket
+import socketserver
+import sqlite3
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import libtorrent as lt
+
+from bandwidth import BandwidthScheduler, PRIORITY_WEIGHTS, DEFAULT_PRIORITY
+
+# Состояния задания
+QUEUED = 'queued'
+DOWNLOADING = 'downloading'
+PAUSED = 'paused'
+IMPORTING = 'importing'
+COMPLETED = 'completed'
+ERROR = 'error'
+STOPPED = 'stopped'
+
+LIVE_STATUSES = (QUEUED, DOWNLOADING, PAUSED, IMPORTING)
+FINISHED_STATUSES = (COMPLETED, ERROR, STOPPED)
+
+# Действия пакетного управления и состояния, к которым они применимы
+CONTROL_ACTIONS = {
+    'pause': (QUEUED, DOWNLOADING),
+    'resume': (PAUSED,),
+    'stop': (QUEUED, DOWNLOADING, PAUSED),
+}
+
+# Интервалы фонового потока (в секундах)
+POLL_INTERVAL = 1
+RESUME_SAVE_INTERVAL = 60
+EVICT_INTERVAL = 30
+BANDWIDTH_INTERVAL = 2
+
+# Через сколько секунд отчет веб-процесса о передачах файлов считается устаревшим
+# (процесс завершился, не успев отправить последний отчет)
+HTTP_ACTIVITY_TTL = 15
+
+# Поля задания, которые отдаются наружу (остальные — внутреннее состояние менеджера)
+PUBLIC_FIELDS = (
+    'id', 'user_id', 'file_id', 'name', 'status', 'progress', 'download_rate', 'upload_rate',
+    'downloaded', 'total_size', 'eta', 'error', 'target_category', 'target_filename',
+    'created_at', 'updated_at', 'finished_at', 'priority', 'download_limit', 'upload_limit',
+    'import_progress', 'sequential', 'imported_files'
+)
+
+# Приоритеты кусков libtorrent: обычный и наивысший
+DEFAULT_PIECE_PRIORITY = 4
+TOP_PIECE_PRIORITY = 7
+
+# Колонки, которые переносятся из torrent_jobs в torrent_history при вытеснении задания
+HISTORY_COLUMNS = (
+    'id', 'user_id', 'file_id', 'info_hash', 'name', 'status', 'progress', 'downloaded', 'total_size',
+    'error', 'target_category', 'target_filename', 'created_at', 'finished_at'
+)
+
+
+class TorrentManagerError(Exception):
+    """Ошибка операции с загрузкой; текст можно показать пользователю"""
+
+
+class Subscription:
+    """Подписка на изменения загрузок. Медленный подписчик не копит очередь:
+    для каждой загрузки хранится только последнее неотправленное состояние"""
+    def __init__(self, bus, user_id, download_id=None):
+        self.bus = bus
+        self.user_id = user_id
+        self.download_id = download_id
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+
+    def matches(self, job):
+        return self.download_id is None or job['id'] == self.download_id
+
+    def push(self, job):
+        with self.lock:
+            self.pending[job['id']] = job
+            self.event.set()
+
+    def get(self, timeout=None):
+        """Ждет изменений и возвращает их списком (пустым, если за timeout ничего не произошло)"""
+        self.event.wait(timeout)
+        with self.lock:
+            changes = list(self.pending.values())
+            self.pending.clear()
+            self.event.clear()
+        return changes
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ProgressBus:
+    """Рассылка изменений состояния загрузок: менеджер публикует изменение один раз,
+    а шина раздает его всем подписчикам владельца загрузки"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        # user_id -> подписки; подписки с user_id=None получают изменения всех пользователей
+        self.subscribers = {}
+
+    def subscribe(self, user_id=None, download_id=None):
+        subscription = Subscription(self, user_id, download_id)
+        with self.lock:
+            self.subscribers.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.subscribers.get(subscription.user_id)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self.subscribers[subscription.user_id]
+
+    def has_subscribers(self, user_id):
+        with self.lock:
+            return bool(self.subscribers.get(user_id))
+
+    def users(self):
+        with self.lock:
+            return [user_id for user_id in self.subscribers if user_id is not None]
+
+    def publish(self, job):
+        with self.lock:
+            targets = list(self.subscribers.get(job['user_id'], ())) + list(self.subscribers.get(None, ()))
+        for subscription in targets:
+            if subscription.matches(job):
+                subscription.push(job)
+
+
+class JobRegistry:
+    """Задания в памяти с индексами по download_id, file_id, user_id и info_hash"""
+    def __init__(self):
+        self.by_id = {}
+        # file_id / user_id -> {download_id: задание} в порядке создания
+        self.by_file = {}
+        self.by_user = {}
+        # info_hash -> последнее задание с этой раздачей
+        self.by_hash = {}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def values(self):
+        return self.by_id.values()
+
+    def get(self, download_id):
+        return self.by_id.get(download_id)
+
+    def add(self, job):
+        self.by_id[job['id']] = job
+        self.by_file.setdefault(job['file_id'], {})[job['id']] = job
+        self.by_user.setdefault(job['user_id'], {})[job['id']] = job
+        self.by_hash[job['info_hash']] = job
+
+    def remove(self, job):
+        self.by_id.pop(job['id'], None)
+        for index, key in ((self.by_file, job['file_id']), (self.by_user, job['user_id'])):
+            jobs = index.get(key)
+            if jobs is not None:
+                jobs.pop(job['id'], None)
+                if not jobs:
+                    del index[key]
+        if self.by_hash.get(job['info_hash']) is job:
+            del self.by_hash[job['info_hash']]
+
+    def latest_for_file(self, file_id):
+        jobs = self.by_file.get(file_id)
+        return next(reversed(jobs.values())) if jobs else None
+
+    def for_user(self, user_id):
+        return list(self.by_user.get(user_id, {}).values())
+
+    def for_hash(self, info_hash):
+        return self.by_hash.get(info_hash)
+
+
+class TorrentManager:
+    def __init__(self, db_path, download_folder, max_active=3, listen_port=6881, on_complete=None, finished_ttl=300,
+                 bandwidth=None, on_file_complete=None):
+        self.db_path = db_path
+        self.download_folder = download_folder
+        self.max_active = max_active
+        self.listen_port = listen_port
+        # Сколько секунд завершенное задание остается в памяти, прежде чем уйти в torrent_history
+        self.finished_ttl = finished_ttl
+        self.bandwidth = bandwidth or BandwidthScheduler()
+        # Идущие в веб-процессах передачи файлов: процесс -> (число передач, время отчета)
+        self.http_activity = {}
+        self._session_limits = None
+        # on_complete(job, report) переносит скачанные файлы в хранилище, сообщая прогресс
+        # через report(перенесено, всего), и возвращает (target_category, target_filename);
+        # исключение переводит задание в ошибку
+        self.on_complete = on_complete
+        # on_file_complete(job, path) регистрирует в хранилище отдельный файл (path — путь внутри
+        # папки загрузки), как только он скачан, и возвращает (категория, имя файла)
+        self.on_file_complete = on_file_complete
+
+        self.jobs = JobRegistry()
+        self.finished = deque()
+        self.handles = {}
+        self.lock = threading.RLock()
+        self.bus = ProgressBus()
+        self.session = None
+        self.import_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='torrent-import')
+
+        self._db_local = threading.local()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._last_resume_save = time.time()
+        self._pending_resume = 0
+
+    # База данных
+
+    def _db(self):
+        conn = getattr(self._db_local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._db_local.conn = conn
+        return conn
+
+    def _save(self, job, *fields):
+        """Записывает в torrent_jobs указанные поля задания (и время изменения)"""
+        job['updated_at'] = datetime.now().isoformat()
+        fields = fields + ('updated_at',)
+        try:
+            conn = self._db()
+            conn.execute(
+                f"UPDATE torrent_jobs SET {', '.join(f'{field} = ?' for field in fields)} WHERE id = ?",
+                [json.dumps(job[field]) if isinstance(job[field], list) else job[field] for field in fields] + [job['id']]
+            )
+            conn.commit()
+        except sqlite3.Error as e:
+            print(f"Ошибка сохранения задания загрузки {job['id']}: {str(e)}")
+        self.bus.publish(self._public(job))
+
+    def _archive(self, download_ids=None):
+        """Переносит завершенные задания из torrent_jobs в torrent_history
+        (download_ids=None — все завершенные)"""
+        columns = ', '.join(HISTORY_COLUMNS)
+        conn = self._db()
+        try:
+            if download_ids is None:
+                condition = f"status IN ({', '.join('?' * len(FINISHED_STATUSES))})"
+                conn.execute(f"INSERT OR REPLACE INTO torrent_history ({columns}) SELECT {columns} FROM torrent_jobs WHERE {condition}", FINISHED_STATUSES)
+                conn.execute(f"DELETE FROM torrent_jobs WHERE {condition}", FINISHED_STATUSES)
+            else:
+                params = [(download_id,) for download_id in download_ids]
+                conn.executemany(f"INSERT OR REPLACE INTO torrent_history ({columns}) SELECT {columns} FROM torrent_jobs WHERE id = ?", params)
+                conn.executemany("DELETE FROM torrent_jobs WHERE id = ?", params)
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            print(f"Ошибка переноса заданий загрузки в историю: {str(e)}")
+
+    def _load_jobs(self):
+        """Восстанавливает незавершенные задания после перезапуска"""
+        self._archive()
+        conn = self._db()
+        rows = conn.execute(f"""
+        SELECT id, user_id, file_id, torrent_path, download_dir, info_hash, name, status,
+               progress, downloaded, total_size, resume_data, created_at, updated_at,
+               priority, download_limit, upload_limit, sequential, imported_files
+        FROM torrent_jobs WHERE status IN ({', '.join('?' * len(LIVE_STATUSES))})
+        ORDER BY created_at
+        """, LIVE_STATUSES).fetchall()
+
+        for row in rows:
+            job = self._new_job(*row[:7], created_at=row[12])
+            job.update({
+                'status': row[7], 'progress': row[8], 'downloaded': row[9], 'total_size': row[10],
+                'resume_data': row[11], 'updated_at': row[13],
+                'priority': row[14], 'download_limit': row[15], 'upload_limit': row[16],
+                'sequential': bool(row[17]), 'imported_files': json.loads(row[18]) if row[18] else [],
+                'check_files': row[8] > 0
+            })
+            # Торрент снова добавляется в сессию, когда до него дойдет очередь
+            if job['status'] == DOWNLOADING:
+                job['status'] = QUEUED
+            self.jobs.add(job)
+
+            if job['status'] == IMPORTING:
+                self.import_executor.submit(self._import_job, job)
+
+        if rows:
+            print(f"Восстановлено заданий торрент-загрузок: {len(rows)}")
+
+    # Жизненный цикл
+
+    def start(self):
+        self.session = lt.session({
+            'listen_interfaces': f'0.0.0.0:{self.listen_port},[::]:{self.listen_port}',
+            'alert_mask': (lt.alert_category.status | lt.alert_category.error | lt.alert_category.storage
+                           | lt.alert_category.file_progress),
+        })
+        with self.lock:
+            self._load_jobs()
+            self._schedule()
+
+        self._thread = threading.Thread(target=self._run, name='torrent-manager', daemon=True)
+        self._thread.start()
+
+    def shutdown(self, timeout=10):
+        """Останавливает фоновый поток и сохраняет resume data всех торрентов"""
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join(timeout)
+        self._thread = None
+
+        with self.lock:
+            self._request_resume_data(force=True)
+        deadline = time.time() + timeout
+        while self._pending_resume > 0 and time.time() < deadline:
+            if self.session.wait_for_alert(500):
+                self._handle_alerts()
+
+        self.session.pause()
+        self.import_executor.shutdown(wait=True)
+
+    def _run(self):
+        last_update = last_evict = last_bandwidth = 0
+        while not self._stopping.is_set():
+            try:
+                # Состояние торрентов запрашивается не чаще раза в POLL_INTERVAL,
+                # остальные события обрабатываются сразу по мере поступления
+                if time.time() - last_update >= POLL_INTERVAL:
+                    last_update = time.time()
+                    self.session.post_torrent_updates()
+                self.session.wait_for_alert(int(POLL_INTERVAL * 1000))
+                self._handle_alerts()
+
+                if time.time() - self._last_resume_save >= RESUME_SAVE_INTERVAL:
+                    self._last_resume_save = time.time()
+                    with self.lock:
+                        self._request_resume_data()
+
+                if time.time() - last_bandwidth >= BANDWIDTH_INTERVAL:
+                    last_bandwidth = time.time()
+                    self._apply_bandwidth()
+
+                if time.time() - last_evict >= EVICT_INTERVAL:
+                    last_evict = time.time()
+                    self._evict_finished()
+            except Exception as e:
+                print(f"Ошибка в цикле менеджера загрузок: {str(e)}")
+                time.sleep(POLL_INTERVAL)
+
+    def _evict_finished(self):
+        """Убирает из памяти задания, завершенные больше finished_ttl секунд назад"""
+        cutoff = (datetime.now() - timedelta(seconds=self.finished_ttl)).isoformat()
+        evicted = []
+        with self.lock:
+            while self.finished and self.finished[0]['finished_at'] < cutoff:
+                job = self.finished.popleft()
+                self.jobs.remove(job)
+                evicted.append(job['id'])
+            if evicted:
+                self._archive(evicted)
+
+    # Задания
+
+    def _new_job(self, download_id, user_id, file_id, torrent_path, download_dir, info_hash, name, created_at=None):
+        now = datetime.now().isoformat()
+        return {
+            'id': download_id,
+            'user_id': user_id,
+            'file_id': file_id,
+            'torrent_path': torrent_path,
+            'download_dir': download_dir,
+            'info_hash': info_hash,
+            'name': name,
+            'status': QUEUED,
+            'progress': 0,
+            'download_rate': 0,
+            'upload_rate': 0,
+            'downloaded': 0,
+            'total_size': 0,
+            'eta': None,
+            'error': None,
+            'target_category': None,
+            'target_filename': None,
+            'resume_data': None,
+            'handle': None,
+            'created_at': created_at or now,
+            'updated_at': now,
+            'finished_at': None,
+            'priority': DEFAULT_PRIORITY,
+            'download_limit': 0,
+            'upload_limit': 0,
+            'applied_download_limit': None,
+            'applied_upload_limit': None,
+            'import_progress': None,
+            # Последовательная загрузка с первыми и последними кусками каждого файла (для просмотра до конца загрузки)
+            'sequential': False,
+            # Файлы, уже зарегистрированные в хранилище до завершения торрента: {'path', 'category', 'filename'}
+            'imported_files': [],
+            # После перезапуска нужно найти файлы, докачанные, но еще не зарегистрированные
+            'check_files': False,
+            'pending_files': [],
+        }
+
+    def _public(self, job):
+        return {field: job[field] for field in PUBLIC_FIELDS}
+
+    def _get_job(self, download_id):
+        job = self.jobs.get(download_id)
+        if job is None:
+            raise TorrentManagerError('Загрузка не найдена')
+        return job
+
+    def add(self, user_id, file_id, torrent_path, priority=DEFAULT_PRIORITY, sequential=False):
+        """Ставит торрент в очередь загрузки и возвращает задание"""
+        if priority not in PRIORITY_WEIGHTS:
+            raise TorrentManagerError(f'Неизвестный приоритет: {priority}')
+        try:
+            info = lt.torrent_info(torrent_path)
+        except RuntimeError as e:
+            raise TorrentManagerError(f'Некорректный торрент-файл: {str(e)}')
+        info_hash = str(info.info_hashes().get_best())
+
+        with self.lock:
+            job = self.jobs.for_hash(info_hash)
+            if job is not None and job['status'] in LIVE_STATUSES:
+                # Повторный запуск той же раздачи подключается к уже идущей загрузке
+                if job['user_id'] == user_id:
+                    return self._public(job)
+                raise TorrentManagerError('Этот торрент уже скачивается')
+
+            download_id = str(uuid.uuid4())
+            download_dir = os.path.join(self.download_folder, 'torrents', download_id)
+            os.makedirs(download_dir, exist_ok=True)
+
+            job = self._new_job(download_id, user_id, file_id, torrent_path, download_dir, info_hash, info.name())
+            job['total_size'] = info.total_size()
+            job['priority'] = priority
+            job['sequential'] = bool(sequential)
+
+            conn = self._db()
+            conn.execute("""
+            INSERT INTO torrent_jobs (id, user_id, file_id, torrent_path, download_dir, info_hash, name,
+                                      status, total_size, priority, sequential, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (download_id, user_id, file_id, torrent_path, download_dir, info_hash, job['name'],
+                  job['status'], job['total_size'], priority, job['sequential'], job['created_at'], job['updated_at']))
+            conn.commit()
+
+            self.jobs.add(job)
+            self._schedule()
+            return self._public(job)
+
+    def _history_row(self, row):
+        job = dict(zip(HISTORY_COLUMNS, row))
+        job.update({
+            'download_rate': 0, 'upload_rate': 0, 'eta': None, 'updated_at': job['finished_at'],
+            'priority': DEFAULT_PRIORITY, 'download_limit': 0, 'upload_limit': 0, 'import_progress': None,
+            'sequential': False, 'imported_files': []
+        })
+        return {field: job[field] for field in PUBLIC_FIELDS}
+
+    def get(self, download_id):
+        with self.lock:
+            job = self.jobs.get(download_id)
+            if job is not None:
+                return self._public(job)
+
+        row = self._db().execute(
+            f"SELECT {', '.join(HISTORY_COLUMNS)} FROM torrent_history WHERE id = ?", (download_id,)
+        ).fetchone()
+        return self._history_row(row) if row else None
+
+    def find(self, file_id):
+        """Последнее задание, запущенное из торрент-файла file_id"""
+        with self.lock:
+            job = self.jobs.latest_for_file(file_id)
+            return self._public(job) if job else None
+
+    def list_jobs(self, user_id):
+        """Текущие и недавно завершенные загрузки пользователя"""
+        with self.lock:
+            return [self._public(job) for job in self.jobs.for_user(user_id)]
+
+    def history(self, user_id, limit=50):
+        """Завершенные загрузки пользователя, начиная с последних"""
+        rows = self._db().execute(
+            f"SELECT {', '.join(HISTORY_COLUMNS)} FROM torrent_history WHERE user_id = ? ORDER BY finished_at DESC LIMIT ?",
+            (user_id, limit)
+        ).fetchall()
+        return [self._history_row(row) for row in rows]
+
+    def subscribe(self, user_id, download_id=None):
+        """Подписка на изменения загрузок пользователя (или одной загрузки)"""
+        return self.bus.subscribe(user_id, download_id)
+
+    def control(self, user_id, action, download_ids=None):
+        """Пакетное управление загрузками пользователя: action — pause, resume или stop;
+        download_ids=None — все загрузки пользователя, к которым применимо действие.
+        Возвращает {download_id: задание или {'error': ...} (без поля status)}"""
+        if action not in CONTROL_ACTIONS:
+            raise TorrentManagerError(f'Неизвестное действие: {action}')
+        apply = getattr(self, f'_{action}_job')
+
+        with self.lock:
+            if download_ids is None:
+                download_ids = [job['id'] for job in self.jobs.for_user(user_id) if job['status'] in CONTROL_ACTIONS[action]]
+
+            results = {}
+            for download_id in download_ids:
+                job = self.jobs.get(download_id)
+                if job is None or job['user_id'] != user_id:
+                    results[download_id] = {'error': 'Загрузка не найдена'}
+                    continue
+                try:
+                    apply(job)
+                    results[download_id] = job
+                except TorrentManagerError as e:
+                    results[download_id] = {'error': str(e)}
+
+            # Освободившиеся слоты занимаются один раз после всей пачки
+            self._schedule()
+            return {
+                download_id: self._public(result) if 'status' in result else result
+                for download_id, result in results.items()
+            }
+
+    def configure(self, user_id, download_ids, priority=None, download_limit=None, upload_limit=None, sequential=None):
+        """Приоритет, собственные ограничения скорости (байт/с, 0 — без ограничения)
+        и режим последовательной загрузки загрузок пользователя.
+        Возвращает {download_id: задание или {'error': ...}}"""
+        if priority is not None and priority not in PRIORITY_WEIGHTS:
+            raise TorrentManagerError(f'Неизвестный приоритет: {priority}')
+        for limit in (download_limit, upload_limit):
+            if limit is not None and (not isinstance(limit, int) or limit < 0):
+                raise TorrentManagerError('Ограничение скорости должно быть неотрицательным числом байт в секунду')
+        if sequential is not None and not isinstance(sequential, bool):
+            raise TorrentManagerError('sequential должен быть true или false')
+        changes = {'priority': priority, 'download_limit': download_limit, 'upload_limit': upload_limit,
+                   'sequential': sequential}
+        changes = {field: value for field, value in changes.items() if value is not None}
+
+        with self.lock:
+            results = {}
+            for download_id in download_ids:
+                job = self.jobs.get(download_id)
+                if job is None or job['user_id'] != user_id:
+                    results[download_id] = {'error': 'Загрузка не найдена'}
+                    continue
+                job.update(changes)
+                self._save(job, *changes)
+                if sequential is not None and job['handle'] is not None:
+                    self._apply_download_mode(job)
+                results[download_id] = self._public(job)
+
+        # Новый приоритет влияет и на очередь, и на распределение полосы
+        with self.lock:
+            self._schedule()
+        self._apply_bandwidth()
+        return results
+
+    def report_activity(self, reporter, active):
+        """Отчет веб-процесса reporter о числе идущих передач файлов пользователям"""
+        self.http_activity[reporter] = (active, time.time())
+        if active:
+            # Полоса освобождается под пользователей сразу, не дожидаясь очередного пересчета
+            self._apply_bandwidth()
+
+    def _interactive_transfers(self):
+        cutoff = time.time() - HTTP_ACTIVITY_TTL
+        return sum(active for active, reported_at in list(self.http_activity.values()) if reported_at >= cutoff)
+
+    def _apply_bandwidth(self):
+        """Пересчитывает общие лимиты сессии и лимиты каждого активного торрента"""
+        if self.session is None:
+            return
+        busy = self._interactive_transfers() > 0
+        with self.lock:
+            active = [job for job in self.jobs.values() if job['status'] == DOWNLOADING and job['handle'] is not None]
+            session_limits, allocation = self.bandwidth.allocate(active, busy=busy)
+
+            if session_limits != self._session_limits:
+                self._session_limits = session_limits
+                self.session.apply_settings({
+                    'download_rate_limit': session_limits['download'],
+                    'upload_rate_limit': session_limits['upload'],
+                })
+
+            for job in active:
+                limits = allocation[job['id']]
+                if limits['download'] != job['applied_download_limit']:
+                    job['handle'].set_download_limit(limits['download'])
+                    job['applied_download_limit'] = limits['download']
+                if limits['upload'] != job['applied_upload_limit']:
+                    job['handle'].set_upload_limit(limits['upload'])
+                    job['applied_upload_limit'] = limits['upload']
+
+    def _pause_job(self, job):
+        if job['status'] not in CONTROL_ACTIONS['pause']:
+            raise TorrentManagerError('Невозможно приостановить загрузку')
+
+        if job['handle'] is not None:
+            job['handle'].pause()
+            job['handle'].save_resume_data(lt.save_resume_flags_t.save_info_dict)
+            self._pending_resume += 1
+        job['status'] = PAUSED
+        job['download_rate'] = job['upload_rate'] = 0
+        job['eta'] = None
+        self._save(job, 'status', 'progress', 'downloaded')
+
+    def _resume_job(self, job):
+        if job['status'] not in CONTROL_ACTIONS['resume']:
+            raise TorrentManagerError('Невозможно возобновить загрузку')
+
+        # Возобновленная загрузка встает в очередь, если все слоты заняты
+        job['status'] = QUEUED
+        self._save(job, 'status')
+
+    def _stop_job(self, job):
+        """Отменяет загрузку и удаляет недокачанные данные"""
+        if job['status'] not in CONTROL_ACTIONS['stop']:
+            raise TorrentManagerError('Невозможно остановить загрузку')
+
+        self._remove_handle(job, delete_files=True)
+        job['resume_data'] = None
+        self._finish(job, STOPPED, 'resume_data')
+        shutil.rmtree(job['download_dir'], ignore_errors=True)
+
+    def _finish(self, job, status, *fields):
+        """Переводит задание в конечное состояние; из памяти оно уйдет через finished_ttl секунд"""
+        job['status'] = status
+        job['finished_at'] = datetime.now().isoformat()
+        job['download_rate'] = job['upload_rate'] = 0
+        job['eta'] = None
+        self._save(job, 'status', 'finished_at', *fields)
+        self.finished.append(job)
+
+    # Очередь и сессия
+
+    def _schedule(self):
+        """Запускает ожидающие задания, пока есть свободные слоты"""
+        active = sum(1 for job in self.jobs.values() if job['status'] == DOWNLOADING)
+        # Задания с более высоким приоритетом запускаются первыми
+        queued = sorted(
+            (job for job in self.jobs.values() if job['status'] == QUEUED),
+            key=lambda job: (-PRIORITY_WEIGHTS.get(job['priority'], 0), job['created_at'])
+        )
+
+        started = False
+        for job in queued:
+            if active >= self.max_active:
+                break
+            try:
+                if job['handle'] is None:
+                    self._add_handle(job)
+                else:
+                    job['handle'].resume()
+                job['status'] = DOWNLOADING
+                self._save(job, 'status')
+                active += 1
+                started = True
+            except Exception as e:
+                self._fail(job, f'Ошибка при запуске загрузки: {str(e)}')
+
+        # Новые торренты сразу получают свою долю полосы
+        if started:
+            self._apply_bandwidth()
+
+    def _add_handle(self, job):
+        if job['resume_data']:
+            params = lt.read_resume_data(job['resume_data'])
+        else:
+            params = lt.add_torrent_params()
+        if params.ti is None:
+            params.ti = lt.torrent_info(job['torrent_path'])
+        params.save_path = job['download_dir']
+        # Очередью управляет менеджер, а не автоматика libtorrent
+        params.flags = (params.flags | lt.torrent_flags.duplicate_is_error) & ~lt.torrent_flags.auto_managed & ~lt.torrent_flags.paused
+
+        handle = self.session.add_torrent(params)
+        job['handle'] = handle
+        job['applied_download_limit'] = job['applied_upload_limit'] = None
+        self.handles[handle] = job['id']
+        if job['sequential']:
+            self._apply_download_mode(job)
+
+    def _apply_download_mode(self, job):
+        """Последовательная загрузка: куски идут по порядку, а первый и последний кусок
+        каждого файла — раньше остальных, чтобы плеер сразу прочитал заголовок и индекс видео"""
+        handle = job['handle']
+        info = handle.torrent_file()
+        if not job['sequential']:
+            handle.unset_flags(lt.torrent_flags.sequential_download)
+            handle.prioritize_pieces([DEFAULT_PIECE_PRIORITY] * info.num_pieces())
+            return
+
+        handle.set_flags(lt.torrent_flags.sequential_download)
+        files = info.files()
+        for index in range(files.num_files()):
+            size = files.file_size(index)
+            if size == 0 or files.file_flags(index) & lt.file_storage.flag_pad_file:
+                continue
+            for offset in (0, size - 1):
+                handle.piece_priority(info.map_file(index, offset, 1).piece, TOP_PIECE_PRIORITY)
+
+    def _remove_handle(self, job, delete_files=False):
+        handle = job['handle']
+        if handle is None:
+            return
+        job['handle'] = None
+        self.handles.pop(handle, None)
+        if delete_files:
+            self.session.remove_torrent(handle, lt.options_t.delete_files)
+        else:
+            self.session.remove_torrent(handle)
+
+    def _request_resume_data(self, force=False):
+        for job in self.jobs.values():
+            handle = job['handle']
+            if handle is not None and (force or handle.need_save_resume_data()):
+                handle.save_resume_data(lt.save_resume_flags_t.save_info_dict)
+                self._pending_resume += 1
+
+    def _fail(self, job, error):
+        print(f"Ошибка торрент-загрузки {job['id']}: {error}")
+        self._remove_handle(job)
+        job['error'] = error
+        self._finish(job, ERROR, 'error')
+
+    # События libtorrent
+
+    def _handle_alerts(self):
+        with self.lock:
+            for alert in self.session.pop_alerts():
+                if isinstance(alert, lt.state_update_alert):
+                    for status in alert.status:
+                        self._update_status(status)
+                elif isinstance(alert, lt.file_completed_alert):
+                    self._on_file_completed(alert.handle, alert.index)
+                elif isinstance(alert, lt.cache_flushed_alert):
+                    self._on_cache_flushed(alert.handle)
+                elif isinstance(alert, lt.torrent_finished_alert):
+                    self._on_finished(alert.handle)
+                elif isinstance(alert, lt.save_resume_data_alert):
+                    self._pending_resume -= 1
+                    self._store_resume_data(alert.handle, lt.write_resume_data_buf(alert.params))
+                elif isinstance(alert, lt.save_resume_data_failed_alert):
+                    self._pending_resume -= 1
+                elif isinstance(alert, lt.torrent_error_alert):
+                    download_id = self.handles.get(alert.handle)
+                    if download_id:
+                        self._fail(self.jobs.get(download_id), alert.message())
+
+    def _update_status(self, status):
+        download_id = self.handles.get(status.handle)
+        job = self.jobs.get(download_id)
+        if job is None or job['status'] != DOWNLOADING:
+            return
+
+        job['progress'] = round(status.progress * 100, 1)
+        job['download_rate'] = status.download_payload_rate
+        job['upload_rate'] = status.upload_payload_rate
+        job['downloaded'] = status.total_wanted_done
+        job['total_size'] = status.total_wanted
+        remaining = status.total_wanted - status.total_wanted_done
+        job['eta'] = int(remaining / status.download_payload_rate) if status.download_payload_rate > 0 else None
+        self.bus.publish(self._public(job))
+
+        # После перезапуска file_completed_alert для уже докачанных файлов не приходит:
+        # ищем их сами, когда libtorrent закончит проверку данных
+        if job['check_files'] and status.state not in (lt.torrent_status.checking_files, lt.torrent_status.checking_resume_data):
+            job['check_files'] = False
+            files = status.handle.torrent_file().files()
+            progress = status.handle.file_progress(lt.torrent_handle.piece_granularity)
+            for index in range(files.num_files()):
+                if progress[index] == files.file_size(index):
+                    self._on_file_completed(status.handle, index)
+
+    def _store_resume_data(self, handle, data):
+        download_id = self.handles.get(handle)
+        job = self.jobs.get(download_id)
+        if job is None:
+            return
+        job['resume_data'] = data
+        self._save(job, 'resume_data', 'progress', 'downloaded', 'total_size')
+
+    def _on_file_completed(self, handle, index):
+        """Докачанный файл многофайлового торрента сразу регистрируется в хранилище,
+        не дожидаясь остальных файлов"""
+        download_id = self.handles.get(handle)
+        job = self.jobs.get(download_id)
+        if job is None or job['status'] != DOWNLOADING or self.on_file_complete is None:
+            return
+
+        files = handle.torrent_file().files()
+        # Единственный файл переносится вместе со всем торрентом
+        if sum(1 for i in range(files.num_files()) if not files.file_flags(i) & lt.file_storage.flag_pad_file) < 2:
+            return
+        if files.file_size(index) == 0 or files.file_flags(index) & lt.file_storage.flag_pad_file:
+            return
+
+        path = files.file_path(index)
+        if path in job['pending_files'] or any(imported['path'] == path for imported in job['imported_files']):
+            return
+        # Проверенный кусок может быть еще не записан на диск: файл регистрируется после cache_flushed_alert
+        job['pending_files'].append(path)
+        handle.flush_cache()
+
+    def _on_cache_flushed(self, handle):
+        download_id = self.handles.get(handle)
+        job = self.jobs.get(download_id)
+        if job is None:
+            return
+        # Тот же поток, что и у переноса всего торрента: финальный перенос увидит уже зарегистрированные файлы
+        for path in job['pending_files']:
+            self.import_executor.submit(self._import_file, job, path)
+        job['pending_files'] = []
+
+    def _import_file(self, job, path):
+        with self.lock:
+            # Остановленная загрузка удаляет файлы, упавшая ждет повторного запуска
+            if job['status'] not in (DOWNLOADING, PAUSED, IMPORTING):
+                return
+            if any(imported['path'] == path for imported in job['imported_files']):
+                return
+            public = self._public(job) | {'download_dir': job['download_dir']}
+
+        try:
+            category, filename = self.on_file_complete(public, path)
+        except Exception as e:
+            # Файл будет перенесен вместе со всем торрентом
+            print(f"Ошибка регистрации файла {path} загрузки {job['id']}: {str(e)}")
+            return
+
+        with self.lock:
+            # Новый список, а не append: опубликованные ранее состояния не должны меняться
+            job['imported_files'] = job['imported_files'] + [{'path': path, 'category': category, 'filename': filename}]
+            if job['target_category'] is None:
+                job['target_category'] = category
+                job['target_filename'] = filename
+            self._save(job, 'imported_files', 'target_category', 'target_filename')
+
+    def _on_finished(self, handle):
+        download_id = self.handles.get(handle)
+        job = self.jobs.get(download_id)
+        if job is None or job['status'] != DOWNLOADING:
+            return
+
+        # Торрент больше не раздается: файлы переносятся в хранилище, слот освобождается
+        self._remove_handle(job)
+        job['status'] = IMPORTING
+        job['progress'] = 100
+        job['downloaded'] = job['total_size']
+        job['download_rate'] = job['upload_rate'] = 0
+        job['eta'] = None
+        self._save(job, 'status', 'progress', 'downloaded')
+        self._schedule()
+        self.import_executor.submit(self._import_job, job)
+
+    def _report_import(self, job, done, total):
+        """Прогресс переноса файлов в хранилище; подписчикам отправляется только смена процента"""
+        percent = int(done * 100 / total) if total else 100
+        with self.lock:
+            if percent == job['import_progress']:
+                return
+            job['import_progress'] = percent
+            self.bus.publish(self._public(job))
+
+    def _import_job(self, job):
+        try:
+            if self.on_complete is None:
+                raise RuntimeError('Не задан обработчик завершения загрузки')
+            target_category, target_filename = self.on_complete(
+                self._public(job) | {'download_dir': job['download_dir']},
+                lambda done, total: self._report_import(job, done, total)
+            )
+        except Exception as e:
+            with self.lock:
+                self._fail(job, f'Ошибка при перемещении файлов: {str(e)}')
+            return
+
+        shutil.rmtree(job['download_dir'], ignore_errors=True)
+        with self.lock:
+            job['target_category'] = target_category
+            job['target_filename'] = target_filename
+            job['resume_data'] = None
+            self._finish(job, COMPLETED, 'progress', 'downloaded', 'target_category', 'target_filename', 'resume_data')
+
+
+# Межпроцессное взаимодействие: по одному JSON-объекту на строку в обе стороны.
+# Запрос: {"cmd": "add", "args": {...}}; ответ: {"result": ...} или {"error": "..."}.
+# После команды subscribe соединение только получает изменения загрузок: {"event": {...}}
+
+# Как часто (в секундах) в поток подписки отправляется пустое сообщение, чтобы заметить разрыв соединения
+SUBSCRIBE_HEARTBEAT = 15
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        manager = self.server.manager
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                command = request.get('cmd')
+                if command == 'subscribe':
+                    self.stream_events(manager)
+                    return
+                if command not in TorrentManagerServer.COMMANDS:
+                    raise TorrentManagerError(f'Неизвестная команда: {command}')
+                reply = {'result': getattr(manager, command)(**request.get('args', {}))}
+            except TorrentManagerError as e:
+                reply = {'error': str(e)}
+            except Exception as e:
+                print(f"Ошибка обработки команды менеджера загрузок: {str(e)}")
+                reply = {'error': 'Внутренняя ошибка менеджера загрузок'}
+
+            self.wfile.write(json.dumps(reply, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+    def stream_events(self, manager):
+        """Пересылает веб-процессу все изменения загрузок, пока он не отключится"""
+        with manager.bus.subscribe() as subscription:
+            try:
+                while True:
+                    changes = subscription.get(SUBSCRIBE_HEARTBEAT)
+                    lines = [json.dumps({'event': job}, ensure_ascii=False) for job in changes] or ['{}']
+                    self.wfile.write(('\n'.join(lines) + '\n').encode('utf-8'))
+                    self.wfile.flush()
+            except OSError:
+                pass
+
+
+class TorrentManagerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Принимает команды рабочих процессов веб-сервера через Unix-сокет"""
+    COMMANDS = ('add', 'get', 'find', 'list_jobs', 'history', 'control', 'configure', 'report_activity')
+    daemon_threads = True
+
+    def __init__(self, manager, socket_path):
+        self.manager = manager
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        super().__init__(socket_path, _RequestHandler)
+        os.chmod(socket_path, 0o600)
+
+
+class TorrentManagerClient:
+    """Клиент менеджера, запущенного отдельным процессом; интерфейс тот же, что у TorrentManager"""
+    def __init__(self, socket_path, timeout=10):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._local = threading.local()
+        # Изменения загрузок приходят по одному соединению на процесс и раздаются через локальную шину
+        self.bus = ProgressBus()
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            conn = self._local.conn = (sock, sock.makefile('rb'))
+        return conn
+
+    def _disconnect(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            conn[1].close()
+            conn[0].close()
+
+    def _call(self, command, **args):
+        payload = json.dumps({'cmd': command, 'args': args}, ensure_ascii=False).encode('utf-8') + b'\n'
+        # Соединение потока переиспользуется; если менеджер перезапускался, пробуем переподключиться один раз
+        for attempt in range(2):
+            try:
+                sock, reader = self._connection()
+                sock.sendall(payload)
+                line = reader.readline()
+                if not line:
+                    raise ConnectionError('соединение закрыто')
+                break
+            except OSError as e:
+                self._disconnect()
+                if attempt:
+                    raise TorrentManagerError(f'Менеджер загрузок недоступен: {str(e)}')
+
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise TorrentManagerError(reply['error'])
+        return reply['result']
+
+    def add(self, user_id, file_id, torrent_path, priority=DEFAULT_PRIORITY, sequential=False):
+        return self._call('add', user_id=user_id, file_id=file_id, torrent_path=torrent_path, priority=priority,
+                          sequential=sequential)
+
+    def get(self, download_id):
+        return self._call('get', download_id=download_id)
+
+    def find(self, file_id):
+        return self._call('find', file_id=file_id)
+
+    def list_jobs(self, user_id):
+        return self._call('list_jobs', user_id=user_id)
+
+    def subscribe(self, user_id, download_id=None):
+        with self._listener_lock:
+            if self._listener is None:
+                self._listener = threading.Thread(target=self._listen, name='torrent-events', daemon=True)
+                self._listener.start()
+        return self.bus.subscribe(user_id, download_id)
+
+    def _listen(self):
+        """Держит соединение-подписку с менеджером и публикует полученные изменения в локальную шину"""
+        while True:
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.settimeout(SUBSCRIBE_HEARTBEAT * 2)
+                    sock.connect(self.socket_path)
+                    sock.sendall(b'{"cmd": "subscribe"}\n')
+
+                    # Пока соединения не было, изменения могли потеряться: подписчики получают текущее состояние
+                    for user_id in self.bus.users():
+                        for job in self.list_jobs(user_id):
+                            self.bus.publish(job)
+
+                    for line in sock.makefile('rb'):
+                        event = json.loads(line).get('event')
+                        if event is not None:
+                            self.bus.publish(event)
+            except (OSError, ValueError, TorrentManagerError) as e:
+                print(f"Соединение с менеджером загрузок потеряно: {str(e)}")
+            time.sleep(1)
+
+    def history(self, user_id, limit=50):
+        return self._call('history', user_id=user_id, limit=limit)
+
+    def control(self, user_id, action, download_ids=None):
+        return self._call('control', user_id=user_id, action=action, download_ids=download_ids)
+
+    def configure(self, user_id, download_ids, priority=None, download_limit=None, upload_limit=None, sequential=None):
+        return self._call('configure', user_id=user_id, download_ids=download_ids, priority=priority,
+                          download_limit=download_limit, upload_limit=upload_limit, sequential=sequential)
+
+    def report_activity(self, reporter, active):
+        return self._call('report_activity', reporter=reporter, active=active)
+
+
+if __name__ == '__main__':
+    # Отдельный процесс менеджера: настройки, схема БД и перенос готовых файлов берутся из server.py
+    import server
+    server.serve_torrent_manager()
@@ -0,0 +1,853 @@
+"""Поиск торрентов на трекерах.
+
+Каждый трекер — отдельный провайдер (подкласс TorrentProvider). Провайдеры
+опрашиваются параллельно на общем пуле потоков с общим дедлайном, результаты
+отдаются по мере готовности.
+"""
+import base64
+import heapq
+import math
+import re
+import time
+import urllib.parse
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import lxml.html
+from lxml import etree
+
+from cache import normalize_key, CachedFailure, Uncached, UncacheableError
+from http_client import HttpClient
+from releases import parse_release, parse_size, parse_count, quality_label, year_mismatch
+
+# Таймаут одного HTTP-запроса к трекеру, секунд
+REQUEST_TIMEOUT = 5
+
+def clean_title(title):
+    """Название без специальных символов, которые могут мешать поиску"""
+    if not title:
+        return ""
+    cleaned = re.sub(r'[^\w\s]', ' ', title)
+    # Удаляем лишние пробелы
+    return re.sub(r'\s+', ' ', cleaned).strip()
+
+def build_search_context(title_ru, title_en, year, deadline):
+    """Параметры поиска для фильма, общие для всех провайдеров.
+    deadline — момент time.monotonic(), после которого провайдеры прекращают запросы"""
+    clean_title_ru = clean_title(title_ru)
+    clean_title_en = clean_title(title_en)
+
+    # Создаем различные варианты поисковых запросов в порядке приоритета
+    search_queries = []
+    if title_en:
+        search_queries.append(f"{title_en} {year}")  # Оригинальное название + год
+        search_queries.append(clean_title_en + f" {year}")  # Очищенное название + год
+
+    if title_ru and title_ru != title_en:  # Если есть русское название и оно отличается от английского
+        search_queries.append(f"{title_ru} {year}")  # Русское название + год
+        search_queries.append(clean_title_ru + f" {year}")  # Очищенное русское название + год
+
+    # Добавляем запросы без года как запасные варианты
+    if title_en:
+        search_queries.append(title_en)
+    if title_ru and title_ru != title_en:
+        search_queries.append(title_ru)
+
+    # Удаляем дубликаты, сохраняя порядок
+    search_queries = list(dict.fromkeys(search_queries))
+
+    series_words = ['season', 'series', 'episode', 'сезон', 'серия', 'эпизод']
+    is_series = any(word in (title_en or "").lower() + (title_ru or "").lower() for word in series_words)
+
+    return {
+        'title_ru': title_ru,
+        'title_en': title_en,
+        'year': year,
+        'clean_title_ru': clean_title_ru,
+        'clean_title_en': clean_title_en,
+        'search_queries': search_queries,
+        'is_series': is_series,
+        'deadline': deadline,
+    }
+
+def time_left(ctx):
+    return ctx['deadline'] - time.monotonic()
+
+def request_timeout(ctx):
+    """Таймаут очередного запроса: не дольше REQUEST_TIMEOUT и не позже общего дедлайна"""
+    return max(0.1, min(REQUEST_TIMEOUT, time_left(ctx)))
+
+# Страницы трекеров разбираются lxml, а строки результатов выбираются заранее
+# скомпилированными XPath-запросами (атрибуты классов провайдеров)
+CHARSET_RE = re.compile(r'charset=["\']?([\w-]+)', re.IGNORECASE)
+
+def parse_html(response):
+    """Дерево lxml для HTML-ответа. Кодировка берется из Content-Type, а если ее там нет —
+    из meta-тега страницы (libxml2 определяет ее сам по байтам)"""
+    charset = CHARSET_RE.search(response.headers.get('Content-Type', ''))
+    # Парсер нельзя использовать из нескольких потоков одновременно, поэтому он создается на каждый разбор
+    parser = lxml.html.HTMLParser(encoding=charset.group(1) if charset else None)
+    return lxml.html.document_fromstring(response.content or b'<html></html>', parser=parser)
+
+def has_class(name):
+    """Условие XPath «у элемента есть класс name» (как .name в CSS)"""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+def first(query, element):
+    """Первый элемент, найденный запросом, или None"""
+    found = query(element)
+    return found[0] if found else None
+
+def element_text(element):
+    """Весь текст элемента без пробелов по краям"""
+    return ''.join(element.itertext()).strip()
+
+def stripped_text(element):
+    """Текст элемента, в котором каждый фрагмент обрезан (как get_text(strip=True) в BeautifulSoup)"""
+    return ''.join(part.strip() for part in element.itertext())
+
+def matches_query(torrent_name, query):
+    """Название содержит хотя бы одно значимое слово запроса"""
+    torrent_name_lower = torrent_name.lower()
+    return any(part in torrent_name_lower for part in query.lower().split() if len(part) > 2)
+
+
+class TorrentProvider(ABC):
+    """Базовый класс провайдера поиска"""
+    name = ''
+
+    def applicable(self, ctx):
+        """Имеет ли смысл искать этим провайдером"""
+        return bool(ctx['search_queries'])
+
+    def cache_key(self, ctx):
+        """Ключ кэша результатов: результат зависит только от названий и года фильма"""
+        return normalize_key(ctx['title_ru'], ctx['title_en'], ctx['year'])
+
+    @abstractmethod
+    def search(self, ctx, session):
+        """Возвращает список найденных торрентов"""
+
+    def make_result(self, name, release, url, size, seeds, leech, magnet=None, torrent=None,
+                    quality=None, size_bytes=None):
+        """Результат в общем для всех провайдеров виде: размер в байтах, сиды и личи числами,
+        признаки релиза из названия (release — результат releases.parse_release)"""
+        return {
+            'name': name,
+            'url': url,
+            'size': size,
+            'size_bytes': size_bytes if size_bytes is not None else parse_size(size),
+            'quality': quality or quality_label(release, name),
+            'seeds': parse_count(seeds),
+            'leech': parse_count(leech),
+            'engine': self.name,
+            'magnet': magnet,
+            'torrent': torrent,
+            'release': release,
+        }
+
+
+class HtmlTorrentProvider(TorrentProvider):
+    """Провайдер, который разбирает HTML-страницу поиска трекера (у YTS вместо нее JSON API)"""
+
+    @abstractmethod
+    def parse_page(self, doc, ctx, query, base_url=None):
+        """Результаты со страницы поиска трекера (doc — дерево из parse_html)"""
+
+
+class RutorProvider(HtmlTorrentProvider):
+    """Rutor: русские и зарубежные фильмы"""
+    name = 'Rutor'
+
+    rows = etree.XPath('(//*[@id="index"])[1]//tr[preceding-sibling::*]')
+    cells = etree.XPath('.//td')
+    magnet_link = etree.XPath('.//a[starts-with(@href, "magnet:")]')
+    torrent_link = etree.XPath(f'.//a[{has_class("downgif")}]')
+    # Ссылка на страницу раздачи — не магнет и не ссылка на скачивание .torrent
+    name_link = etree.XPath(f'.//a[not(starts-with(@href, "magnet:")) and not({has_class("downgif")})]')
+    seeds = etree.XPath(f'.//span[{has_class("green")}]')
+    leeches = etree.XPath(f'.//span[{has_class("red")}]')
+
+    def search(self, ctx, session):
+        results = []
+
+        for query in ctx['search_queries'][:2]:  # Используем только первые два запроса
+            if time_left(ctx) <= 0:
+                break
+
+            rutor_search_url = f"http://rutor.info/search/{urllib.parse.quote(query)}"
+            response = session.get(rutor_search_url, timeout=request_timeout(ctx))
+            if response.status_code != 200:
+                continue
+
+            results.extend(self.parse_page(parse_html(response), ctx, query))
+
+            # Если нашли хотя бы 3 результата, можно прекратить поиск на данном трекере
+            if len(results) >= 3:
+                break
+
+        return results
+
+    def parse_page(self, doc, ctx, query, base_url=None):
+        results = []
+        year = ctx['year']
+
+        for row in self.rows(doc)[:10]:  # Берем только первые 10 результатов
+            try:
+                cells = self.cells(row)
+                if len(cells) < 4:
+                    continue
+
+                # Ячейка комментариев есть не у всех раздач, поэтому размер и пиры берутся с конца строки
+                name_cell = cells[1]
+                size_cell = cells[-2]
+                seeds = first(self.seeds, cells[-1])
+                leeches = first(self.leeches, cells[-1])
+
+                # Ссылка на торрент
+                magnet_link = first(self.magnet_link, name_cell)
+                torrent_link = first(self.torrent_link, name_cell)
+
+                # Название торрента
+                name_tag = first(self.name_link, name_cell)
+                if name_tag is None:
+                    continue
+
+                torrent_name = stripped_text(name_tag)
+                release = parse_release(torrent_name)
+
+                # Проверяем соответствие запросу по году
+                if year_mismatch(release, year):
+                    continue
+
+                # Проверяем, чтобы название содержало как минимум часть запроса
+                if not matches_query(torrent_name, query):
+                    continue
+
+                # URL для деталей
+                detail_url = "http://rutor.info" + name_tag.get('href') if name_tag.get('href') is not None else None
+
+                magnet = magnet_link.get('href') if magnet_link is not None else None
+                torrent_href = torrent_link.get('href') if torrent_link is not None else None
+
+                results.append(self.make_result(
+                    torrent_name, release,
+                    # URL для использования в приложении (магнет или страница с деталями)
+                    url=magnet or detail_url or "",
+                    size=stripped_text(size_cell),
+                    seeds=stripped_text(seeds) if seeds is not None else 0,
+                    leech=stripped_text(leeches) if leeches is not None else 0,
+                    magnet=magnet,
+                    torrent="http://rutor.info" + torrent_href if torrent_href is not None else None
+                ))
+            except Exception as e:
+                print(f"Ошибка при разборе результата Rutor: {str(e)}")
+                continue
+
+        return results
+
+
+class YTSProvider(TorrentProvider):
+    """YTS/YIFY через API: хорошо для иностранных фильмов"""
+    name = 'YTS/YIFY'
+
+    def search(self, ctx, session):
+        results = []
+        year = ctx['year']
+
+        for query in ctx['search_queries'][:2]:  # Используем только первые два запроса для YTS
+            if time_left(ctx) <= 0:
+                break
+
+            yts_api_url = f"https://yts.mx/api/v2/list_movies.json?query_term={urllib.parse.quote(query)}&limit=10&sort=seeds"
+            yts_response = session.get(yts_api_url, timeout=request_timeout(ctx))
+            if yts_response.status_code != 200:
+                continue
+
+            yts_data = yts_response.json()
+            if yts_data.get('status') != 'ok' or yts_data.get('data', {}).get('movie_count', 0) == 0:
+                continue
+
+            for movie_data in yts_data.get('data', {}).get('movies', []):
+                movie_title = movie_data.get('title_long', '')
+                movie_year = movie_data.get('year', 0)
+
+                # Проверяем соответствие года (если указан)
+                if year and abs(int(movie_year) - year) > 1:
+                    continue
+
+                for torrent in movie_data.get('torrents', []):
+                    quality = torrent.get('quality', 'Unknown')
+                    torrent_url = torrent.get('url', '')
+
+                    if torrent_url:
+                        torrent_name = f"{movie_title} [{quality}]"
+                        results.append(self.make_result(
+                            torrent_name, parse_release(torrent_name),
+                            url=torrent_url,
+                            size=torrent.get('size', 'Unknown'),
+                            size_bytes=torrent.get('size_bytes'),
+                            quality=quality,
+                            seeds=torrent.get('seeds', 0),
+                            leech=torrent.get('peers', 0),
+                            torrent=torrent_url,
+                            magnet=None  # YTS дает только .torrent файлы
+                        ))
+
+            # Если нашли результаты, переходим к следующему источнику
+            if results:
+                break
+
+        return results
+
+
+class X1337Provider(HtmlTorrentProvider):
+    """1337x: скрапинг, перебор зеркал домена"""
+    name = '1337x'
+    domains = ['https://1337x.to', 'https://1337x.st', 'https://1337x.is']
+
+    rows = etree.XPath(f'//table[{has_class("table-list")}]//tbody//tr')
+    name_cell = etree.XPath(f'.//td[{has_class("name")}]')
+    # Вторая ссылка в ячейке названия (первая — иконка категории)
+    name_link = etree.XPath('.//a[count(preceding-sibling::*) = 1]')
+    size_cell = etree.XPath(f'.//td[{has_class("size")}]')
+    seeds_cell = etree.XPath(f'.//td[{has_class("seeds")}]')
+    leeches_cell = etree.XPath(f'.//td[{has_class("leeches")}]')
+
+    def search(self, ctx, session):
+        results = []
+
+        for query in ctx['search_queries']:
+            for domain in self.domains:
+                if time_left(ctx) <= 0:
+                    return results
+
+                try:
+                    search_url = f"{domain}/search/{urllib.parse.quote(query)}/1/"
+                    response = session.get(search_url, timeout=request_timeout(ctx))
+                    if response.status_code != 200:
+                        continue
+
+                    results.extend(self.parse_page(parse_html(response), ctx, query, domain))
+
+                    # Если нашли хотя бы 3 результата, прекращаем поиск на этом трекере
+                    if len(results) >= 3:
+                        break
+                except Exception as e:
+                    print(f"Ошибка при доступе к домену 1337x {domain}: {str(e)}")
+                    continue
+
+            # Если нашли результаты для текущего запроса, переходим к следующему трекеру
+            if results:
+                break
+
+        return results
+
+    def parse_page(self, doc, ctx, query, base_url=None):
+        results = []
+        year = ctx['year']
+
+        for row in self.rows(doc)[:10]:  # Ограничиваем до 10 результатов
+            try:
+                name_cell = first(self.name_cell, row)
+                if name_cell is None:
+                    continue
+
+                name_link = self.name_link(name_cell)[0]
+                torrent_name = element_text(name_link)
+                torrent_link = name_link.attrib['href']
+
+                # Проверяем наличие ключевых слов из запроса в названии
+                if not matches_query(torrent_name, query):
+                    continue
+
+                # Проверяем год, если он указан в запросе
+                release = parse_release(torrent_name)
+                if year_mismatch(release, year):
+                    continue
+
+                results.append(self.make_result(
+                    torrent_name, release,
+                    # Ссылка на детальную страницу торрента
+                    url=f"{base_url}{torrent_link}",
+                    # В ячейке размера для мобильной версии вложено число сидов, берем только ее собственный текст
+                    size=(self.size_cell(row)[0].text or '').strip(),
+                    seeds=stripped_text(self.seeds_cell(row)[0]),
+                    leech=stripped_text(self.leeches_cell(row)[0]),
+                    magnet=None,  # Будет получено по запросу
+                    torrent=None  # Будет получено по запросу
+                ))
+            except Exception as e:
+                print(f"Ошибка при парсинге результата 1337x: {str(e)}")
+                continue
+
+        return results
+
+
+class RuTrackerProvider(HtmlTorrentProvider):
+    """RuTracker: особенно полезен для русских фильмов"""
+    name = 'RuTracker'
+
+    rows = etree.XPath(f'//table[{has_class("forumline")}]//tr[{has_class("hl-tr")}]')
+    title_cell = etree.XPath(f'.//td[{has_class("t-title")}]')
+    link = etree.XPath('.//a')
+    seeds = etree.XPath(f'.//td[{has_class("seedmed")}]//b')
+    leeches = etree.XPath(f'.//td[{has_class("leechmed")}]//b')
+    size_cell = etree.XPath(f'.//td[{has_class("tor-size")}]')
+
+    def applicable(self, ctx):
+        return bool(ctx['title_ru'])
+
+    def search(self, ctx, session):
+        query = ctx['title_ru']
+        if ctx['year']:
+            query += f" {ctx['year']}"
+
+        # RuTracker использует POST-запрос для поиска
+        rutracker_response = session.post('https://rutracker.org/forum/tracker.php', data={'nm': query},
+                                          timeout=request_timeout(ctx))
+        if rutracker_response.status_code != 200:
+            return []
+
+        return self.parse_page(parse_html(rutracker_response), ctx, query)
+
+    def parse_page(self, doc, ctx, query, base_url=None):
+        results = []
+        year = ctx['year']
+
+        title_parts = [p.lower() for p in [ctx['clean_title_ru'], ctx['clean_title_en']] if p]
+
+        for row in self.rows(doc)[:7]:  # Ограничиваем до 7 результатов
+            try:
+                title_cell = first(self.title_cell, row)
+                if title_cell is None:
+                    continue
+
+                link = self.link(title_cell)[0]
+                torrent_name = element_text(link)
+                torrent_link = link.attrib['href']
+
+                # Проверяем название на соответствие запросу
+                if not any(part in torrent_name.lower() for part in title_parts):
+                    continue
+
+                # Проверяем год, если он указан
+                release = parse_release(torrent_name)
+                if year_mismatch(release, year):
+                    continue
+
+                # Получаем сиды и личи
+                seeds = first(self.seeds, row)
+                leeches = first(self.leeches, row)
+
+                # Получаем размер
+                size_cell = first(self.size_cell, row)
+
+                # Формируем ссылку на страницу с торрентом
+                if not torrent_link.startswith('http'):
+                    torrent_link = f"https://rutracker.org/forum/{torrent_link}"
+
+                results.append(self.make_result(
+                    torrent_name, release,
+                    url=torrent_link,
+                    size=stripped_text(size_cell) if size_cell is not None else 'Unknown',
+                    seeds=element_text(seeds) if seeds is not None else 0,
+                    leech=element_text(leeches) if leeches is not None else 0,
+                    magnet=None,  # Будет получено по запросу
+                    torrent=None  # Будет получено по запросу
+                ))
+            except Exception as e:
+                print(f"Ошибка при парсинге результата RuTracker: {str(e)}")
+                continue
+
+        return results
+
+
+class KinozalProvider(HtmlTorrentProvider):
+    """Kinozal: русские релизы"""
+    name = 'Kinozal'
+
+    rows = etree.XPath(f'//table[{has_class("t_peer")} and {has_class("w100p")}]//tr[not({has_class("bg")})]')
+    cells = etree.XPath('.//td')
+    link = etree.XPath('.//a')
+
+    def applicable(self, ctx):
+        return bool(ctx['title_ru'])
+
+    def search(self, ctx, session):
+        query = ctx['title_ru']
+        if ctx['year']:
+            query += f" {ctx['year']}"
+
+        kinozal_response = session.get('https://kinozal.tv/browse.php', params={'s': query},
+                                       timeout=request_timeout(ctx))
+        if kinozal_response.status_code != 200:
+            return []
+
+        return self.parse_page(parse_html(kinozal_response), ctx, query)
+
+    def parse_page(self, doc, ctx, query, base_url=None):
+        results = []
+        year = ctx['year']
+
+        for row in self.rows(doc)[:7]:  # Ограничиваем до 7 результатов
+            try:
+                cells = self.cells(row)
+                if len(cells) < 5:
+                    continue
+
+                name_cell = cells[1]
+                size_cell = cells[3]
+                seeds_cell = cells[4]
+
+                link = first(self.link, name_cell)
+                if link is None:
+                    continue
+
+                torrent_name = stripped_text(link)
+                detail_url = 'https://kinozal.tv' + link.get('href') if link.get('href') is not None else None
+
+                # Проверяем соответствие запросу
+                if not any(part.lower() in torrent_name.lower() for part in [ctx['title_ru'], ctx['title_en']] if part):
+                    continue
+
+                # Проверяем год, если он указан
+                release = parse_release(torrent_name)
+                if year_mismatch(release, year):
+                    continue
+
+                results.append(self.make_result(
+                    torrent_name, release,
+                    url=detail_url,
+                    size=stripped_text(size_cell),
+                    seeds=stripped_text(seeds_cell),
+                    leech=0,  # Kinozal не показывает личей в результатах поиска
+                    magnet=None,  # Требуется регистрация
+                    torrent=None   # Требуется регистрация
+                ))
+            except Exception as e:
+                print(f"Ошибка при парсинге результата Kinozal: {str(e)}")
+                continue
+
+        return results
+
+
+class EZTVProvider(HtmlTorrentProvider):
+    """EZTV: только для сериалов"""
+    name = 'EZTV'
+
+    rows = etree.XPath(f'//table//tr[{has_class("forum_header_border")}]')
+    title = etree.XPath(f'.//td[{has_class("forum_thread_post")}]//a[{has_class("epinfo")}]')
+    # Магнет в третьей ячейке, размер в четвертой, сиды в шестой
+    magnet_link = etree.XPath('.//td[count(preceding-sibling::*) = 2]//a')
+    size_cell = etree.XPath('.//td[count(preceding-sibling::*) = 3]')
+    seeds_cell = etree.XPath('.//td[count(preceding-sibling::*) = 5]')
+
+    def applicable(self, ctx):
+        queries = ctx['search_queries']
+        return bool(queries) and (ctx['is_series'] or 'season' in queries[0].lower())
+
+    def search(self, ctx, session):
+        query = ctx['search_queries'][0]
+
+        eztv_response = session.get(f"https://eztv.re/search/{urllib.parse.quote(query)}", timeout=request_timeout(ctx))
+        if eztv_response.status_code != 200:
+            return []
+
+        return self.parse_page(parse_html(eztv_response), ctx, query)
+
+    def parse_page(self, doc, ctx, query, base_url=None):
+        results = []
+
+        for row in self.rows(doc)[:10]:  # Ограничиваем до 10 результатов
+            try:
+                title_element = first(self.title, row)
+                if title_element is None:
+                    continue
+
+                torrent_name = element_text(title_element)
+
+                # Проверка соответствия запросу
+                if not matches_query(torrent_name, query):
+                    continue
+
+                magnet_element = first(self.magnet_link, row)
+                if magnet_element is None or 'magnet:' not in magnet_element.get('href', ''):
+                    continue
+
+                magnet_url = magnet_element.get('href')
+
+                # Получаем размер и сиды/личи
+                size_cell = first(self.size_cell, row)
+                seeds_cell = first(self.seeds_cell, row)
+
+                results.append(self.make_result(
+                    torrent_name, parse_release(torrent_name),
+                    url=magnet_url,
+                    size=stripped_text(size_cell) if size_cell is not None else 'Unknown',
+                    seeds=stripped_text(seeds_cell) if seeds_cell is not None else 0,
+                    leech=0,  # EZTV не показывает личей
+                    magnet=magnet_url,
+                    torrent=None
+                ))
+            except Exception as e:
+                print(f"Ошибка при парсинге результата EZTV: {str(e)}")
+                continue
+
+        return results
+
+
+# Провайдеры в порядке приоритета; новый трекер достаточно добавить в этот список
+PROVIDERS = [
+    RutorProvider(),
+    YTSProvider(),
+    X1337Provider(),
+    RuTrackerProvider(),
+    KinozalProvider(),
+    EZTVProvider(),
+]
+
+# Общий пул для всех поисков процесса, чтобы одновременные поиски не плодили потоки без ограничений
+search_executor = None
+
+# Кэш результатов провайдеров (cache.TTLCache), пространство имен tracker:<имя>
+result_cache = None
+
+# Сколько секунд может работать провайдер, когда включен кэш. Ответ пользователю по-прежнему
+# ограничен дедлайном поиска, но опоздавший результат сохранится для следующих поисков
+PROVIDER_DEADLINE = 30
+
+# Общий HTTP-клиент (http_client.HttpClient): пул соединений с трекерами и повторы запросов
+http_client = None
+
+def configure(max_workers, cache=None, client=None):
+    global search_executor, result_cache, http_client
+    search_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='trackers')
+    result_cache = cache
+    http_client = client or HttpClient()
+
+def new_session(ctx):
+    """Сессия для одного поиска: повторы запросов не выходят за дедлайн поиска"""
+    return http_client.session(deadline=ctx['deadline'])
+
+def load_provider_results(provider, ctx):
+    """Поиск провайдером для кэша: ответ, собранный после дедлайна, может быть неполным,
+    поэтому он не кэшируется, а ошибка из-за урезанного дедлайном таймаута не запоминается"""
+    session = new_session(ctx)
+    try:
+        results = provider.search(ctx, session)
+    except Exception as e:
+        if time_left(ctx) <= 0:
+            raise UncacheableError(str(e)) from e
+        raise
+    finally:
+        session.close()
+
+    if time_left(ctx) <= 0:
+        return Uncached(results)
+    return results
+
+def run_provider(provider, ctx):
+    """Выполняет поиск одним провайдером; ошибки превращаются в пустой результат с описанием"""
+    started = time.monotonic()
+    try:
+        if result_cache is None:
+            results = load_provider_results(provider, ctx)
+            if isinstance(results, Uncached):
+                results = results.value
+        else:
+            provider_ctx = dict(ctx, deadline=max(ctx['deadline'], started + PROVIDER_DEADLINE))
+            results = result_cache.get_or_load(
+                f'tracker:{provider.name}', provider.cache_key(ctx),
+                lambda: load_provider_results(provider, provider_ctx),
+                # Фоновое обновление не привязано к дедлайну исходного запроса
+                refresh=lambda: load_provider_results(provider, dict(ctx, deadline=time.monotonic() + PROVIDER_DEADLINE)),
+                is_negative=lambda value: not value
+            )
+        error = None
+    except CachedFailure as e:
+        results, error = [], str(e)
+    except Exception as e:
+        print(f"Ошибка при поиске на {provider.name}: {str(e)}")
+        results, error = [], str(e)
+
+    return {
+        'engine': provider.name,
+        'results': results,
+        'error': error,
+        'elapsed': round(time.monotonic() - started, 3),
+    }
+
+def search_providers(ctx, providers=None):
+    """Опрашивает провайдеров параллельно и выдает их ответы по мере готовности.
+    Провайдеры, не успевшие к дедлайну, выдаются с ошибкой 'timeout'"""
+    if search_executor is None:
+        configure(len(PROVIDERS) * 2)
+
+    providers = [p for p in (providers or PROVIDERS) if p.applicable(ctx)]
+    pending = {search_executor.submit(run_provider, provider, ctx): provider for provider in providers}
+
+    while pending:
+        remaining = time_left(ctx)
+        if remaining <= 0:
+            break
+
+        done, _ = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            pending.pop(future)
+            yield future.result()
+
+    # Опоздавшие провайдеры сами завершатся по таймауту запроса, их результаты не ждем
+    for future, provider in pending.items():
+        future.cancel()
+        yield {'engine': provider.name, 'results': [], 'error': 'timeout', 'elapsed': None}
+
+def fallback_links(query, trackers):
+    """Ссылки на поисковые системы и трекеры, если торрентов найдено слишком мало"""
+    links = []
+
+    # Безопасные поисковые системы, которые можно использовать как запасной вариант
+    search_engines = [
+        {'name': 'Google', 'url': f'https://www.google.com/search?q={urllib.parse.quote(query)}+torrent'},
+        {'name': 'Yandex', 'url': f'https://yandex.ru/search/?text={urllib.parse.quote(query)}+torrent'},
+        {'name': 'DuckDuckGo', 'url': f'https://duckduckgo.com/?q={urllib.parse.quote(query)}+torrent'}
+    ]
+
+    for engine in search_engines:
+        links.append({
+            'name': f'Поиск в {engine["name"]}: {query}',
+            'url': engine['url'],
+            'size': 'N/A',
+            'quality': 'N/A',
+            'seeds': 'N/A',
+            'leech': 'N/A',
+            'engine': engine['name'],
+            'magnet': None,
+            'torrent': None
+        })
+
+    # Добавляем прямые ссылки на трекеры с безопасным поиском
+    for tracker in trackers:
+        links.append({
+            'name': f'Поиск на {tracker["name"]}: {query}',
+            'url': tracker['search_url'].format(query=urllib.parse.quote(query)),
+            'size': 'N/A',
+            'quality': 'N/A',
+            'seeds': 'N/A',
+            'leech': 'N/A',
+            'engine': tracker['name'],
+            'magnet': None,
+            'torrent': None
+        })
+
+    return links
+
+# Слияние и ранжирование результатов всех провайдеров
+MAGNET_HASH_RE = re.compile(r'xt=urn:btih:([0-9a-f]{40}|[a-z2-7]{32})', re.IGNORECASE)
+URL_HASH_RE = re.compile(r'(?<![0-9a-f])([0-9a-f]{40})(?![0-9a-f])', re.IGNORECASE)
+TOKEN_RE = re.compile(r'[^\W_]+')
+
+# Веса составляющих оценки результата (каждая составляющая от 0 до 1)
+SCORE_WEIGHTS = {'title': 3, 'year': 1, 'quality': 1.5, 'seeds': 2}
+# Столько сидов считается полностью здоровой раздачей
+HEALTHY_SEEDS = 1000
+RESOLUTION_SCORES = {2160: 1.0, 1440: 0.95, 1080: 0.9, 720: 0.6, 576: 0.4, 480: 0.3}
+# Качество по источнику, если разрешение в названии не указано
+SOURCE_SCORES = {'Remux': 0.9, 'BluRay': 0.8, 'BDRip': 0.7, 'WEB-DL': 0.7, 'WEBRip': 0.6, 'HDRip': 0.5,
+                 'HDTV': 0.5, 'DVDRip': 0.4, 'DVD': 0.4}
+
+def infohash(item):
+    """Infohash раздачи (40 hex-символов в нижнем регистре) из магнет-ссылки или ссылки
+    на .torrent, в которой он обычно есть (YTS, зеркала torrent-кэшей). None, если его нет"""
+    match = MAGNET_HASH_RE.search(item.get('magnet') or '')
+    if match is None and (item.get('url') or '').startswith('magnet:'):
+        match = MAGNET_HASH_RE.search(item['url'])
+    if match is not None:
+        value = match.group(1)
+        if len(value) == 32:
+            value = base64.b32decode(value.upper()).hex()
+        return value.lower()
+
+    match = URL_HASH_RE.search(item.get('torrent') or '')
+    return match.group(1).lower() if match else None
+
+def dedupe_key(item):
+    """Раздачи с одним infohash — одна раздача, на каком бы трекере она ни нашлась.
+    Без infohash одинаковыми считаются ссылки одного трекера на одну страницу: адрес сравнивается
+    без схемы и домена (1337x отдает одни и те же раздачи на всех зеркалах домена), но с параметрами
+    запроса — у RuTracker (viewtopic.php?t=N) и Kinozal (details.php?id=N) раздача задается только ими"""
+    value = infohash(item)
+    if value:
+        return ('btih', value)
+    url = urllib.parse.urlsplit(item.get('url') or '')
+    if not url.path and not url.query:
+        return ('name', item.get('engine'), item.get('name'))
+    query = urllib.parse.urlencode(sorted(urllib.parse.parse_qsl(url.query, keep_blank_values=True)))
+    return ('page', item.get('engine'), url.path, query)
+
+def merge_results(results):
+    """Объединяет повторы одной раздачи. Сиды и личи складываются по трекерам, но с одного
+    трекера берется максимум, чтобы не считать одну и ту же раздачу дважды"""
+    merged = {}
+    for item in results:
+        key = dedupe_key(item)
+        entry = merged.get(key)
+        if entry is None:
+            merged[key] = entry = {'item': dict(item), 'seeds': {}, 'leech': {}}
+        else:
+            # Недостающие ссылки берутся у повторов; магнет-ссылка предпочтительнее страницы трекера
+            merged_item = entry['item']
+            for field in ('magnet', 'torrent', 'size_bytes'):
+                if merged_item.get(field) is None and item.get(field) is not None:
+                    merged_item[field] = item[field]
+            if item.get('magnet') and not (merged_item.get('url') or '').startswith('magnet:'):
+                merged_item['url'] = item['magnet']
+
+        engine = item.get('engine')
+        entry['seeds'][engine] = max(entry['seeds'].get(engine, 0), parse_count(item.get('seeds')))
+        entry['leech'][engine] = max(entry['leech'].get(engine, 0), parse_count(item.get('leech')))
+
+    items = []
+    for key, entry in merged.items():
+        item = entry['item']
+        item['seeds'] = sum(entry['seeds'].values())
+        item['leech'] = sum(entry['leech'].values())
+        item['sources'] = list(entry['seeds'])
+        item['infohash'] = key[1] if key[0] == 'btih' else None
+        items.append(item)
+    return items
+
+def title_tokens(text):
+    return set(TOKEN_RE.findall((text or '').lower().replace('ё', 'е')))
+
+def score_result(item, title_variants, year):
+    """Оценка результата: совпадение названия, года, качество и число сидов"""
+    name_tokens = title_tokens(item.get('name'))
+    title_score = max((len(tokens & name_tokens) / len(tokens) for tokens in title_variants), default=0)
+
+    release = item.get('release') or {}
+    # Годов в названии бывает несколько («Бегущий по лезвию 2049 (2017)»), как и в year_mismatch
+    if not year or not release.get('years'):
+        year_score = 0.5
+    else:
+        year_score = 1.0 if int(year) in release['years'] else 0.0
+
+    quality_score = RESOLUTION_SCORES.get(release.get('resolution')) or SOURCE_SCORES.get(release.get('source'), 0.2)
+    # Экранка остается экранкой при любом заявленном разрешении
+    if release.get('source') in ('CAM', 'TS'):
+        quality_score = 0
+
+    seeds_score = min(math.log1p(item.get('seeds', 0)) / math.log1p(HEALTHY_SEEDS), 1.0)
+
+    return (SCORE_WEIGHTS['title'] * title_score + SCORE_WEIGHTS['year'] * year_score
+            + SCORE_WEIGHTS['quality'] * quality_score + SCORE_WEIGHTS['seeds'] * seeds_score)
+
+def rank_results(results, ctx, limit):
+    """Лучшие limit результатов: повторы объединены, остальные отсортированы по оценке.
+    Выбор через ограниченную кучу (heapq.nlargest), полной сортировки нет"""
+    title_variants = [tokens for tokens in (title_tokens(ctx['clean_title_en']), title_tokens(ctx['clean_title_ru'])) if tokens]
+    items = merge_results(results)
+    for item in items:
+        item['score'] = round(score_result(item, title_variants, ctx['year']), 3)
+    # При равной оценке выше раздача с большим числом сидов
+    return heapq.nlargest(limit, items, key=lambda item: (item['score'], item['seeds']))